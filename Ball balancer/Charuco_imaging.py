@@ -2,6 +2,9 @@ import cv2 as cv
 import numpy as np
 import time
 import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from ballDetector import BallTracker
 
 # Board Parameters
 ARUCO_DICT = cv.aruco.DICT_5X5_250 # 5 bit x 5 bit codes w/ hamming distance of 6, 250
@@ -16,6 +19,22 @@ DISTORTION_MATRIX_PATH = 'C:/Users/trist\OneDrive/Desktop/Projects/ELEC3907A3-F-
 WINDOW_SIZE = (480, 640)
 TRANSFORMED_SIZE = (480, 480)
 
+# Copies of the calibration files that live next to this file, used if the paths above don't exist on this machine
+LOCAL_CAM_MATRIX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '3camMatrix.npy')
+LOCAL_DISTORTION_MATRIX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '3distMatrix.npy')
+LOCAL_CALIBRATION_LOCATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CamCalibration')
+
+MAX_REPROJECTION_ERROR = 1.0 # pixels, calibration images worse than this get dropped
+MIN_CALIBRATION_IMAGES = 10 # never drop images below this many
+
+DEFAULT_BALL_TRACKER = BallTracker() # used by get_circle_position when no tracker is passed in
+
+# these import this file back for the board parameters and sizes above, so they come after them and are imported as
+# modules (not from ... import) so it works whichever of them is imported first
+import frameProcessor
+import homographyCache as homographies
+import cameraCapture
+
 
 
 
@@ -39,117 +58,294 @@ def generateCharucoBoard():
       
 
 
-def saveCalibrationCameraParameters ():
+def boardKey():
+    """
+    short hash of the board parameters, detections cached for one board aren't reused for another
+    """
+    description = repr((ARUCO_DICT, SIZE, SQUARE_LENGTH, MARKER_LENGTH))
+    return hashlib.sha1(description.encode()).hexdigest()[:12]
+
+
+def detectCalibrationImage(image_path, cache_dir=None):
+    """
+    finds the charuco corners in one calibration image.
+    returns (image_path, charuco_corners, charuco_ids, image_size), corners and ids are None if the board wasn't found,
+    everything but the path is None if the image couldn't be read.
+    If cache_dir is given the result is stored there, keyed by the file contents and board parameters,
+    so unchanged images are never processed twice
+    """
+    cache_path = None
+    if cache_dir is not None:
+        with open(image_path, 'rb') as image_file:
+            file_hash = hashlib.sha1(image_file.read()).hexdigest()
+        cache_path = os.path.join(cache_dir, file_hash + '_' + boardKey() + '.npz')
+        if os.path.exists(cache_path):
+            cached = np.load(cache_path)
+            if cached['found']:
+                return image_path, cached['corners'], cached['ids'], tuple(cached['image_size'])
+            return image_path, None, None, tuple(cached['image_size'])
+
+    dictionary = cv.aruco.getPredefinedDictionary(ARUCO_DICT)
+    board = cv.aruco.CharucoBoard(SIZE, SQUARE_LENGTH, MARKER_LENGTH, dictionary)
+    params = cv.aruco.DetectorParameters()
+
+    image = cv.imread(image_path)
+    if image is None:
+        print("Couldn't read", image_path, "skipping it")
+        return image_path, None, None, None
+    image_size = (image.shape[1], image.shape[0])
+    charuco_corners, charuco_ids = None, None
+    marker_corners, marker_ids, _ = cv.aruco.detectMarkers(image, dictionary, parameters = params)
+    if len(marker_corners) > 0:
+        charuco_retval, corners, ids = cv.aruco.interpolateCornersCharuco(marker_corners, marker_ids, image, board)
+        if charuco_retval:
+            charuco_corners, charuco_ids = corners, ids
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        if charuco_corners is not None:
+            np.savez(cache_path, found=True, corners=charuco_corners, ids=charuco_ids, image_size=image_size)
+        else:
+            np.savez(cache_path, found=False, image_size=image_size)
+
+    return image_path, charuco_corners, charuco_ids, image_size
+
+
+def _detectCalibrationImageArgs(args):
+    return detectCalibrationImage(*args)
+
+
+def reprojectionErrors(charuco_corners, charuco_ids, board, camera_matrix, dist_coeffs, rvecs, tvecs):
+    """
+    returns the rms reprojection error (pixels) of each calibration image
+    """
+    board_points = board.getChessboardCorners()
+    errors = []
+    for corners, ids, rvec, tvec in zip(charuco_corners, charuco_ids, rvecs, tvecs):
+        projected, _ = cv.projectPoints(board_points[ids.flatten()], rvec, tvec, camera_matrix, dist_coeffs)
+        errors.append(float(np.sqrt(np.mean(np.sum((projected.reshape(-1, 2) - corners.reshape(-1, 2))**2, axis=1)))))
+    return errors
+
+
+def saveCalibrationCameraParameters (processes=None, max_reprojection_error=MAX_REPROJECTION_ERROR, use_cache=True):
     """
     Takes a folder of images and calculates the camera and distortion matrix. These get saved to a np array for later use
+
+    Detection runs over a process pool and is cached per image (see detectCalibrationImage), so adding a few images
+    only processes the new ones. Images with a reprojection error above max_reprojection_error (pixels) are dropped
+    and the calibration is redone without them. Returns a report of {image path: reprojection error or None if not used}
     """
     # Load the board parameters
     dictionary = cv.aruco.getPredefinedDictionary(ARUCO_DICT)
     board = cv.aruco.CharucoBoard(SIZE, SQUARE_LENGTH, MARKER_LENGTH, dictionary)
-    params = cv.aruco.DetectorParameters()
 
+    calibration_location = CALIBRATION_LOCATION if os.path.isdir(CALIBRATION_LOCATION) else LOCAL_CALIBRATION_LOCATION
+    cache_dir = os.path.join(calibration_location, 'cache') if use_cache else None
 
     # Load the calibration images and saves the filepath to a list
     images = []
-    for filename in os.listdir(CALIBRATION_LOCATION):
+    for filename in sorted(os.listdir(calibration_location)):
         if filename.endswith('.jpg'):
-            image_path = os.path.join(CALIBRATION_LOCATION,filename).replace("\\", "/")
+            image_path = os.path.join(calibration_location,filename).replace("\\", "/")
             images.append(image_path)
 
-    
-    
-
-    all_charuco_corners = []
-    all_charuco_ids = []
-
-    # checks each image for charuco Patterns 
-    for image_file in images:
-        image = cv.imread(image_file)
-        marker_corners, marker_ids, _ = cv.aruco.detectMarkers(image, dictionary, parameters = params)
-        if len(marker_corners) > 0:
-            charuco_retval, charuco_corners, charuco_ids = cv.aruco.interpolateCornersCharuco(marker_corners, marker_ids, image, board)
-            if charuco_retval:
-                all_charuco_corners.append(charuco_corners)
-                all_charuco_ids.append(charuco_ids)
-                
+    # checks each image for charuco Patterns, in parallel
+    with ProcessPoolExecutor(processes) as pool:
+        detections = list(pool.map(_detectCalibrationImageArgs, [(image_path, cache_dir) for image_path in images]))
 
+    report = {image_path: None for image_path in images}
+    detections = [detection for detection in detections if detection[1] is not None]
+    if len(detections) == 0:
+        print("No charuco boards found, calibration failed")
+        return report
+    image_size = detections[0][3]
 
-    retval, camera_matrix, dist_coeffs, rvecs, tvecs = cv.aruco.calibrateCameraCharuco(all_charuco_corners, all_charuco_ids, board, image.shape[:2], None, None)
-
-    
-    np.save(CAM_MATRIX_PATH, camera_matrix)
-    np.save(DISTORTION_MATRIX_PATH, dist_coeffs)
+    while True:
+        all_charuco_corners = [detection[1] for detection in detections]
+        all_charuco_ids = [detection[2] for detection in detections]
+        retval, camera_matrix, dist_coeffs, rvecs, tvecs = cv.aruco.calibrateCameraCharuco(all_charuco_corners, all_charuco_ids, board, image_size, None, None)
+        errors = reprojectionErrors(all_charuco_corners, all_charuco_ids, board, camera_matrix, dist_coeffs, rvecs, tvecs)
+
+        # drop the bad frames and calibrate again (keeping enough images to calibrate with)
+        bad = [i for i, error in enumerate(errors) if error > max_reprojection_error]
+        if len(bad) == 0 or len(detections) - len(bad) < MIN_CALIBRATION_IMAGES:
+            break
+        for i in bad:
+            print("Dropping", os.path.basename(detections[i][0]), "reprojection error =", errors[i])
+        detections = [detection for i, detection in enumerate(detections) if i not in bad]
+
+    for detection, error in zip(detections, errors):
+        report[detection[0]] = error
+    print("Per image reprojection error (pixels):")
+    for image_path, error in report.items():
+        print("   ", os.path.basename(image_path), "not used" if error is None else round(error, 3))
+    print("Overall rms reprojection error =", retval, "using", len(detections), "of", len(images), "images")
+
+    cam_matrix_path = CAM_MATRIX_PATH if os.path.isdir(os.path.dirname(CAM_MATRIX_PATH)) else LOCAL_CAM_MATRIX_PATH
+    distortion_matrix_path = DISTORTION_MATRIX_PATH if os.path.isdir(os.path.dirname(DISTORTION_MATRIX_PATH)) else LOCAL_DISTORTION_MATRIX_PATH
+    np.save(cam_matrix_path, camera_matrix)
+    np.save(distortion_matrix_path, dist_coeffs)
     print("Calibration complete and saved")
+    return report
 
 
-def drawCorners(image, dictionary, board, camMatrix, distMatrix):
+def estimateBoardPose(image, dictionary, board, camMatrix, distMatrix):
     """
-    takes in an image with a charuco board and locates the corners of the image and adds a marker.
-    outputs an image with the coners drawn on.
+    finds the charuco board in the image and estimates its pose.
+    returns (found, rvec, tvec), rvec and tvec are None if the board wasn't found
     """
-    x_size, y_size = SIZE
-    charucoPoints3D = [(0,0,0), (x_size*SQUARE_LENGTH, 0, 0), (0, y_size*SQUARE_LENGTH, 0), (x_size*SQUARE_LENGTH, y_size*SQUARE_LENGTH, 0)]
-
     # find corners in supplied image and get pixle position and Ids
     corners, ids, _ = cv.aruco.detectMarkers(image, dictionary)
     if len(corners) > 0:
         charucoCorners = cv.aruco.interpolateCornersCharuco(corners, ids, image, board)
-        #print("\n" + str(charucoCorners) + "\n")
 
-        # unpacks the corners into cornerLocations and Ids and tries to draw boxes
+        # unpacks the corners into cornerLocations and Ids
         if charucoCorners is not None and len(charucoCorners) > 0:
             charucoCornerLocations =  charucoCorners[1]
             charucoIds = charucoCorners[2]
 
-            # Estimates pose and draws in corners
-
+            # Estimates pose
             if charucoCornerLocations is not None and len(charucoCornerLocations) > 0 and len(charucoIds) >= 6:
                 ret, rvec, tvec = cv.aruco.estimatePoseCharucoBoard(charucoCornerLocations, charucoIds, board, camMatrix, distMatrix, None, None, useExtrinsicGuess= False)
-                cornerArray = []
                 if ret:
-                    for point_3d in charucoPoints3D:
-                        point_2d, _ = cv.projectPoints(point_3d, rvec, tvec, camMatrix, distMatrix)
-                        #print(point_2d[0][0])
-                        cornerArray.append(tuple(point_2d[0][0]))
-                    
-                    cornerArray = np.array(cornerArray)
-                    transformedImage = transformPerspective(image, cornerArray)
-                    #print(image.shape)
-                    return True, transformedImage
-        
-        return False, image
+                    return True, rvec, tvec
 
+    return False, None, None
+
+
+def boardCornerPoints3D():
+    """
+    returns the 4 outside corners of the board in board coordinates (meters), in the order transformPerspective expects
+    """
+    x_size, y_size = SIZE
+    return np.array([(0,0,0), (x_size*SQUARE_LENGTH, 0, 0), (0, y_size*SQUARE_LENGTH, 0), (x_size*SQUARE_LENGTH, y_size*SQUARE_LENGTH, 0)], dtype=np.float64)
+
+
+def projectBoardCorners(rvec, tvec, camMatrix, distMatrix):
+    """
+    projects the 4 outside corners of the board into the image, returns a (4, 2) array of pixel positions
+    """
+    # all 4 points in one call instead of one call per point
+    points_2d, _ = cv.projectPoints(boardCornerPoints3D(), rvec, tvec, camMatrix, distMatrix)
+    return points_2d.reshape(4, 2)
+
+
+def drawCorners(image, dictionary, board, camMatrix, distMatrix):
+    """
+    takes in an image with a charuco board and locates the corners of the image and adds a marker.
+    outputs an image with the coners drawn on.
+    """
+    ret, rvec, tvec = estimateBoardPose(image, dictionary, board, camMatrix, distMatrix)
+    if ret:
+        cornerArray = projectBoardCorners(rvec, tvec, camMatrix, distMatrix)
+        transformedImage = transformPerspective(image, cornerArray)
+        return True, transformedImage
 
     return False, image
 
+def calculateHomography(cornerList, ransac=True):
+    """
+    returns the homography that moves the located corners to the corners of a TRANSFORMED_SIZE image.
+    with exactly 4 exact corners ransac can be turned off to use the cheaper direct solution
+    """
+    x_length, y_length = TRANSFORMED_SIZE
+
+    destination = np.array([(0,0), (x_length,0), (0, y_length), (x_length, y_length)], dtype=np.float32)
+
+    if ransac:
+        transform, mask = cv.findHomography(cornerList, destination, cv.RANSAC, 5.0)
+    else:
+        transform = cv.getPerspectiveTransform(np.asarray(cornerList, dtype=np.float32), destination)
+    return transform
+
 def transformPerspective(image, cornerList):
     """
     takes in the image, and returns a transformed image. The transformed image
     has the located corners moved to a specifed point in the returned image.
     """
 
-    x_length, y_length = TRANSFORMED_SIZE
-
-    destination = np.array([(0,0), (x_length,0), (0, y_length), (x_length, y_length)])
-   
-    transform, mask = cv.findHomography(cornerList, destination, cv.RANSAC, 5.0)
-    transformedImage = cv.warpPerspective(image, transform, (x_length, y_length))
+    transform = calculateHomography(cornerList)
+    transformedImage = cv.warpPerspective(image, transform, TRANSFORMED_SIZE)
 
     return transformedImage
 
 
-def get_circle_position(image):
+def get_circle_position(image, tracker=None):
     """
     takes in an image that has had a perspective transformation and ouputs the position of a circle in the image.
-    the position is grabbed with a Hough circle transform. The output is a tuple with the x and y positions in pixels.
+    the ball is found by searching the whole frame for a round blob, then tracked in a small region around
+    where it is expected to be (see ballDetector.BallTracker). The output is a tuple with the x and y positions in pixels,
+    (None, None) if the ball wasn't found. Use get_circle_position_with_confidence to also get the confidence.
+    Without a tracker the shared default one is used, which only works for frames from one thread in order
     """
-    #circles = cv.HoughCircles(image,cv.HOUGH_GRADIENT_ALT, 0.5, 100, param1 = 100, param2 = 30, minRadius = 1, maxRadius = 30)
+    x_pos, y_pos, _ = get_circle_position_with_confidence(image, tracker)
+    return x_pos, y_pos
 
-    """Add in a filter to ensure that only the ball we are after gets returned. just for robustness. It should check all
-    the possible circles and eliminate those that are too small. Also needs the parameters tuned to ensure efficency. 
+
+def get_circle_position_with_confidence(image, tracker=None):
+    """
+    same as get_circle_position but returns (x, y, confidence). Uses a shared default tracker if none is given
     """
+    if tracker is None:
+        tracker = DEFAULT_BALL_TRACKER
+    return tracker.detect(image)
+
 
-    return None, None
+def get_circle_position_mm(image, calibration_map, tracker=None):
+    """
+    same as get_circle_position but the position is in mm on the plate from the middle of the board,
+    converted with an interperalate_matrix.CalibrationMap. (None, None) if the ball wasn't found
+    """
+    x_pos, y_pos = get_circle_position(image, tracker)
+    return calibration_map.toMillimetres(x_pos, y_pos)
+
+
+def loadCalibration():
+    """
+    loads the camera and distortion matrix, trying the configured paths first then the copies next to this file.
+    returns (camMatrix, distMatrix)
+    """
+    try:
+        return np.load(CAM_MATRIX_PATH), np.load(DISTORTION_MATRIX_PATH)
+    except OSError:
+        return np.load(LOCAL_CAM_MATRIX_PATH), np.load(LOCAL_DISTORTION_MATRIX_PATH)
+
+
+def processFrame(frame, dictionary, board, camMatrix, distMatrix, homographyCache=None, commandedTilt=(None, None),
+                 fusedRemap=None):
+    """
+    runs one camera frame through undistort -> sharpen -> board detection -> ball detection.
+    if a HomographyCache is given the board is only re-detected when the cache asks for it,
+    commandedTilt is the (pitch, roll) last sent to the platform, used by the cache to predict the board pose.
+    if a FusedRemap is given as well (needs the cache) undistort + warp is one remap of the raw frame,
+    and only the small warped image gets sharpened. The full frame is only undistorted when the board is re-detected
+    returns (found board, ball x, ball y, image to display). Ball position is None if it wasn't found
+    frameProcessor.FrameProcessor does the same without allocating new images every frame
+    """
+    if fusedRemap is not None and homographyCache is not None:
+        transform, version = homographyCache.update(lambda: sharpenImage(cv.undistort(frame, camMatrix, distMatrix)), *commandedTilt)
+        if transform is None:
+            return False, None, None, frame
+        fusedRemap.update(transform, version)
+        frame_to_display = sharpenImage(fusedRemap.apply(cv.cvtColor(frame, cv.COLOR_BGR2GRAY)))
+        x_pos, y_pos = get_circle_position(frame_to_display)
+        return True, x_pos, y_pos, frame_to_display
+
+    undistorted = cv.undistort(frame, camMatrix, distMatrix)
+    undistorted_gray = sharpenImage(undistorted)
+
+    if homographyCache is not None:
+        transform, _ = homographyCache.update(undistorted_gray, *commandedTilt)
+        corner_ret = transform is not None
+        frame_to_display = cv.warpPerspective(undistorted_gray, transform, TRANSFORMED_SIZE) if corner_ret else undistorted_gray
+    else:
+        corner_ret, frame_to_display = drawCorners(undistorted_gray, dictionary, board, camMatrix, distMatrix)
+
+    x_pos, y_pos = None, None
+    if corner_ret:
+        x_pos, y_pos = get_circle_position(frame_to_display)
+
+    return corner_ret, x_pos, y_pos, frame_to_display
 
 
 def sharpenImage(image, kernel_size=(7,7), sigma=0.25, intensity=4):
@@ -157,8 +353,8 @@ def sharpenImage(image, kernel_size=(7,7), sigma=0.25, intensity=4):
     Converts to gray and sharpens the image 
     """
 
-    # Convert image to grayscale
-    gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    # Convert image to grayscale (unless it already is)
+    gray = image if image.ndim == 2 else cv.cvtColor(image, cv.COLOR_BGR2GRAY)
     
     # Apply Gaussian blur
     blurred = cv.GaussianBlur(gray, kernel_size, sigma)
@@ -168,13 +364,14 @@ def sharpenImage(image, kernel_size=(7,7), sigma=0.25, intensity=4):
     
     return sharpened
 
-def main():
+def main(capture=None, adaptive=True):
     """
-    opens the camera and undistorts the images
+    opens the camera and undistorts the images.
+    capture - anything with a cv.VideoCapture style read() to use instead of the camera, e.g. a frameRecorder.ReplayCapture
+    adaptive - let the camera drop to a smaller size if processing can't keep up (see cameraCapture.py)
     """
     try:
-        camMatrix = np.load(CAM_MATRIX_PATH)
-        distMatrix = np.load(DISTORTION_MATRIX_PATH)
+        camMatrix, distMatrix = loadCalibration()
     except:
         print('Loading calibtration files failed')
         return
@@ -184,8 +381,15 @@ def main():
     board = cv.aruco.CharucoBoard(SIZE, SQUARE_LENGTH, MARKER_LENGTH, dictionary)
     
 
-    # Open 
-    cam = cv.VideoCapture(0) # use 1 for web cam
+    # buffers for every step (undistort, sharpen, warp), reused every frame instead of making new images.
+    # The board is only re-detected every so often (detection allocates), in between its homography is reused.
+    # The camera matrix gets scaled to whatever size the camera is running at
+    processor = frameProcessor.FrameProcessor(camMatrix, distMatrix, dictionary, board,
+                                              homographies.HomographyCache(dictionary, board, camMatrix, distMatrix),
+                                              calibrationSize=cameraCapture.CALIBRATION_SIZE)
+
+    # Open at WINDOW_SIZE, only reading the gray (luma) part of the frames
+    cam = capture if capture is not None else cameraCapture.CameraCapture(0, gray=True, adaptive=adaptive) # use 1 for web cam
     print(cam.isOpened())
     frame_count = 0
     start_time = cv.getTickCount()
@@ -196,10 +400,12 @@ def main():
         ret, frame = cam.read()
 
         if ret:
-            
-            undistorted = cv.undistort(frame, camMatrix, distMatrix)
+            process_start = time.perf_counter()
+            corner_ret, current_x_pos, current_y_pos, frame_to_display = processor.process(frame)
+            undistorted = processor.buffers['undistorted']
             #undistorted = cv.medianBlur(undistorted, 5)
-            undistorted_gray = sharpenImage(undistorted)
+            if isinstance(cam, cameraCapture.CameraCapture):
+                cam.reportProcessingTime(time.perf_counter() - process_start)
 
             
             #cv.imshow('Distorted Image', frame)
@@ -216,25 +422,25 @@ def main():
             #     cv.imshow('Undistorted Image', undistorted_gray)
 
             #current_time = time.time()
-            corner_ret, frame_to_display = drawCorners(undistorted_gray, dictionary, board, camMatrix, distMatrix)
             #print("frame to display time: "  + str(current_time - time.time()))
             try:
                 if frame_to_display is not None:
 
                     #current_time = time.time()
 
-                    if corner_ret:
-                        current_x_pos, current_y_pos = get_circle_position(frame_to_display)
 
                     # put frame rate on the image
                     fps_text = f"FPS: {fps:.2f}"
                     cv.putText(frame_to_display, fps_text, (20, 30), cv.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
 
                     cv.imshow("with ids", frame_to_display)  
-                    cv.imshow("unsharpened", cv.cvtColor(undistorted, cv.COLOR_BGR2GRAY))
+                    cv.imshow("unsharpened", undistorted)
                     #print("image display time: "  + str(current_time - time.time()))
             except:
                 pass
+        elif getattr(cam, 'finished', False):
+            # replayed recording has run out of frames
+            break
         else:
             print("camera not active")
 
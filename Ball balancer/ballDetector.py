@@ -0,0 +1,249 @@
+# Finds the ball in the warped top-down image
+# The board is full of things that look a bit like a ball (white squares with marker holes, dark squares with their
+# corners blurred off), so a blob only counts as the ball if it is round (its edge is the same distance from its
+# centre all the way round), solid (no holes in the middle) and stands out from a ring of board around it.
+# The image is thresholded at several levels since a ball the same colour as the squares it sits on only separates
+# from them at some threshold, not necessarily the Otsu one.
+# Acquisition mode searches the whole frame, once the ball is found tracking mode only looks at a small region around
+# where the ball should be, which is much cheaper.
+# A tracker remembers the last position and velocity, so it has to be given frames in order. Give each thread
+# processing frames its own tracker
+
+import threading
+import numpy as np
+import cv2 as cv
+
+# Expected ball size in the warped image (pixels)
+MIN_RADIUS = 8
+MAX_RADIUS = 40
+
+ROI_SCALE = 3 # half width of the tracking region in ball radii
+MAX_MISSES = 5 # misses in a row before going back to searching the whole frame
+MIN_CONFIDENCE = 0.5 # detections below this count as misses, board features score well under it
+ACQUISITION_DOWNSCALE = 2 # the full frame search runs on an image this many times smaller, then the best are refined
+ACQUISITION_CANDIDATES = 5 # most candidates from the small image refined at full resolution
+
+THRESHOLD_STEP = 16 # gray levels between the thresholds the blob search tries
+FILL_RATIO_CIRCLE = np.pi / 4 # area of a circle divided by the area of its bounding box
+ROUNDNESS_TOLERANCE = 0.08 # spread of the edge distance from the centre (fraction of the radius) that scores 0
+PIXEL_NOISE = 0.5 # pixels of that spread a perfect circle has anyway from being drawn in pixels
+SOLID_RADIUS = 0.8 # the blob has to fill the circle of this fraction of its radius (no holes)
+CONTRAST_RING = (1.3, 1.8) # inner and outer radius of the ring the blob is compared to, in blob radii
+FULL_CONTRAST = 40 # gray levels between the blob and the ring around it that count as full contrast
+
+
+class BallTracker():
+    """
+    Ball detector with a full-frame acquisition mode and a region of interest tracking mode.
+    detect() returns sub-pixel (x, y) and a confidence between 0 and 1
+    """
+    def __init__(self, minRadius=MIN_RADIUS, maxRadius=MAX_RADIUS, ballIsBright=True, roiScale=ROI_SCALE,
+                 maxMisses=MAX_MISSES, minConfidence=MIN_CONFIDENCE):
+        """
+        ballIsBright - True if the ball is lighter than the board around it (white ball), False for a dark ball
+        maxMisses - number of missed frames in a row before going back to acquisition mode
+        minConfidence - detections below this confidence count as misses
+        """
+        self.minRadius = minRadius
+        self.maxRadius = maxRadius
+        self.ballIsBright = ballIsBright
+        self.roiScale = roiScale
+        self.maxMisses = maxMisses
+        self.minConfidence = minConfidence
+
+        self.tracking = False
+        self.position = None # last detected (x, y)
+        self.velocity = (0.0, 0.0) # pixels per frame
+        self.radius = None
+        self.level = None # threshold level the ball was last found at
+        self.misses = 0
+        self.acquisitions = 0
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.tracking = False
+            self.position = None
+            self.velocity = (0.0, 0.0)
+            self.misses = 0
+
+    def detect(self, image):
+        """
+        returns (x, y, confidence) of the ball in a grayscale image, (None, None, 0.0) if it wasn't found
+        """
+        with self._lock:
+            result = None
+            if self.tracking:
+                result = self._track(image)
+            else:
+                result = self._acquire(image)
+                self.acquisitions += 1
+
+            if result is None or result[3] < self.minConfidence:
+                self.misses += 1
+                if self.misses >= self.maxMisses:
+                    self.tracking = False
+                    self.position = None
+                    self.velocity = (0.0, 0.0)
+                return None, None, 0.0
+
+            x, y, radius, confidence, level = result
+            if self.position is not None:
+                self.velocity = (x - self.position[0], y - self.position[1])
+            self.position = (x, y)
+            self.radius = radius
+            self.level = level
+            self.misses = 0
+            self.tracking = True
+            return x, y, confidence
+
+    def _predictedPosition(self):
+        # constant velocity guess, keeps going during misses
+        steps = self.misses + 1
+        return (self.position[0] + self.velocity[0] * steps, self.position[1] + self.velocity[1] * steps)
+
+    def _track(self, image):
+        radius = self.radius if self.radius is not None else self.maxRadius
+        halfSize = int(radius * self.roiScale * (1 + self.misses * 0.5)) # look further each time it is missed
+        px, py = self._predictedPosition()
+        x0 = max(int(px) - halfSize, 0)
+        y0 = max(int(py) - halfSize, 0)
+        x1 = min(int(px) + halfSize, image.shape[1])
+        y1 = min(int(py) + halfSize, image.shape[0])
+        if x1 - x0 < 2 * self.minRadius or y1 - y0 < 2 * self.minRadius:
+            return None
+
+        # the ball shows up at about the same threshold frame to frame, only the full set of levels if it doesn't
+        roi = image[y0:y1, x0:x1]
+        result = self._findBlob(roi, radius, self._nearbyLevels(self.level))
+        if result is None or result[3] < self.minConfidence:
+            result = self._findBlob(roi, radius)
+        if result is None:
+            return None
+        x, y, r, confidence, level = result
+        return x + x0, y + y0, r, confidence, level
+
+    def _acquire(self, image):
+        # search a smaller copy of the whole frame, then redo the most likely blobs at full resolution
+        scale = ACQUISITION_DOWNSCALE
+        small = cv.resize(image, (image.shape[1] // scale, image.shape[0] // scale), interpolation=cv.INTER_AREA)
+        candidates = self._blobs(small, max(self.minRadius / scale, 3), self.maxRadius / scale,
+                                 levels=range(THRESHOLD_STEP, 256, 2 * THRESHOLD_STEP))
+        candidates.sort(key=lambda blob: blob[3], reverse=True)
+
+        best = None
+        refined = []
+        for x, y, r, confidence, level in candidates:
+            if confidence < self.minConfidence / 2 or len(refined) >= ACQUISITION_CANDIDATES:
+                break
+            if any((x - doneX)**2 + (y - doneY)**2 < r**2 for doneX, doneY in refined):
+                continue # the same blob found at another threshold level
+            refined.append((x, y))
+            halfSize = int((r * CONTRAST_RING[1] + 2) * scale)
+            x0 = max(int(x * scale) - halfSize, 0)
+            y0 = max(int(y * scale) - halfSize, 0)
+            blob = self._findBlob(image[y0:int(y * scale) + halfSize, x0:int(x * scale) + halfSize],
+                                  levels=self._nearbyLevels(level))
+            if blob is not None and (best is None or blob[3] > best[3]):
+                best = (blob[0] + x0, blob[1] + y0, blob[2], blob[3], blob[4])
+        return best
+
+    def _nearbyLevels(self, level):
+        """the threshold level and the ones either side of it"""
+        return [nearby for nearby in (level - THRESHOLD_STEP, level, level + THRESHOLD_STEP) if 0 < nearby < 256]
+
+    def _findBlob(self, roi, expectedRadius=None, levels=None):
+        """
+        returns the (x, y, radius, confidence, threshold level) of the blob in the region most likely to be the ball,
+        relative to the region, the centre is the blob centroid (sub-pixel). None if there is no candidate at all
+        """
+        blobs = self._blobs(roi, self.minRadius, self.maxRadius, expectedRadius, levels)
+        return max(blobs, key=lambda blob: blob[3]) if blobs else None
+
+    def _blobs(self, roi, minRadius, maxRadius, expectedRadius=None, levels=None):
+        """
+        thresholds the region at each level (default every THRESHOLD_STEP) and scores every round-ish blob between
+        minRadius and maxRadius (see _scoreBlob), as (x, y, radius, confidence, level).
+        A blob that is exactly the same at several levels is only scored once
+        """
+        if levels is None:
+            levels = range(THRESHOLD_STEP, 256, THRESHOLD_STEP)
+        thresholdType = cv.THRESH_BINARY if self.ballIsBright else cv.THRESH_BINARY_INV
+        minArea = np.pi * minRadius**2 * 0.5
+        maxArea = np.pi * maxRadius**2 * 1.5
+        blobs = []
+        scored = set()
+        for level in levels:
+            _, mask = cv.threshold(roi, level, 255, thresholdType)
+            count, labels, stats, centroids = cv.connectedComponentsWithStats(mask, connectivity=8)
+
+            # cheap checks on every component at once (label 0 is the background): the right size, and a square
+            # bounding box that it fills about pi/4 of. Board squares fill all of theirs
+            width = stats[1:, cv.CC_STAT_WIDTH].astype(float)
+            height = stats[1:, cv.CC_STAT_HEIGHT].astype(float)
+            area = stats[1:, cv.CC_STAT_AREA].astype(float)
+            aspect = np.minimum(width, height) / np.maximum(width, height)
+            fill = area / (width * height)
+            candidates = np.nonzero((area >= minArea) & (area <= maxArea) & (aspect > 0.75) &
+                                    (np.abs(fill - FILL_RATIO_CIRCLE) < 0.15))[0] + 1
+
+            for label in candidates:
+                key = tuple(stats[label])
+                if key in scored:
+                    continue
+                scored.add(key)
+                result = self._scoreBlob(roi, labels, label, stats[label], centroids[label], expectedRadius)
+                if result is not None:
+                    blobs.append(result + (level,))
+        return blobs
+
+    def _scoreBlob(self, roi, labels, label, stat, centroid, expectedRadius):
+        """
+        confidence that a component is the ball, the product of how solid and round it is, its contrast against the
+        ring of board around it and, when an expected radius is given (tracking), how close it is to that size.
+        returns (x, y, radius, confidence), None if it can't be the ball (stops as soon as the confidence would be
+        under half of minConfidence, the board gives lots of candidates)
+        """
+        floor = self.minConfidence / 2
+        x0, y0, width, height, area = (int(value) for value in stat[:5])
+        cx, cy = float(centroid[0]), float(centroid[1])
+        radius = float(np.sqrt(area / np.pi))
+        blob = labels[y0:y0 + height, x0:x0 + width] == label
+
+        # solid: no holes around the middle, the white around a marker is round-ish but has the marker in it
+        dx2 = (np.arange(x0, x0 + width) - cx)**2
+        dy2 = (np.arange(y0, y0 + height)[:, None] - cy)**2
+        middle = dx2 + dy2 <= (SOLID_RADIUS * radius)**2
+        confidence = float(blob[middle].mean()) if middle.any() else 0.0
+        if confidence < floor:
+            return None
+
+        # round: every edge pixel about the same distance from the centre, a square's corners stick out
+        contours, _ = cv.findContours(blob.astype(np.uint8), cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)
+        edge = max(contours, key=len).reshape(-1, 2)
+        distances = np.hypot(edge[:, 0] + (x0 - cx), edge[:, 1] + (y0 - cy))
+        meanDistance = distances.mean()
+        spread = np.sqrt(np.dot(distances - meanDistance, distances - meanDistance) / len(distances))
+        confidence *= max(0.0, 1 - max(spread - PIXEL_NOISE, 0) / meanDistance / ROUNDNESS_TOLERANCE)
+        if confidence < floor:
+            return None
+
+        # contrast: the blob against a ring of whatever is around it, which is clipped at the edge of the region
+        inner, outer = CONTRAST_RING[0] * radius, CONTRAST_RING[1] * radius
+        rx0, ry0 = max(int(cx - outer), 0), max(int(cy - outer), 0)
+        rx1, ry1 = min(int(cx + outer) + 1, roi.shape[1]), min(int(cy + outer) + 1, roi.shape[0])
+        distanceSquared = (np.arange(rx0, rx1) - cx)**2 + (np.arange(ry0, ry1)[:, None] - cy)**2
+        ring = (distanceSquared >= inner**2) & (distanceSquared <= outer**2)
+        if not ring.any():
+            return None
+        difference = float(roi[y0:y0 + height, x0:x0 + width][blob].mean()) - float(roi[ry0:ry1, rx0:rx1][ring].mean())
+        if not self.ballIsBright:
+            difference = -difference
+        confidence *= min(max(difference / FULL_CONTRAST, 0.0), 1.0)
+
+        if expectedRadius is not None:
+            expectedArea = np.pi * expectedRadius**2
+            confidence *= 0.5 + 0.5 * min(area, expectedArea) / max(area, expectedArea)
+        if confidence < floor:
+            return None
+        return cx, cy, radius, confidence
@@ -0,0 +1,258 @@
+# Camera capture settings for the vision loop
+# cv.VideoCapture(0) with default settings gives whatever the driver picks (1920x1080 on our camera, the size the
+# calibration images were taken at) with a few frames buffered, so the frame being processed can already be old.
+# CameraCapture asks the camera for a size, frame rate, pixel format (MJPG or YUYV) and a 1 frame buffer through the
+# V4L2 properties, then reads back what it actually got since drivers quietly pick the closest mode they have.
+# gray=True only reads the luma (Y) plane, which is all the vision code uses. The raw frames are taken with
+# CAP_PROP_CONVERT_RGB off: for YUYV the Y channel is pulled out of the packed frame, for MJPG the jpeg is decoded
+# straight to gray (skipping the colour planes). Drivers that ignore CONVERT_RGB give BGR, that gets converted to gray
+# so read() always gives gray when asked.
+# adaptive=True steps the size down through RESOLUTIONS when processing takes longer than a camera frame, and back
+# up once the bigger size would fit comfortably. The calibration is for CALIBRATION_SIZE, scaleCameraMatrix gives the
+# camera matrix for other sizes (FrameProcessor does that itself when given calibrationSize)
+
+import sys
+import threading
+import numpy as np
+import cv2 as cv
+from Charuco_imaging import WINDOW_SIZE
+
+CALIBRATION_SIZE = (1920, 1080) # (width, height) the CamCalibration images, and so 3camMatrix.npy, were taken at
+CAPTURE_SIZE = (WINDOW_SIZE[1], WINDOW_SIZE[0]) # (width, height) to ask the camera for
+CAPTURE_FPS = 30
+PIXEL_FORMAT = 'MJPG' # or 'YUYV', MJPG gets higher frame rates over USB 2 at bigger sizes
+BUFFER_SIZE = 1 # frames the driver holds, 1 so read() gives the newest frame instead of a queued one
+# sizes the adaptive mode steps through, biggest first. Much below 480x360 the markers get too small to read
+RESOLUTIONS = [(1280, 720), (800, 600), (640, 480), (480, 360)]
+
+ADAPT_FRAMES = 30 # processed frames averaged before deciding to change size
+SLOW_FRACTION = 0.9 # step down when processing takes more than this fraction of a camera frame
+UPSCALE_HEADROOM = 0.6 # step up when the bigger size would take less than this fraction of a camera frame
+PROCESSING_SMOOTHING = 0.1 # weight of each new processing time in the running average
+
+
+def fourcc(pixelFormat):
+    return cv.VideoWriter_fourcc(*pixelFormat)
+
+
+def fourccName(code):
+    code = int(code)
+    return ''.join(chr((code >> (8 * i)) & 0xFF) for i in range(4))
+
+
+def scaleCameraMatrix(camMatrix, fromSize, toSize):
+    """
+    camera matrix calibrated at fromSize (width, height) for images of toSize.
+    Same aspect ratio is a plain scale. For a different aspect ratio the camera mode is assumed to crop the middle of
+    the sensor to that aspect ratio and scale it, which is what UVC cameras normally do (640x480 off a 16:9 sensor).
+    Recalibrating at the capture size is more accurate if the camera does something else
+    """
+    fromWidth, fromHeight = fromSize
+    toWidth, toHeight = toSize
+    if (fromWidth, fromHeight) == (toWidth, toHeight):
+        return camMatrix
+    cropWidth = min(fromWidth, fromHeight * toWidth / toHeight)
+    cropHeight = min(fromHeight, fromWidth * toHeight / toWidth)
+    scaleX = toWidth / cropWidth
+    scaleY = toHeight / cropHeight
+
+    scaled = np.array(camMatrix, dtype=np.float64)
+    scaled[0, 0] *= scaleX
+    scaled[0, 1] *= scaleX
+    scaled[0, 2] = (scaled[0, 2] - (fromWidth - cropWidth) / 2) * scaleX
+    scaled[1, 1] *= scaleY
+    scaled[1, 2] = (scaled[1, 2] - (fromHeight - cropHeight) / 2) * scaleY
+    return scaled
+
+
+class CameraCapture():
+    """
+    cv.VideoCapture with negotiated settings, an optional gray only read and optional adaptive resolution.
+    Has the same read()/isOpened()/get()/release() as cv.VideoCapture so it drops in where that was used.
+    read() has to stay on one thread (size changes happen there), reportProcessingTime() can be called from any,
+    the adaptive state is shared between them under a lock
+    """
+    def __init__(self, cameraIndex=0, size=CAPTURE_SIZE, fps=CAPTURE_FPS, pixelFormat=PIXEL_FORMAT,
+                 bufferSize=BUFFER_SIZE, gray=False, adaptive=False, resolutions=RESOLUTIONS, capture=None):
+        """
+        size - (width, height) to ask for, the camera may give something else (see self.size)
+        pixelFormat - 'MJPG' or 'YUYV'
+        gray - read() returns gray (luma only) frames
+        adaptive - change size with the processing time given to reportProcessingTime()
+        resolutions - sizes adaptive mode can use, biggest first. Sizes bigger than size are not used
+        capture - an already opened cv.VideoCapture to configure instead of opening cameraIndex
+        """
+        if capture is None:
+            # V4L2 directly on linux (the pi), the properties below are V4L2 ones. Default backend elsewhere
+            capture = cv.VideoCapture(cameraIndex, cv.CAP_V4L2 if sys.platform.startswith('linux') else cv.CAP_ANY)
+        self.capture = capture
+        self.requestedSize = tuple(size)
+        self.fps = fps
+        self.pixelFormat = pixelFormat
+        self.bufferSize = bufferSize
+        self.gray = gray
+        self.adaptive = adaptive
+        self.resolutions = [tuple(size)] + [r for r in resolutions if r[0] * r[1] < size[0] * size[1]]
+
+        self.size = None # (width, height) the camera is actually giving
+        self.negotiated = {}
+        self.rawLuma = False # True when the driver gives raw frames and read() pulls out the luma itself
+        self.sizeChanges = 0
+        self.processingTime = None # running average (s) of reportProcessingTime
+        self._processedFrames = 0
+        self._resolutionIndex = 0
+        self._refused = set() # sizes the camera wouldn't switch to
+        self._pendingIndex = None
+        self._lock = threading.Lock() # guards processingTime, _processedFrames, _pendingIndex and _resolutionIndex
+
+        if self.capture.isOpened():
+            self._configure(self.resolutions[0])
+
+    def _configure(self, size):
+        """sends the settings to the camera and reads back what it picked"""
+        self.capture.set(cv.CAP_PROP_FOURCC, fourcc(self.pixelFormat))
+        self.capture.set(cv.CAP_PROP_FRAME_WIDTH, size[0])
+        self.capture.set(cv.CAP_PROP_FRAME_HEIGHT, size[1])
+        self.capture.set(cv.CAP_PROP_FPS, self.fps)
+        self.capture.set(cv.CAP_PROP_BUFFERSIZE, self.bufferSize)
+        self.rawLuma = False
+        if self.gray:
+            # only keep the raw frames if the driver actually agreed to give them
+            self.rawLuma = bool(self.capture.set(cv.CAP_PROP_CONVERT_RGB, 0)) and \
+                           self.capture.get(cv.CAP_PROP_CONVERT_RGB) == 0
+
+        self.size = (int(self.capture.get(cv.CAP_PROP_FRAME_WIDTH)), int(self.capture.get(cv.CAP_PROP_FRAME_HEIGHT)))
+        self.negotiated = {"size": self.size, "fps": self.capture.get(cv.CAP_PROP_FPS),
+                           "pixel_format": fourccName(self.capture.get(cv.CAP_PROP_FOURCC)),
+                           "buffer_size": int(self.capture.get(cv.CAP_PROP_BUFFERSIZE)), "raw_luma": self.rawLuma}
+        return self.size
+
+    def read(self):
+        """same as cv.VideoCapture.read, gray frames if gray is set"""
+        if self._pendingIndex is not None:
+            self._changeResolution(self._pendingIndex)
+        ret, frame = self.capture.read()
+        if not ret or frame is None:
+            return False, None
+        if self.gray:
+            frame = self._luma(frame)
+            if frame is None:
+                return False, None
+        return True, frame
+
+    def _luma(self, frame):
+        """
+        gray image from whatever the driver gave. Always a new image, VisionPipeline queues frames so a reused buffer
+        would be overwritten while a worker still has it
+        """
+        if frame.ndim == 3 and frame.shape[2] == 3:
+            # driver converted to BGR anyway
+            return cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+        if frame.ndim == 3 and frame.shape[2] == 2:
+            return cv.cvtColor(frame, cv.COLOR_YUV2GRAY_YUY2)
+
+        width, height = self.size
+        raw = frame.reshape(-1)
+        if raw.size == width * height * 2 and self.negotiated.get("pixel_format") == 'YUYV':
+            # one row of packed YUYV bytes, Y is every other byte
+            packed = raw.reshape(height, width, 2)
+            return cv.cvtColor(packed, cv.COLOR_YUV2GRAY_YUY2)
+        if frame.ndim == 2 and frame.shape == (height, width):
+            return frame
+        # compressed (MJPG) frame, the jpeg decoder can skip the colour planes
+        return cv.imdecode(raw, cv.IMREAD_GRAYSCALE)
+
+    def reportProcessingTime(self, seconds):
+        """
+        tells adaptive mode how long a frame took to process. With several workers processing in parallel give the
+        time per frame of throughput (processing time / workers)
+        """
+        with self._lock:
+            # several workers report at once, without the lock updates to the average get lost and two workers
+            # can both decide on a size change
+            average = self.processingTime
+            self.processingTime = seconds if average is None else average + PROCESSING_SMOOTHING * (seconds - average)
+            self._processedFrames += 1
+            if not self.adaptive or self._processedFrames < ADAPT_FRAMES or self._pendingIndex is not None:
+                return
+
+            framePeriod = 1 / (self.negotiated.get("fps") or self.fps)
+            smaller = self._nextIndex(1)
+            bigger = self._nextIndex(-1)
+            if self.processingTime > SLOW_FRACTION * framePeriod and smaller is not None:
+                self._pendingIndex = smaller
+            elif bigger is not None:
+                # processing time goes roughly with the number of pixels
+                width, height = self.resolutions[self._resolutionIndex]
+                biggerWidth, biggerHeight = self.resolutions[bigger]
+                predicted = self.processingTime * (biggerWidth * biggerHeight) / (width * height)
+                if predicted < UPSCALE_HEADROOM * framePeriod:
+                    self._pendingIndex = bigger
+
+    def _nextIndex(self, step):
+        """index of the next usable size, smaller for step 1 and bigger for step -1. None if there isn't one"""
+        index = self._resolutionIndex + step
+        while 0 <= index < len(self.resolutions):
+            if self.resolutions[index] not in self._refused:
+                return index
+            index += step
+        return None
+
+    def _changeResolution(self, index):
+        # the camera is reconfigured outside the lock so reporting workers don't wait on the driver. Nothing else
+        # changes the size while _pendingIndex is set, reportProcessingTime doesn't decide again until it is cleared
+        size = self.resolutions[index]
+        if self._configure(size) != size:
+            # camera doesn't have this mode, go back to the one it was using
+            self._configure(self.resolutions[self._resolutionIndex])
+            with self._lock:
+                self._refused.add(size)
+                self._processedFrames = 0
+                self._pendingIndex = None
+            return
+        with self._lock:
+            self._resolutionIndex = index
+            self.sizeChanges += 1
+            self._processedFrames = 0
+            self.processingTime = None
+            self._pendingIndex = None
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def get(self, propId):
+        return self.capture.get(propId)
+
+    def set(self, propId, value):
+        return self.capture.set(propId, value)
+
+    def release(self):
+        self.capture.release()
+
+    def stats(self):
+        """negotiated settings, size changes and the average processing time (ms)"""
+        stats = dict(self.negotiated)
+        stats["size_changes"] = self.sizeChanges
+        if self.processingTime is not None:
+            stats["processing_ms"] = self.processingTime * 1000
+        return stats
+
+
+if __name__ == '__main__':
+    # shows what the camera agreed to for each pixel format, and the read rate
+    from time import perf_counter
+
+    for pixelFormat in ('MJPG', 'YUYV'):
+        capture = CameraCapture(pixelFormat=pixelFormat, gray=True)
+        if not capture.isOpened():
+            print("camera not found")
+            break
+        for i in range(5):
+            capture.read() # let the camera settle
+        startTime = perf_counter()
+        frames = 0
+        for i in range(60):
+            ret, frame = capture.read()
+            frames += ret
+        print(pixelFormat, capture.stats(), frames / (perf_counter() - startTime), "fps", None if frame is None else frame.shape)
+        capture.release()
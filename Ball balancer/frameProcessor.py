@@ -0,0 +1,211 @@
+# Per frame image processing without allocating new images every frame
+# Charuco_imaging.processFrame makes new images at every stage (gray, undistorted, blurred, sharpened, warped).
+# On the pi allocating and freeing a few hundred KB per stage, per frame, shows up as frame time spikes (malloc and
+# page faults). FrameProcessor owns one buffer per stage and hands them to OpenCV through dst=, so once the first
+# frame has set them up a frame doesn't allocate any images at all.
+# OpenCV quietly allocates a new image if a dst has the wrong size or type, so every stage checks it got its own buffer
+# back and counts an allocation if it didn't. stats() has the counts so this can be checked.
+# Board detection still allocates inside OpenCV (with a homography cache it only runs when the cache asks for it,
+# without one it runs every frame), the warp after it goes into a buffer either way.
+# A FrameProcessor is not thread safe, give each processing thread its own
+
+import numpy as np
+import cv2 as cv
+import Charuco_imaging as charuco
+
+
+class FrameProcessor():
+    """
+    Does what Charuco_imaging.processFrame does (undistort -> sharpen -> board -> ball) into preallocated buffers.
+    The image returned by process() is one of the buffers, it is overwritten by the next frame so copy it to keep it
+    """
+    def __init__(self, camMatrix, distMatrix, dictionary, board, homographyCache=None, fusedRemap=None, tracker=None,
+                 kernelSize=(7,7), sigma=0.25, intensity=4, calibrationSize=None):
+        """
+        homographyCache, fusedRemap - same as for processFrame
+        tracker - BallTracker to use, defaults to the shared one get_circle_position uses (one thread only)
+        kernelSize, sigma, intensity - sharpenImage settings
+        calibrationSize - (width, height) camMatrix was calibrated at. If given the camera matrix is rescaled to the
+                          frame size whenever it changes (cameraCapture's adaptive mode), and passed on to the
+                          homography cache and fused remap. None uses camMatrix as is for every size
+        """
+        self.calibratedCamMatrix = camMatrix
+        self.calibrationSize = calibrationSize
+        self.frameSize = None
+        self.camMatrix = camMatrix
+        self.distMatrix = distMatrix
+        self.dictionary = dictionary
+        self.board = board
+        self.homographyCache = homographyCache
+        self.fusedRemap = fusedRemap
+        self.tracker = tracker
+        self.kernelSize = kernelSize
+        self.sigma = sigma
+        self.intensity = intensity
+
+        self.buffers = {} # stage name -> image
+        self.frames = 0
+        self.allocations = 0 # images allocated since the start (setting up the buffers counts)
+        self.lastFrameAllocations = 0
+        self._frameStartAllocations = 0
+        self._undistortMaps = None # (size, map1, map2)
+
+    def _buffer(self, name, shape, dtype=np.uint8):
+        """returns the buffer for a stage, (re)allocating it if it doesn't exist yet or the frame size changed"""
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype)
+            self.buffers[name] = buffer
+            self.allocations += 1
+        return buffer
+
+    def _keep(self, name, buffer, result):
+        """checks OpenCV wrote into the buffer, if it made a new image instead count it and use that from now on"""
+        if result is not buffer:
+            self.buffers[name] = result
+            self.allocations += 1
+        return result
+
+    def gray(self, frame):
+        """frame in gray, a gray frame is used as it is"""
+        if frame.ndim == 2:
+            return frame
+        buffer = self._buffer('gray', frame.shape[:2])
+        return self._keep('gray', buffer, cv.cvtColor(frame, cv.COLOR_BGR2GRAY, dst=buffer))
+
+    def undistort(self, gray):
+        """
+        same as cv.undistort but with the undistort maps worked out once instead of every call.
+        Done on the gray image, converting to gray before or after undistorting gives the same thing
+        """
+        size = (gray.shape[1], gray.shape[0])
+        if self._undistortMaps is None or self._undistortMaps[0] != size:
+            map1, map2 = cv.initUndistortRectifyMap(self.camMatrix, self.distMatrix, None, self.camMatrix, size, cv.CV_16SC2)
+            self._undistortMaps = (size, map1, map2)
+            self.allocations += 2
+        buffer = self._buffer('undistorted', gray.shape)
+        return self._keep('undistorted', buffer, cv.remap(gray, self._undistortMaps[1], self._undistortMaps[2],
+                                                          cv.INTER_LINEAR, dst=buffer))
+
+    def sharpen(self, gray, stage='full'):
+        """same as sharpenImage on a gray image. stage keeps the full frame and warped image buffers separate"""
+        blurred = self._buffer(stage + ' blurred', gray.shape)
+        blurred = self._keep(stage + ' blurred', blurred, cv.GaussianBlur(gray, self.kernelSize, self.sigma, dst=blurred))
+        sharpened = self._buffer(stage + ' sharpened', gray.shape)
+        return self._keep(stage + ' sharpened', sharpened,
+                          cv.addWeighted(gray, 1.0 + self.intensity, blurred, -self.intensity, 0, dst=sharpened))
+
+    def undistortAndSharpen(self, frame):
+        """gray, undistorted and sharpened full frame, what processFrame looks for the board in"""
+        return self.sharpen(self.undistort(self.gray(frame)))
+
+    def warp(self, image, transform):
+        """same as cv.warpPerspective to the TRANSFORMED_SIZE top-down view"""
+        width, height = charuco.TRANSFORMED_SIZE
+        buffer = self._buffer('warped', (height, width))
+        return self._keep('warped', buffer, cv.warpPerspective(image, transform, charuco.TRANSFORMED_SIZE, dst=buffer))
+
+    def process(self, frame, commandedTilt=(None, None)):
+        """
+        same as Charuco_imaging.processFrame, returns (found board, ball x, ball y, image to display)
+        """
+        self._frameStartAllocations = self.allocations
+        self._matchFrameSize(frame)
+        try:
+            return self._process(frame, commandedTilt)
+        finally:
+            self.frames += 1
+            self.lastFrameAllocations = self.allocations - self._frameStartAllocations
+
+    def _matchFrameSize(self, frame):
+        """rescales the camera matrix for a new frame size, only when calibrationSize was given"""
+        size = (frame.shape[1], frame.shape[0])
+        if self.calibrationSize is None or size == self.frameSize:
+            return
+        from cameraCapture import scaleCameraMatrix
+        self.frameSize = size
+        self.camMatrix = scaleCameraMatrix(self.calibratedCamMatrix, self.calibrationSize, size)
+        self._undistortMaps = None
+        # the cache and remap can be shared between processors, only the first one to see the new size updates them
+        for shared in (self.homographyCache, self.fusedRemap):
+            if shared is not None and not np.array_equal(shared.camMatrix, self.camMatrix):
+                shared.setCameraMatrix(self.camMatrix)
+
+    def _process(self, frame, commandedTilt):
+        if self.fusedRemap is not None and self.homographyCache is not None:
+            transform, version = self.homographyCache.update(lambda: self.undistortAndSharpen(frame), *commandedTilt)
+            if transform is None:
+                return False, None, None, frame
+            self.fusedRemap.update(transform, version)
+            width, height = charuco.TRANSFORMED_SIZE
+            buffer = self._buffer('fused', (height, width))
+            warped = self.fusedRemap.apply(self.gray(frame), dst=buffer)
+            if warped is None:
+                # another processor changed the camera matrix between update and apply, so there are no maps yet.
+                # Do this frame the long way, undistort then warp
+                image = self.warp(self.undistortAndSharpen(frame), transform)
+            else:
+                image = self.sharpen(self._keep('fused', buffer, warped), 'warped')
+            x_pos, y_pos = charuco.get_circle_position(image, self.tracker)
+            return True, x_pos, y_pos, image
+
+        sharpened = self.undistortAndSharpen(frame)
+        if self.homographyCache is not None:
+            transform, _ = self.homographyCache.update(sharpened, *commandedTilt)
+            corner_ret = transform is not None
+            image = self.warp(sharpened, transform) if corner_ret else sharpened
+        else:
+            # same as drawCorners, with the warp into a buffer
+            corner_ret, rvec, tvec = charuco.estimateBoardPose(sharpened, self.dictionary, self.board,
+                                                               self.camMatrix, self.distMatrix)
+            image = sharpened
+            if corner_ret:
+                corners = charuco.projectBoardCorners(rvec, tvec, self.camMatrix, self.distMatrix)
+                image = self.warp(sharpened, charuco.calculateHomography(corners))
+
+        x_pos, y_pos = None, None
+        if corner_ret:
+            x_pos, y_pos = charuco.get_circle_position(image, self.tracker)
+        return corner_ret, x_pos, y_pos, image
+
+    def stats(self):
+        """frames processed, images allocated in total and in the last frame, and how much memory the buffers use"""
+        return {"frames": self.frames, "allocations": self.allocations, "last_frame_allocations": self.lastFrameAllocations,
+                "buffer_bytes": sum(buffer.nbytes for buffer in self.buffers.values())}
+
+
+if __name__ == '__main__':
+    import os
+    import tracemalloc
+    from time import perf_counter
+    from homographyCache import HomographyCache
+    from fusedRemap import FusedRemap
+
+    # checks the steady state really doesn't allocate images, on the sample frame
+    frame = cv.imread(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image with corners.png'))
+    camMatrix, distMatrix = charuco.loadCalibration()
+    dictionary = cv.aruco.getPredefinedDictionary(charuco.ARUCO_DICT)
+    board = cv.aruco.CharucoBoard(charuco.SIZE, charuco.SQUARE_LENGTH, charuco.MARKER_LENGTH, dictionary)
+
+    for fused in (False, True):
+        cache = HomographyCache(dictionary, board, camMatrix, distMatrix)
+        processor = FrameProcessor(camMatrix, distMatrix, dictionary, board, cache,
+                                   FusedRemap(camMatrix, distMatrix) if fused else None)
+        processor.process(frame) # first frame sets up the buffers and finds the board
+        processor.process(frame)
+
+        tracemalloc.start()
+        largest = 0 # most memory any frame allocated, not counting frames where the board was re-detected
+        frameTimes = []
+        for i in range(100):
+            detections = cache.detections
+            tracemalloc.reset_peak()
+            startTime = perf_counter()
+            processor.process(frame)
+            frameTimes.append(perf_counter() - startTime)
+            current, peak = tracemalloc.get_traced_memory()
+            if cache.detections == detections:
+                largest = max(largest, peak - current)
+        tracemalloc.stop()
+        print("fused" if fused else "undistort + warp", processor.stats(), "most memory allocated in a frame",
+              largest, "bytes,", np.mean(frameTimes) * 1000, "ms per frame")
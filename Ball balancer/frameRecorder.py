@@ -0,0 +1,281 @@
+# Records raw camera frames to disk and plays them back, so the vision code can be tested and timed without a camera
+# A recording is a folder of chunk files (frames_00000.npy, ...) holding N frames each plus their capture times.
+# Raw chunks are plain .npy files that get memory mapped on replay, compressed chunks are lossless .npz (smaller, slower)
+# RecordingCapture and ReplayCapture both have a cv.VideoCapture style read(), so they drop into Charuco_imaging.main()
+# and VisionPipeline in place of the camera
+
+import os
+import json
+import numpy as np
+import cv2 as cv
+from time import perf_counter, sleep
+from numpy.lib.format import open_memmap
+
+CHUNK_SIZE = 100 # frames per chunk file, 100 640x480 colour frames is about 90MB
+INFO_FILE = 'recording.json'
+TIMESTAMPS_FILE = 'timestamps.npy'
+
+
+def chunkPath(directory, index, compressed):
+    return os.path.join(directory, 'frames_%05d.%s' % (index, 'npz' if compressed else 'npy'))
+
+
+class FrameRecorder():
+    """
+    Writes frames and their timestamps to a recording folder, one chunk at a time
+    """
+    def __init__(self, directory, chunkSize=CHUNK_SIZE, compressed=False):
+        """
+        directory - folder for the recording, created if needed. An old recording in it gets overwritten
+        compressed - save chunks losslessly compressed (np.savez_compressed) instead of raw
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.chunkSize = chunkSize
+        self.compressed = compressed
+        self.count = 0
+        self.shape = None
+        self.dtype = None
+        self._chunk = None
+        self._timestamps = []
+
+    def write(self, frame, timestamp=None):
+        """
+        adds a frame, timestamp defaults to now (perf_counter). Every frame has to be the same size and type
+        """
+        if timestamp is None:
+            timestamp = perf_counter()
+        if self.shape is None:
+            self.shape = frame.shape
+            self.dtype = frame.dtype
+        elif frame.shape != self.shape:
+            raise ValueError(f"frame is {frame.shape}, the recording is {self.shape}")
+
+        index = self.count % self.chunkSize
+        if index == 0:
+            self._newChunk()
+        self._chunk[index] = frame
+        self._timestamps.append(timestamp)
+        self.count += 1
+        if index == self.chunkSize - 1:
+            self._finishChunk(self.chunkSize)
+
+    def _newChunk(self):
+        shape = (self.chunkSize,) + self.shape
+        if self.compressed:
+            self._chunk = np.empty(shape, self.dtype)
+        else:
+            # written straight into the file so a chunk never has to fit in memory twice
+            self._chunk = open_memmap(chunkPath(self.directory, self.count // self.chunkSize, False), mode='w+',
+                                      dtype=self.dtype, shape=shape)
+
+    def _finishChunk(self, length):
+        if self.compressed:
+            np.savez_compressed(chunkPath(self.directory, (self.count - 1) // self.chunkSize, True),
+                                frames=self._chunk[:length])
+        else:
+            self._chunk.flush()
+            if length < self.chunkSize:
+                # the file was made for a whole chunk, copy the recorded frames into one that is the right size
+                # so the spare frames don't sit on disk (and in the replay) as black frames
+                path = chunkPath(self.directory, (self.count - 1) // self.chunkSize, False)
+                tempPath = path + '.tmp.npy'
+                truncated = open_memmap(tempPath, mode='w+', dtype=self.dtype, shape=(length,) + self.shape)
+                truncated[:] = self._chunk[:length]
+                truncated.flush()
+                del truncated
+                self._chunk = None # the memory map has to be closed before the file is replaced
+                os.replace(tempPath, path)
+        self._chunk = None
+
+    def close(self):
+        """
+        saves the last partial chunk, the timestamps and the recording info
+        """
+        if self._chunk is not None:
+            self._finishChunk(self.count % self.chunkSize)
+        np.save(os.path.join(self.directory, TIMESTAMPS_FILE), np.array(self._timestamps, dtype=np.float64))
+        info = {"count": self.count, "chunk_size": self.chunkSize, "compressed": self.compressed,
+                "shape": list(self.shape) if self.shape is not None else None,
+                "dtype": str(self.dtype) if self.dtype is not None else None}
+        with open(os.path.join(self.directory, INFO_FILE), 'w') as file:
+            json.dump(info, file)
+
+
+class RecordingCapture():
+    """
+    Wraps a capture (normally the camera) and records every frame read through it
+    """
+    def __init__(self, capture, directory, chunkSize=CHUNK_SIZE, compressed=False):
+        self.capture = capture
+        self.recorder = FrameRecorder(directory, chunkSize, compressed)
+
+    def read(self):
+        ret, frame = self.capture.read()
+        if ret:
+            self.recorder.write(frame)
+        return ret, frame
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def release(self):
+        self.recorder.close()
+        self.capture.release()
+
+
+class ReplayCapture():
+    """
+    Plays a recording back through a cv.VideoCapture style read().
+    speed - 'original' waits so frames come out with the recorded spacing, 'max' returns them as fast as they are read,
+            a number plays at that many frames per second
+    After the last frame read() returns (False, None) and finished is True, unless loop is True
+    """
+    def __init__(self, directory, speed='original', loop=False):
+        with open(os.path.join(directory, INFO_FILE)) as file:
+            info = json.load(file)
+        self.directory = directory
+        self.count = info["count"]
+        self.chunkSize = info["chunk_size"]
+        self.compressed = info["compressed"]
+        self.timestamps = np.load(os.path.join(directory, TIMESTAMPS_FILE))
+        self.speed = speed
+        self.loop = loop
+
+        self.position = 0 # index of the next frame
+        self.finished = self.count == 0
+        self.timestamp = None # recorded capture time of the last frame returned
+        self._chunkIndex = None
+        self._chunk = None
+        self._startTime = None # perf_counter when the replay (or this pass of the loop) started
+        self._released = False
+
+    def _frame(self, position):
+        chunkIndex = position // self.chunkSize
+        if chunkIndex != self._chunkIndex:
+            path = chunkPath(self.directory, chunkIndex, self.compressed)
+            if self.compressed:
+                self._chunk = np.load(path)["frames"]
+            else:
+                self._chunk = np.load(path, mmap_mode='r')
+            self._chunkIndex = chunkIndex
+        return self._chunk[position % self.chunkSize]
+
+    def _waitForFrame(self, position):
+        if self.speed == 'max':
+            return
+        if self._startTime is None or position == 0:
+            self._startTime = perf_counter()
+        if self.speed == 'original':
+            due = self._startTime + self.timestamps[position] - self.timestamps[0]
+        else:
+            due = self._startTime + position / self.speed
+        remaining = due - perf_counter()
+        if remaining > 0:
+            sleep(remaining)
+
+    def read(self):
+        if self._released or self.finished:
+            return False, None
+        if self.position >= self.count:
+            if not self.loop:
+                self.finished = True
+                return False, None
+            self.position = 0
+
+        self._waitForFrame(self.position)
+        # copy out of the memory map, like a camera each read gives a new writable frame
+        frame = np.array(self._frame(self.position))
+        self.timestamp = float(self.timestamps[self.position])
+        self.position += 1
+        return True, frame
+
+    def isOpened(self):
+        return not self._released
+
+    def get(self, propId):
+        """the few cv.VideoCapture properties that make sense for a recording"""
+        if propId == cv.CAP_PROP_FRAME_COUNT:
+            return float(self.count)
+        if propId == cv.CAP_PROP_POS_FRAMES:
+            return float(self.position)
+        if propId == cv.CAP_PROP_FPS and self.count > 1:
+            return float((self.count - 1) / (self.timestamps[-1] - self.timestamps[0]))
+        return 0.0
+
+    def release(self):
+        self._released = True
+        self._chunk = None
+
+
+def recordCamera(directory, duration, cameraIndex=0, compressed=False):
+    """
+    records duration seconds from the camera, returns the number of frames recorded
+    """
+    capture = RecordingCapture(cv.VideoCapture(cameraIndex), directory, compressed=compressed)
+    startTime = perf_counter()
+    while perf_counter() - startTime < duration:
+        capture.read()
+    capture.release()
+    return capture.recorder.count
+
+
+def benchmarkReplay(directory, useHomographyCache=True, useFusedRemap=False):
+    """
+    runs every frame of a recording through a FrameProcessor (the per frame path VisionPipeline uses) as fast as
+    possible, one after another so the results are the same every run.
+    returns fps, mean and worst frame time (ms) and the ball positions
+    """
+    import Charuco_imaging as charuco
+    from homographyCache import HomographyCache
+    from fusedRemap import FusedRemap
+    from frameProcessor import FrameProcessor
+    from ballDetector import BallTracker
+
+    camMatrix, distMatrix = charuco.loadCalibration()
+    dictionary = cv.aruco.getPredefinedDictionary(charuco.ARUCO_DICT)
+    board = cv.aruco.CharucoBoard(charuco.SIZE, charuco.SQUARE_LENGTH, charuco.MARKER_LENGTH, dictionary)
+    homographyCache = HomographyCache(dictionary, board, camMatrix, distMatrix) if useHomographyCache else None
+    fusedRemap = FusedRemap(camMatrix, distMatrix) if useFusedRemap and useHomographyCache else None
+    processor = FrameProcessor(camMatrix, distMatrix, dictionary, board, homographyCache, fusedRemap,
+                               tracker=BallTracker())
+
+    replay = ReplayCapture(directory, speed='max')
+    frameTimes = []
+    positions = []
+    while True:
+        ret, frame = replay.read()
+        if not ret:
+            break
+        startTime = perf_counter()
+        found, x, y, image = processor.process(frame)
+        frameTimes.append(perf_counter() - startTime)
+        positions.append((x, y))
+    replay.release()
+
+    frameTimes = np.array(frameTimes) if frameTimes else np.zeros(1)
+    return {"frames": len(positions), "fps": float(len(positions) / frameTimes.sum()) if positions else 0.0,
+            "mean_ms": float(frameTimes.mean() * 1000), "max_ms": float(frameTimes.max() * 1000),
+            "positions": positions}
+
+
+if __name__ == '__main__':
+    import sys
+    usage = "usage: frameRecorder.py record <folder> <seconds> [compressed] | replay <folder> [original|max|fps] | benchmark <folder>"
+    if len(sys.argv) < 3:
+        print(usage)
+    elif sys.argv[1] == 'record':
+        frames = recordCamera(sys.argv[2], float(sys.argv[3]), compressed=len(sys.argv) > 4 and sys.argv[4] == 'compressed')
+        print("recorded", frames, "frames to", sys.argv[2])
+    elif sys.argv[1] == 'replay':
+        import Charuco_imaging as charuco
+        speed = sys.argv[3] if len(sys.argv) > 3 else 'original'
+        if speed not in ('original', 'max'):
+            speed = float(speed)
+        charuco.main(ReplayCapture(sys.argv[2], speed))
+    elif sys.argv[1] == 'benchmark':
+        result = benchmarkReplay(sys.argv[2])
+        found = sum(x is not None for x, y in result.pop("positions"))
+        print(result, "ball found in", found, "frames")
+    else:
+        print(usage)
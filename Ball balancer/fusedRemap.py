@@ -0,0 +1,92 @@
+# Combines undistortion and the perspective warp into one remap table
+# Instead of cv.undistort on the full frame followed by cv.warpPerspective, each frame is a single cv.remap
+# from raw camera pixels straight to the TRANSFORMED_SIZE top-down view
+
+import threading
+import numpy as np
+import cv2 as cv
+import Charuco_imaging as charuco
+
+
+def buildFusedMaps(camMatrix, distMatrix, homography, size=charuco.TRANSFORMED_SIZE):
+    """
+    builds fixed point (CV_16SC2) remap maps that take a raw (distorted) camera image to the warped top-down view.
+    homography is the undistorted image -> top-down view transform (as used by transformPerspective)
+
+    initUndistortRectifyMap takes every output pixel u back through inv(newCameraMatrix) to normalized coordinates,
+    distorts them and projects with camMatrix. Using newCameraMatrix = homography * camMatrix sends u through
+    inv(homography) first, which is exactly the inverse of the perspective warp
+    """
+    newCameraMatrix = np.asarray(homography, dtype=np.float64).dot(camMatrix)
+    map1, map2 = cv.initUndistortRectifyMap(camMatrix, distMatrix, np.eye(3), newCameraMatrix, size, cv.CV_16SC2)
+    return map1, map2
+
+
+class FusedRemap():
+    """
+    Holds the fused maps and rebuilds them only when the homography changes
+    """
+    def __init__(self, camMatrix, distMatrix, size=charuco.TRANSFORMED_SIZE):
+        self.camMatrix = camMatrix
+        self.distMatrix = distMatrix
+        self.size = size
+        self.rebuilds = 0
+        self._maps = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def update(self, homography, version):
+        """
+        rebuilds the maps if version is different from the one they were built for. Pass the (homography, version)
+        pair HomographyCache.update returns, reading cache.version separately can pair it with a different homography
+        """
+        with self._lock:
+            if version != self._version:
+                # swap both maps in at once so other threads never see a half updated pair
+                self._maps = buildFusedMaps(self.camMatrix, self.distMatrix, homography, self.size)
+                self._version = version
+                self.rebuilds += 1
+
+    def setCameraMatrix(self, camMatrix):
+        """uses a new camera matrix (the capture size changed), the maps are rebuilt on the next update"""
+        with self._lock:
+            self.camMatrix = camMatrix
+            self._maps = None
+            self._version = None
+
+    def apply(self, image, dst=None):
+        """
+        returns the top-down view of a raw camera image, None if no homography has been set yet
+        """
+        maps = self._maps
+        if maps is None:
+            return None
+        return cv.remap(image, maps[0], maps[1], cv.INTER_LINEAR, dst=dst)
+
+
+if __name__ == '__main__':
+    # closed loop the commanded tilt changes a little every frame, checks the maps are only rebuilt when the tilt
+    # has moved past the homography cache's deadband, not every frame
+    import os
+    from homographyCache import HomographyCache
+
+    frame = cv.imread(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image with corners.png'))
+    camMatrix, distMatrix = charuco.loadCalibration()
+    dictionary = cv.aruco.getPredefinedDictionary(charuco.ARUCO_DICT)
+    board = cv.aruco.CharucoBoard(charuco.SIZE, charuco.SQUARE_LENGTH, charuco.MARKER_LENGTH, dictionary)
+    cache = HomographyCache(dictionary, board, camMatrix, distMatrix)
+    fusedRemap = FusedRemap(camMatrix, distMatrix)
+    gray = charuco.sharpenImage(cv.undistort(frame, camMatrix, distMatrix))
+
+    frames = 300
+    times = np.arange(frames) / 30
+    pitches = 1.5 * np.sin(2 * np.pi * 0.2 * times) # slow sway, well inside the re-detection threshold
+    rolls = 1.0 * np.cos(2 * np.pi * 0.1 * times)
+    for pitch, roll in zip(pitches, rolls):
+        fusedRemap.update(*cache.update(gray, pitch, roll))
+
+    # every rebuild needs the tilt to have moved more than the deadband on one axis, plus one per detection
+    travel = np.abs(np.diff(pitches)).sum() + np.abs(np.diff(rolls)).sum()
+    bound = travel / cache.predictionDeadband + cache.detections
+    print(frames, "frames,", fusedRemap.rebuilds, "rebuilds (at most", int(bound), "allowed)", cache.stats())
+    assert fusedRemap.rebuilds <= bound and fusedRemap.rebuilds < frames / 2
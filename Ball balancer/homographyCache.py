@@ -0,0 +1,189 @@
+# Caches the board -> image homography so the charuco markers don't have to be detected every frame
+# The camera doesn't move relative to the base, so the board only moves in the image when the platform tilts.
+# Between detections the board pose is predicted from the tilt commanded to the PlatformController
+# The marker detection runs outside the lock so other VisionPipeline workers keep using the cached homography while
+# one of them re-detects, only one detection runs at a time
+
+import os
+import sys
+import threading
+import numpy as np
+import cv2 as cv
+import Charuco_imaging as charuco
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from calculateRotationMatrix import calculateRotationMatrix
+
+DEFAULT_REFRESH_INTERVAL = 30 # frames between forced re-detections
+DEFAULT_TILT_THRESHOLD = 2 # degrees of commanded tilt change (since the last detection) that forces a re-detection
+# degrees the commanded tilt has to move (since the last prediction) before the homography is predicted again.
+# In closed loop the tilt changes a little every frame, and every new homography makes FusedRemap rebuild its maps
+# (about 1.5 ms). 0.1 degrees moves the corners of the warped image by about 0.2 pixels
+DEFAULT_PREDICTION_DEADBAND = 0.1
+MAX_RETRY_INTERVAL = 16 # frames, after a failed detection the wait before retrying doubles up to this
+
+
+class HomographyCache():
+    """
+    Holds the most recent board pose and homography.
+    update() only runs the marker detection when the cache is too old or the commanded tilt moved too far,
+    otherwise it reuses the cached homography or predicts a new one from the commanded tilt
+    """
+    def __init__(self, dictionary, board, camMatrix, distMatrix, refreshInterval=DEFAULT_REFRESH_INTERVAL,
+                 tiltThreshold=DEFAULT_TILT_THRESHOLD, boardToPlatform=np.eye(3),
+                 predictionDeadband=DEFAULT_PREDICTION_DEADBAND):
+        """
+        refreshInterval - re-detect the board at least every this many frames
+        tiltThreshold - re-detect when commanded pitch or roll is this many degrees away from the last detection
+        predictionDeadband - only predict a new homography when pitch or roll moved more than this many degrees
+                             since the last prediction, smaller changes keep the homography (and its version)
+        boardToPlatform - rotation from board axes to platform axes, identity if the board is lined up with the platform
+        """
+        self.dictionary = dictionary
+        self.board = board
+        self.camMatrix = camMatrix
+        self.distMatrix = distMatrix
+        self.refreshInterval = refreshInterval
+        self.tiltThreshold = tiltThreshold
+        self.predictionDeadband = predictionDeadband
+        self.boardToPlatform = np.asarray(boardToPlatform, dtype=float)
+
+        # centre of the board in board coordinates, the platform is assumed to tilt about this point
+        self.boardCentre = charuco.boardCornerPoints3D().mean(axis=0)
+
+        self.homography = None
+        self.version = 0 # incremented every time the homography changes, so users of it know to rebuild things
+        self.detections = 0
+        self.predictions = 0
+        self.reuses = 0
+
+        self._framesSinceDetection = 0
+        self._referenceRotation = None # board rotation in camera frame at the last detection
+        self._referenceCentre = None # board centre in camera frame at the last detection
+        self._referencePlatformRotation = None # platform rotation commanded at the last detection
+        self._referenceTilt = None
+        self._lastTilt = None
+        self._failedDetections = 0 # failed detections in a row, each one doubles the wait before the next try
+        self._detecting = False # a worker is detecting outside the lock
+        self._lock = threading.Lock()
+
+    def update(self, image, commandedPitch=None, commandedRoll=None):
+        """
+        returns (homography, version) for this frame, read together under the lock so the version is always the one
+        of that homography (FusedRemap keys its maps on it). The homography is None if the board has never been found.
+        image is only searched for markers when a re-detection is needed, it can also be a function
+        returning the image so it is only prepared when a re-detection actually happens
+        """
+        tilt = None if commandedPitch is None or commandedRoll is None else (commandedPitch, commandedRoll)
+        with self._lock:
+            self._framesSinceDetection += 1
+            if self._detecting or not self._needsDetection(tilt):
+                return self._predictOrReuse(tilt)
+            # claim the detection, then let go of the lock for the slow part
+            self._detecting = True
+            self._framesSinceDetection = 0
+            camMatrix, distMatrix = self.camMatrix, self.distMatrix
+
+        try:
+            if callable(image):
+                image = image()
+            found, rvec, tvec = charuco.estimateBoardPose(image, self.dictionary, self.board, camMatrix, distMatrix)
+        except Exception:
+            with self._lock:
+                self._detecting = False
+            raise
+
+        with self._lock:
+            self._detecting = False
+            # a new camera matrix while detecting means the pose is for the old one, throw it away
+            if found and camMatrix is self.camMatrix:
+                self._setReference(rvec, tvec, tilt)
+                return self.homography, self.version
+            self._failedDetections += 1
+            # detection failed, keep going with what we have
+            return self._predictOrReuse(tilt)
+
+    def _predictOrReuse(self, tilt):
+        if tilt is not None and self._referenceRotation is not None and self._pastDeadband(tilt):
+            self._predict(tilt)
+        else:
+            self.reuses += 1
+        return self.homography, self.version
+
+    def setCameraMatrix(self, camMatrix):
+        """uses a new camera matrix (the capture size changed) and re-detects on the next update"""
+        with self._lock:
+            self.camMatrix = camMatrix
+            self.homography = None
+            self._referenceRotation = None
+            self._failedDetections = 0
+
+    def invalidate(self):
+        """forces a re-detection on the next update"""
+        with self._lock:
+            self.homography = None
+            self._referenceRotation = None
+            self._failedDetections = 0
+
+    def _pastDeadband(self, tilt):
+        """True if the tilt moved far enough from the one the homography was made for to predict a new one"""
+        if self._lastTilt is None:
+            return True
+        return (abs(tilt[0] - self._lastTilt[0]) > self.predictionDeadband or
+                abs(tilt[1] - self._lastTilt[1]) > self.predictionDeadband)
+
+    def _needsDetection(self, tilt):
+        if self._failedDetections and self._framesSinceDetection < min(2 ** self._failedDetections, MAX_RETRY_INTERVAL):
+            # the board wasn't found last time (hand over it, ball covering markers), don't retry every frame
+            return False
+        if self.homography is None or self._referenceRotation is None:
+            return True
+        if self._framesSinceDetection >= self.refreshInterval:
+            return True
+        if tilt is not None and self._referenceTilt is not None:
+            return (abs(tilt[0] - self._referenceTilt[0]) > self.tiltThreshold or
+                    abs(tilt[1] - self._referenceTilt[1]) > self.tiltThreshold)
+        return False
+
+    def _setReference(self, rvec, tvec, tilt):
+        """takes a detected board pose as the new reference for predictions"""
+        self._failedDetections = 0
+        rotation, _ = cv.Rodrigues(rvec)
+        self._referenceRotation = rotation
+        self._referenceCentre = rotation.dot(self.boardCentre) + tvec.reshape(3)
+        self._referenceTilt = tilt
+        self._referencePlatformRotation = None if tilt is None else calculateRotationMatrix(*tilt)
+        self._lastTilt = tilt
+        self._setHomography(rvec, tvec)
+        self.detections += 1
+
+    def _predict(self, tilt):
+        """
+        predicts the board pose for a new commanded tilt from the pose at the last detection:
+        R_camera_board(new) = R_camera_board(ref) * R_board_platform * R_platform(ref)^T * R_platform(new) * R_platform_board
+        """
+        self._lastTilt = tilt
+        if self._referencePlatformRotation is None:
+            # last detection had no tilt to compare against, take this tilt as the reference
+            self._referenceTilt = tilt
+            self._referencePlatformRotation = calculateRotationMatrix(*tilt)
+            self.reuses += 1
+            return
+
+        deltaRotation = self._referencePlatformRotation.T.dot(calculateRotationMatrix(*tilt))
+        deltaRotation = self.boardToPlatform.T.dot(deltaRotation).dot(self.boardToPlatform)
+        rotation = self._referenceRotation.dot(deltaRotation)
+
+        # keep the centre of the board where it was, tilting moves everything else around it
+        tvec = self._referenceCentre - rotation.dot(self.boardCentre)
+        rvec, _ = cv.Rodrigues(rotation)
+        self._setHomography(rvec, tvec)
+        self.predictions += 1
+
+    def _setHomography(self, rvec, tvec):
+        corners = charuco.projectBoardCorners(rvec, tvec, self.camMatrix, self.distMatrix)
+        self.homography = charuco.calculateHomography(corners, ransac=False)
+        self.version += 1
+
+    def stats(self):
+        return {"detections": self.detections, "predictions": self.predictions, "reuses": self.reuses}
@@ -1,7 +1,17 @@
+# Calibration map from warped image pixels to millimetres on the plate
+# MEASURED_CORNERS is a hand measured grid of where the 7x7 inner ChArUco corners show up in the warped image, with
+# holes where a corner couldn't be found. buildCalibrationMap() fills the holes, then works out the plate position of
+# every STEP'th pixel of the warped image and saves that as a .npy file. scipy is only needed to build the map,
+# CalibrationMap looks positions up from the (memory mapped) file with bilinear interpolation, no scipy in the loop
+
+import os
+import hashlib
 import numpy as np
-from scipy.interpolate import griddata
 
-data = [
+from Charuco_imaging import SQUARE_LENGTH, TRANSFORMED_SIZE
+
+# (x, y) pixel position of each inner corner, row by row. None where the corner wasn't measured
+MEASURED_CORNERS = [
     [None, None, (178.23778, 239.69135), None, None, (283.03058, 233.97826), None],
     [(106.958, 276.26096), (144.38188, 275.03555), (180.18245, 273.52017), None, None, (286.1315, 267.27582), None],
     [(109.04088, 310.93637), (146.4808, 309.42035), (182.21104, 307.64346), (218.0415, 305.8496), (253.5068, 303.55048), (288.44675, 301.45132), None],
@@ -11,17 +21,166 @@ data = [
     [None, None, None, None, None, (298.59924, 445.02005), (334.81857, 442.8071)]
 ]
 
-# Flatten the data and remove None values
-flat_data = [point for row in data for point in row if point is not None]
+MAP_STEP = 4 # pixels between map samples, the map is (480/4 + 1) x (480/4 + 1) x 2
+CORNER_SPACING = SQUARE_LENGTH * 1000 # mm between inner corners
+MAP_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache')
+
+
+def quadraticTerms(x, y):
+    """columns of a 2D quadratic in x and y, for least squares fits"""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    return np.stack((np.ones_like(x), x, y, x * x, x * y, y * y), axis=-1)
+
+
+def fitQuadratic(x, y, values):
+    """least squares 2D quadratic through the points, returns a function of (x, y)"""
+    coefficients, *_ = np.linalg.lstsq(quadraticTerms(x, y), values, rcond=None)
+    return lambda newX, newY: quadraticTerms(newX, newY) @ coefficients
+
+
+def fillHoles(corners=MEASURED_CORNERS):
+    """
+    returns the corner grid as a (rows, columns, 2) array with the missing corners filled in.
+    Holes are filled in grid index space: linearly between measured corners, and from a quadratic fit of the whole
+    grid for holes on the outside (where linear interpolation has nothing to go on)
+    """
+    from scipy.interpolate import griddata
+
+    rows, columns = len(corners), len(corners[0])
+    grid = np.array([[point if point is not None else (np.nan, np.nan) for point in row] for row in corners],
+                    dtype=np.float64)
+    rowIndex, columnIndex = np.meshgrid(np.arange(rows), np.arange(columns), indexing='ij')
+    known = ~np.isnan(grid[:, :, 0])
+
+    filled = grid.copy()
+    filled[~known] = griddata((rowIndex[known], columnIndex[known]), grid[known],
+                              (rowIndex[~known], columnIndex[~known]), method='linear')
+    outside = np.isnan(filled[:, :, 0])
+    if outside.any():
+        quadratic = fitQuadratic(rowIndex[known], columnIndex[known], grid[known])
+        filled[outside] = quadratic(rowIndex[outside], columnIndex[outside])
+    return filled
+
+
+def cornerMillimetres(rows, columns):
+    """
+    (rows, columns, 2) plate position (mm) of each inner corner. (0, 0) is the middle of the board,
+    x goes along a row and y down the columns, the same directions as the image
+    """
+    rowIndex, columnIndex = np.meshgrid(np.arange(rows), np.arange(columns), indexing='ij')
+    return np.stack(((columnIndex - (columns - 1) / 2) * CORNER_SPACING,
+                     (rowIndex - (rows - 1) / 2) * CORNER_SPACING), axis=-1)
+
+
+def buildCalibrationMap(corners=MEASURED_CORNERS, imageSize=TRANSFORMED_SIZE, step=MAP_STEP):
+    """
+    returns a (height/step + 1, width/step + 1, 2) float32 array, the plate position (mm) of pixel (column*step, row*step).
+    Inside the measured corners the map is piecewise linear between them, outside it is a quadratic fit of all of them
+    """
+    from scipy.interpolate import griddata
+
+    filled = fillHoles(corners)
+    millimetres = cornerMillimetres(*filled.shape[:2])
+    pixels = filled.reshape(-1, 2)
+    millimetres = millimetres.reshape(-1, 2)
+
+    width, height = imageSize
+    mapX, mapY = np.meshgrid(np.arange(0, width + 1, step, dtype=np.float64),
+                             np.arange(0, height + 1, step, dtype=np.float64))
+    calibrationMap = griddata(pixels, millimetres, (mapX, mapY), method='linear')
+    outside = np.isnan(calibrationMap[:, :, 0])
+    quadratic = fitQuadratic(pixels[:, 0], pixels[:, 1], millimetres)
+    calibrationMap[outside] = quadratic(mapX[outside], mapY[outside])
+    return calibrationMap.astype(np.float32)
+
+
+def calibrationMapPath(corners=MEASURED_CORNERS, imageSize=TRANSFORMED_SIZE, step=MAP_STEP, cacheDir=MAP_CACHE_DIR):
+    """cache file for these settings, the name changes if the measurements or settings do"""
+    description = repr((corners, tuple(imageSize), step, CORNER_SPACING))
+    return os.path.join(cacheDir, 'calibrationMap_' + hashlib.sha1(description.encode()).hexdigest()[:16] + '.npy')
+
+
+class CalibrationMap():
+    """
+    Converts warped image pixel positions to plate millimetres. The map is loaded memory mapped from its cache file,
+    and built (needs scipy) and saved first if there isn't one yet
+    """
+    def __init__(self, path=None, imageSize=TRANSFORMED_SIZE, step=MAP_STEP):
+        if path is None:
+            path = calibrationMapPath(imageSize=imageSize, step=step)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            tempPath = path + '.tmp.npy'
+            np.save(tempPath, buildCalibrationMap(imageSize=imageSize, step=step))
+            os.replace(tempPath, path)
+        self.path = path
+        self.map = np.load(path, mmap_mode='r')
+        rows, columns = self.map.shape[:2]
+        width, height = imageSize
+        self.stepX = width / (columns - 1)
+        self.stepY = height / (rows - 1)
+        self.lastColumn = columns - 2 # last cell that can be interpolated in
+        self.lastRow = rows - 2
+        self._grid = np.asarray(self.map) # plain ndarray view of the memory map, slicing a np.memmap is slower
+
+    def toMillimetres(self, x, y):
+        """
+        plate position (mm) of pixel (x, y). x and y can be numbers or arrays, positions off the image are
+        extrapolated from the nearest cell. (None, None) in gives (None, None) out, like get_circle_position
+        """
+        if x is None or y is None:
+            return None, None
+        # plain numbers (and numpy float64, a float subclass) skip np.ndim, which costs more than the lookup
+        if (isinstance(x, (int, float)) and isinstance(y, (int, float))) or (np.ndim(x) == 0 and np.ndim(y) == 0):
+            return self._lookupPoint(float(x), float(y))
+        return self._lookupArray(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+
+    def _lookupPoint(self, x, y):
+        # one 2x2 slice of the map, then plain python. numpy's per call overhead is more than the whole blend
+        u = x / self.stepX
+        v = y / self.stepY
+        column = min(max(int(u // 1), 0), self.lastColumn)
+        row = min(max(int(v // 1), 0), self.lastRow)
+        fu = u - column
+        fv = v - row
+        (a, b), (c, d) = self._grid[row:row+2, column:column+2].tolist() # only the 4 corners of the cell
+        topX = a[0] + fu * (b[0] - a[0])
+        topY = a[1] + fu * (b[1] - a[1])
+        bottomX = c[0] + fu * (d[0] - c[0])
+        bottomY = c[1] + fu * (d[1] - c[1])
+        return topX + fv * (bottomX - topX), topY + fv * (bottomY - topY)
+
+    def _lookupArray(self, x, y):
+        u = x / self.stepX
+        v = y / self.stepY
+        column = np.clip(np.floor(u).astype(np.intp), 0, self.lastColumn)
+        row = np.clip(np.floor(v).astype(np.intp), 0, self.lastRow)
+        fu = (u - column)[..., None]
+        fv = (v - row)[..., None]
+        top = self.map[row, column] + fu * (self.map[row, column + 1] - self.map[row, column])
+        bottom = self.map[row + 1, column] + fu * (self.map[row + 1, column + 1] - self.map[row + 1, column])
+        result = top + fv * (bottom - top)
+        return result[..., 0], result[..., 1]
+
+
+if __name__ == '__main__':
+    from time import perf_counter
 
-# Separate x and y coordinates
-x_coords = [point[0] for point in flat_data]
-y_coords = [point[1] for point in flat_data]
+    np.set_printoptions(precision=2, suppress=True)
+    print("corners with the holes filled in:")
+    print(fillHoles())
 
-# Generate grid
-grid_x, grid_y = np.meshgrid(np.arange(len(data[0])), np.arange(len(data)))
+    calibrationMap = CalibrationMap()
+    print("map", calibrationMap.map.shape, "saved to", calibrationMap.path)
 
-# Interpolate missing values using linear interpolation
-interpolated_values = griddata((x_coords, y_coords), flat_data, (grid_x, grid_y), method='linear')
+    filled = fillHoles()
+    expected = cornerMillimetres(*filled.shape[:2])
+    mapX, mapY = calibrationMap.toMillimetres(filled[:, :, 0], filled[:, :, 1])
+    error = np.hypot(mapX - expected[:, :, 0], mapY - expected[:, :, 1])
+    print("error at the corners: mean", error.mean(), "max", error.max(), "mm")
 
-print(interpolated_values)
\ No newline at end of file
+    startTime = perf_counter()
+    for i in range(10000):
+        calibrationMap.toMillimetres(240.5, 300.25)
+    print("one point lookup", (perf_counter() - startTime) / 10000 * 1e6, "us")
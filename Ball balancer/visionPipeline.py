@@ -0,0 +1,261 @@
+# Runs the camera stuff asynchronously: a capture thread, processing workers and a consumer that reads the newest ball position
+# Stages are connected by small queues that throw away stale frames, so the control loop always gets the freshest data
+
+import cv2 as cv
+import threading
+import queue
+from time import perf_counter, sleep
+import Charuco_imaging as charuco
+from homographyCache import HomographyCache
+from fusedRemap import FusedRemap
+from frameProcessor import FrameProcessor
+from ballDetector import BallTracker
+from cameraCapture import CameraCapture, CALIBRATION_SIZE
+
+
+class StageStats():
+    """
+    Keeps track of how long a pipeline stage takes and how often it runs.
+    Latency and FPS are exponential moving averages so they follow the current behaviour
+    """
+    def __init__(self, name, smoothing=0.1):
+        self.name = name
+        self.smoothing = smoothing
+        self.count = 0
+        self.latency = 0.0 # s
+        self.max_latency = 0.0 # s
+        self.fps = 0.0
+        self._last_time = None
+        self._lock = threading.Lock()
+
+    def record(self, latency, now=None):
+        """records one run of the stage that took latency seconds"""
+        if now is None:
+            now = perf_counter()
+        with self._lock:
+            if self.count == 0:
+                self.latency = latency
+            else:
+                self.latency += self.smoothing * (latency - self.latency)
+            self.max_latency = max(self.max_latency, latency)
+            if self._last_time is not None and now > self._last_time:
+                instant_fps = 1 / (now - self._last_time)
+                self.fps = instant_fps if self.fps == 0 else self.fps + self.smoothing * (instant_fps - self.fps)
+            self._last_time = now
+            self.count += 1
+
+    def summary(self):
+        with self._lock:
+            return {"count": self.count, "fps": self.fps, "latency_ms": self.latency * 1000,
+                    "max_latency_ms": self.max_latency * 1000}
+
+
+class DropOldestQueue():
+    """
+    Bounded queue where putting into a full queue throws away the oldest item instead of blocking
+    """
+    def __init__(self, maxsize=1):
+        self._queue = queue.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, item):
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """returns the next item, or None if nothing arrived within timeout"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class BallMeasurement():
+    """
+    One result from the pipeline. x and y are None if the ball (or the board) wasn't found in that frame
+    """
+    __slots__ = ("frame_number", "timestamp", "x", "y", "found_board", "image")
+
+    def __init__(self, frame_number, timestamp, x, y, found_board, image=None):
+        self.frame_number = frame_number
+        self.timestamp = timestamp # perf_counter() time the frame was captured
+        self.x = x
+        self.y = y
+        self.found_board = found_board
+        self.image = image
+
+
+class VisionPipeline():
+    """
+    capture thread -> frame queue -> processing workers -> latest result slot
+    Use latest() to read the newest result without blocking, or positions() to iterate over results as they arrive
+    """
+    def __init__(self, capture=None, camera_index=0, num_workers=2, queue_size=1, keep_images=False,
+                 use_homography_cache=True, tilt_source=None, use_fused_remap=False, adaptive_capture=True):
+        """
+        capture - anything with a cv.VideoCapture style read(), opens camera_index if not given
+        num_workers - number of processing threads, OpenCV releases the GIL so these run on separate cores
+        queue_size - max number of frames waiting to be processed, older frames are dropped
+        keep_images - keep the warped image in each result (for display)
+        use_homography_cache - only re-detect the board when needed instead of every frame (see homographyCache.py)
+        tilt_source - function returning the (pitch, roll) currently commanded to the platform,
+                      e.g. PlatformController.get_commanded_tilt, lets the cache predict the board pose
+        use_fused_remap - undistort and warp each frame with one precomputed remap (needs the homography cache)
+        adaptive_capture - when opening the camera, let it drop to a smaller size if processing can't keep up
+        """
+        if capture is None:
+            # gray frames at WINDOW_SIZE, with a 1 frame driver buffer (see cameraCapture.py)
+            capture = CameraCapture(camera_index, gray=True, adaptive=adaptive_capture)
+        self.capture = capture
+        self.num_workers = num_workers
+        self.keep_images = keep_images
+
+        self.camMatrix, self.distMatrix = charuco.loadCalibration()
+        self.dictionary = cv.aruco.getPredefinedDictionary(charuco.ARUCO_DICT)
+        self.board = cv.aruco.CharucoBoard(charuco.SIZE, charuco.SQUARE_LENGTH, charuco.MARKER_LENGTH, self.dictionary)
+        self.tilt_source = tilt_source
+        self.homography_cache = None
+        if use_homography_cache:
+            self.homography_cache = HomographyCache(self.dictionary, self.board, self.camMatrix, self.distMatrix)
+        self.fused_remap = None
+        if use_fused_remap and use_homography_cache:
+            self.fused_remap = FusedRemap(self.camMatrix, self.distMatrix)
+
+        self.frame_processors = [] # one per processing worker, each has its own buffers
+        self.frame_queue = DropOldestQueue(queue_size)
+        self.capture_stats = StageStats("capture")
+        self.process_stats = StageStats("process")
+        self.end_to_end_stats = StageStats("end to end") # capture time until the result is available
+        self.consumer_stats = StageStats("consumer") # capture time until the result is read
+
+        self._latest = None
+        self._last_read_frame = -1
+        self._result_lock = threading.Condition()
+        self._running = False
+        self._threads = []
+
+    def start(self):
+        self._running = True
+        self._threads = [threading.Thread(target=self._capture_loop, name="capture", daemon=True)]
+        for i in range(self.num_workers):
+            self._threads.append(threading.Thread(target=self._process_loop, name="process " + str(i), daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        with self._result_lock:
+            self._result_lock.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.capture.release()
+
+    def _capture_loop(self):
+        frame_number = 0
+        while self._running:
+            start_time = perf_counter()
+            ret, frame = self.capture.read()
+            timestamp = perf_counter()
+            if not ret:
+                # camera not ready (or replay finished), don't spin the cpu
+                sleep(0.005)
+                continue
+            self.capture_stats.record(timestamp - start_time, timestamp)
+            self.frame_queue.put((frame_number, timestamp, frame))
+            frame_number += 1
+
+    def _process_loop(self):
+        # each worker has its own ball tracker, workers finish frames out of order and a shared tracker would get
+        # its last position and velocity from whichever frame finished last. A worker's own frames are in order
+        processor = FrameProcessor(self.camMatrix, self.distMatrix, self.dictionary, self.board,
+                                   self.homography_cache, self.fused_remap, tracker=BallTracker(),
+                                   calibrationSize=CALIBRATION_SIZE)
+        self.frame_processors.append(processor)
+        while self._running:
+            item = self.frame_queue.get(timeout=0.1)
+            if item is None:
+                continue
+            frame_number, timestamp, frame = item
+
+            commanded_tilt = self.tilt_source() if self.tilt_source is not None else (None, None)
+            start_time = perf_counter()
+            found_board, x, y, image = processor.process(frame, commanded_tilt)
+            done_time = perf_counter()
+            self.process_stats.record(done_time - start_time, done_time)
+            if isinstance(self.capture, CameraCapture):
+                # workers run in parallel, so a frame of throughput takes the processing time / workers
+                self.capture.reportProcessingTime((done_time - start_time) / self.num_workers)
+
+            # the image is the processor's buffer and gets overwritten by the next frame
+            result = BallMeasurement(frame_number, timestamp, x, y, found_board, image.copy() if self.keep_images else None)
+            with self._result_lock:
+                # with several workers results can finish out of order, never replace a newer frame with an older one
+                if self._latest is None or frame_number > self._latest.frame_number:
+                    self._latest = result
+                    self.end_to_end_stats.record(done_time - timestamp, done_time)
+                    self._result_lock.notify_all()
+
+    def latest(self, only_new=True):
+        """
+        returns the newest BallMeasurement without blocking.
+        If only_new is True returns None when there is nothing newer than the last call
+        """
+        with self._result_lock:
+            result = self._latest
+            if result is None or (only_new and result.frame_number <= self._last_read_frame):
+                return None
+            self._last_read_frame = result.frame_number
+        self.consumer_stats.record(perf_counter() - result.timestamp)
+        return result
+
+    def positions(self, timeout=1.0):
+        """
+        generator that yields each new BallMeasurement as it becomes available, skipping any that were superseded
+        """
+        while self._running:
+            with self._result_lock:
+                self._result_lock.wait_for(lambda: not self._running or
+                                           (self._latest is not None and self._latest.frame_number > self._last_read_frame),
+                                           timeout)
+            result = self.latest()
+            if result is not None:
+                yield result
+
+    def stats(self):
+        """
+        returns the latency and fps of every stage plus how many frames were dropped as stale
+        """
+        stats = {"capture": self.capture_stats.summary(), "process": self.process_stats.summary(),
+                 "end to end": self.end_to_end_stats.summary(), "consumer": self.consumer_stats.summary(),
+                 "dropped frames": self.frame_queue.dropped}
+        if self.homography_cache is not None:
+            stats["homography cache"] = self.homography_cache.stats()
+        stats["frame processors"] = [processor.stats() for processor in self.frame_processors]
+        if isinstance(self.capture, CameraCapture):
+            stats["camera"] = self.capture.stats()
+        return stats
+
+
+if __name__ == '__main__':
+    pipeline = VisionPipeline(keep_images=True).start()
+    print("Starting vision pipeline, press q to quit")
+    try:
+        for measurement in pipeline.positions():
+            cv.imshow("with ids", measurement.image)
+            if cv.waitKey(1) & 0xFF == ord('q'):
+                break
+            if measurement.frame_number % 30 == 0:
+                print(pipeline.stats())
+    finally:
+        pipeline.stop()
+        cv.destroyAllWindows()
@@ -1,68 +1,274 @@
-from gpiozero import AngularServo
-from time import sleep
-from calculateMotorAngle import calculateMotorAngle 
-from gpiozero.pins.pigpio import PiGPIOFactory
-
-factory = PiGPIOFactory()
-SERVO_1_PIN = 16
-SERVO_3_PIN = 12
-SERVO_2_PIN = 13
+from time import sleep, perf_counter
+import threading
+from calculateMotorAngle import calculateMotorAngle, calculateMotorAngleTilt
+from helperFuncs import cosd, sind
+from helperFuncs import debugPrint
+from forwardKinematics import PoseTracker
+from hardwareBackends import createServoBackend
 
 MAX_ANGLE = 60
 MIN_ANGLE = -60
 
-def get_servo_angles(pitch, roll, z):
+SERVO_PWM_PERIOD = 0.02 # s, servos only pick up a new position once per PWM period so writing faster is wasted
+BLOCKING_SETTLE_TIME = 0.2 # s, how long blocking mode waits after moving the servos
+
+def get_servo_angles(pitch, roll, z, angle_table=None, clamp=False):
     """
     returns the angles needed (servo 1, servo 2, servo 3)
+    if a ServoAngleTable is given it is used, falling back to the exact calculation outside the table
+    if clamp is True impossible poses, and poses needing a servo past MIN_ANGLE or MAX_ANGLE, are moved to the
+    closest pose the servos can do, otherwise UnreachablePoseError is raised (out of range angles are returned as is)
     """
-    angles = calculateMotorAngle(pitch, roll, z)
-    print(angles)
+    angles = None
+    if angle_table is not None:
+        angles = angle_table.lookup(pitch, roll, z)
+    if angles is None or (clamp and not servo_angles_in_range(angles)):
+        angles = calculateMotorAngle(pitch, roll, z, clamp=clamp, angleLimits=(MIN_ANGLE, MAX_ANGLE))
+    debugPrint(angles)
     return angles
 
+def get_servo_angles_tilt(direction, magnitude, z, tilt_table=None, clamp=False):
+    """
+    same as get_servo_angles for a tilt direction and magnitude (see calculateMotorAngleTilt).
+    tilt_table is a ServoAngleTable built with tiltVector=True
+    """
+    angles = None
+    if tilt_table is not None:
+        angles = tilt_table.lookupTilt(direction, magnitude, z)
+    if angles is None or (clamp and not servo_angles_in_range(angles)):
+        angles = calculateMotorAngleTilt(direction, magnitude, z, clamp=clamp, angleLimits=(MIN_ANGLE, MAX_ANGLE))
+    debugPrint(angles)
+    return angles
+
+def servo_angles_in_range(servo_angles):
+    """
+    True if all 3 servo angles are within MIN_ANGLE and MAX_ANGLE
+    """
+    return all(MIN_ANGLE <= angle <= MAX_ANGLE for angle in servo_angles)
+
+class ServoWriter ():
+    """
+    Background thread that writes servo set-points so the control loop never waits on the servos.
+    Only the newest set-point is kept (latest value wins), and writes are spaced at least min_update_interval apart
+    """
+    def __init__(self, write_servos, min_update_interval=SERVO_PWM_PERIOD):
+        """
+        write_servos - function that takes (servo 1, servo 2, servo 3) angles and actually moves the servos
+        min_update_interval - minimum time between writes in seconds
+        """
+        self.write_servos = write_servos
+        self.min_update_interval = min_update_interval
+
+        self.commands_submitted = 0
+        self.commands_written = 0
+        self.commands_coalesced = 0 # replaced by a newer set-point before they could be written
+        self.commands_dropped = 0 # rejected for being out of range, or still pending at shutdown
+        self.error = None # exception that stopped the writer thread, raised again by the next submit()
+
+        self._pending = None
+        self._running = True
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="ServoWriter", daemon=True)
+        self._thread.start()
+
+    def submit(self, servo_angles):
+        """
+        queues a set-point to be written, replaces any set-point that hasn't been written yet. Never blocks.
+        If a write failed or stop() was called the writer thread has stopped, so an error is raised here instead of
+        losing the command
+        """
+        with self._condition:
+            if self.error is not None:
+                self.commands_dropped += 1
+                raise RuntimeError("servo writer stopped after a failed write") from self.error
+            if not self._running:
+                self.commands_dropped += 1
+                raise RuntimeError("servo writer has been stopped")
+            self.commands_submitted += 1
+            if self._pending is not None:
+                self.commands_coalesced += 1
+            self._pending = servo_angles
+            self._condition.notify()
+
+    def drop(self):
+        """
+        counts a set-point that was rejected before being submitted
+        """
+        with self._condition:
+            self.commands_dropped += 1
+
+    def _run(self):
+        last_write_time = None
+        while True:
+            with self._condition:
+                while self._pending is None and self._running:
+                    self._condition.wait()
+                if not self._running:
+                    return
+
+            # wait out the rest of the update interval, new set-points that arrive meanwhile replace the pending one
+            if last_write_time is not None:
+                wait_time = last_write_time + self.min_update_interval - perf_counter()
+                if wait_time > 0:
+                    sleep(wait_time)
+
+            with self._condition:
+                servo_angles = self._pending
+                self._pending = None
+            if servo_angles is None:
+                continue
+
+            last_write_time = perf_counter()
+            try:
+                self.write_servos(servo_angles)
+            except Exception as error:
+                # e.g. an I/O error from the servo backend. Keep it for submit() to raise and stop writing
+                with self._condition:
+                    self.error = error
+                    self.commands_dropped += 1
+                    self._running = False
+                debugPrint("Servo write failed, servo writer stopped: ", repr(error))
+                return
+            with self._condition:
+                self.commands_written += 1
+
+    def stats(self):
+        """
+        returns a dict of the command counters
+        """
+        with self._condition:
+            return {"submitted": self.commands_submitted, "written": self.commands_written,
+                    "coalesced": self.commands_coalesced, "dropped": self.commands_dropped}
+
+    def stop(self):
+        """
+        stops the writer thread, a set-point that hasn't been written yet is dropped
+        """
+        with self._condition:
+            self._running = False
+            if self._pending is not None:
+                self.commands_dropped += 1
+                self._pending = None
+            self._condition.notify()
+        self._thread.join()
+
 class PlatformController ():
-    def __init__(self):
-        factory = PiGPIOFactory()
-        self.servo1 = AngularServo(SERVO_1_PIN, initial_angle = 0, pin_factory=factory, min_angle =-90, max_angle = 90, min_pulse_width = 0.00036 , max_pulse_width = 0.00227)
-        self.servo3 = AngularServo(SERVO_3_PIN, initial_angle = 0, pin_factory=factory, min_angle =-90, max_angle = 90, min_pulse_width = 0.00050 , max_pulse_width = 0.00224)
-        self.servo2 = AngularServo(SERVO_2_PIN, initial_angle = 0, pin_factory=factory, min_angle =-90, max_angle = 90, min_pulse_width = 0.00036 , max_pulse_width = 0.00227)
+    def __init__(self, angle_table=None, non_blocking=False, min_update_interval=SERVO_PWM_PERIOD, clamp_unreachable=True,
+                 workspace=None, backend=None, tilt_table=None):
+        """
+        angle_table - optional ServoAngleTable (see servoAngleTable.py) to look angles up instead of calculating them
+        tilt_table - optional ServoAngleTable built with tiltVector=True, the same thing for set_platform_tilt
+        non_blocking - if True servo set-points are handed to a background ServoWriter instead of
+                       moving the servos and sleeping BLOCKING_SETTLE_TIME
+        min_update_interval - minimum time between servo writes in non blocking mode (s)
+        clamp_unreachable - move impossible poses to the closest reachable one instead of raising UnreachablePoseError
+        workspace - optional WorkspaceMap (see workspaceMap.py), poses outside it are saturated onto its edge
+                    before the servo angles are worked out
+        backend - servo backend from hardwareBackends.py, defaults to createServoBackend() (real servos unless the
+                  PLATFORM_BACKEND environment variable says "fake")
+        """
+        self.angle_table = angle_table
+        self.tilt_table = tilt_table
+        self.clamp_unreachable = clamp_unreachable
+        self.workspace = workspace
+
+        # last pose sent with set_platform_angle or set_platform_tilt whose servo angles were accepted
+        self.pitch = 0
+        self.roll = 0
+        self.z = 0
+
+        # last servo angles accepted by set_servos, and forward kinematics to get the pose back from them
+        self.servo_angles = (0, 0, 0)
+        self.pose_tracker = PoseTracker()
+        self.pose_lock = threading.Lock()
+        self.backend = backend if backend is not None else createServoBackend()
+
+        self.servo_writer = None
+        if non_blocking:
+            self.servo_writer = ServoWriter(self._write_servos, min_update_interval)
 
     def set_platform_angle (self, pitch, roll, z):
         """
         takes in an angle 
         """
-        servo_angles = get_servo_angles(pitch, roll, z)
-        
-        self.set_servos(servo_angles)
-        
+        if self.workspace is not None:
+            pitch, roll, z = self.workspace.saturate(pitch, roll, z)
+        servo_angles = get_servo_angles(pitch, roll, z, self.angle_table, self.clamp_unreachable)
+        if self.set_servos(servo_angles):
+            self.pitch = pitch
+            self.roll = roll
+            self.z = z
+
+    def set_platform_tilt(self, direction, magnitude, z):
+        """
+        tilts the platform by magnitude (degrees) towards direction (degrees, 0 is the pitch direction and 90 the roll
+        direction) at height z. Unlike set_platform_angle the steepest slope of the plate is exactly along direction
+        and exactly magnitude steep however big the tilt, pitch and roll don't change each other's effect.
+        A correction vector (x, y) is direction = atan2(y, x), magnitude = hypot(x, y).
+        pitch and roll are kept as the small angle equivalents magnitude*cos(direction), magnitude*sin(direction)
+        """
+        if self.workspace is not None:
+            direction, magnitude, z = self.workspace.saturateTilt(direction, magnitude, z)
+        servo_angles = get_servo_angles_tilt(direction, magnitude, z, self.tilt_table, self.clamp_unreachable)
+        if self.set_servos(servo_angles):
+            self.pitch = magnitude * cosd(direction)
+            self.roll = magnitude * sind(direction)
+            self.z = z
+
     def set_servos(self, servo_angles):
         """
-        sets all the servo angles 
-        """
-        if MIN_ANGLE <= servo_angles[0] <= MAX_ANGLE:
-            self.servo1.angle= servo_angles[0]
-            #sleep(0.01)
-        else:
-            print("Angle 1 failed: angle = ", servo_angles[0])
-            return
-        if MIN_ANGLE<= servo_angles[1] <= MAX_ANGLE:
-            self.servo2.angle= servo_angles[1]
-            #sleep(0.01)
-        else:
-            print("Angle 1 failed: angle = ", servo_angles[1])
-            return
-
-        if MIN_ANGLE<= servo_angles[2] <= MAX_ANGLE:
-            self.servo3.angle= servo_angles[2]
-            #sleep(0.01)
-        else:
-            print("Angle 1 failed: angle = ", servo_angles[2])
-            return
-        sleep(0.2)
+        sets all the servo angles, returns False if they were rejected for being out of range
+        in non blocking mode this only queues the angles for the servo writer thread and returns immediately
+        """
+        if self.servo_writer is not None:
+            if not servo_angles_in_range(servo_angles):
+                self.servo_writer.drop()
+                debugPrint("Servo angles out of range, command dropped: angles = ", servo_angles)
+                return False
+            self.servo_writer.submit(servo_angles)
+            self.servo_angles = servo_angles
+            return True
+
+        # check all of them first so an out of range angle can't leave the platform half moved
+        if not servo_angles_in_range(servo_angles):
+            debugPrint("Servo angles out of range, nothing moved: angles = ", servo_angles)
+            return False
+        self._write_servos(servo_angles)
+        self.servo_angles = servo_angles
+        sleep(BLOCKING_SETTLE_TIME)
+        return True
+
+    def _write_servos(self, servo_angles):
+        """
+        moves the servos to the given angles, callers check they are in range first
+        """
+        self.backend.setAngles(servo_angles)
+
+    def get_commanded_tilt(self):
+        """
+        returns the (pitch, roll) of the last pose whose servo angles were accepted
+        """
+        return (self.pitch, self.roll)
+
+    def get_platform_pose(self):
+        """
+        returns the (pitch, roll, z) the servos were actually sent, worked out from the servo angles with forward
+        kinematics. Differs from the commanded pose when it was clamped or saturated. Safe to call from other threads
+        """
+        with self.pose_lock:
+            return self.pose_tracker.solve(self.servo_angles)
+
+    def get_platform_tilt(self):
+        """
+        returns the (pitch, roll) part of get_platform_pose, for the vision pipeline's tilt_source
+        """
+        pitch, roll, z = self.get_platform_pose()
+        return (pitch, roll)
 
     def cleanup(self):
-        self.servo1.close()
-        self.servo2.close()
-        self.servo3.close()
+        if self.servo_writer is not None:
+            self.servo_writer.stop()
+        self.backend.close()
 
 # if __name__ == "main":
 #     p = PlatformController()
@@ -0,0 +1,115 @@
+# Kalman filter for the ball position and velocity
+# Takes timestamped ball positions from the vision pipeline and predicts where the ball will be when the
+# servos actually move, so the control loop isn't acting on old data. Keeps predicting through missed frames for a while
+# Camera latency is covered by the measurement timestamps (capture time), servo latency by predicting past "now"
+
+import numpy as np
+
+SERVO_LATENCY = 0.03 # s, from sending a set-point until the platform has moved
+MAX_COAST_TIME = 0.3 # s, how long to keep predicting without a measurement before giving up on the ball
+
+
+class BallEstimator():
+    """
+    Constant velocity (or constant acceleration) Kalman filter over the ball x and y.
+    Both axes share the same model and measurement times, so they share one covariance matrix
+    """
+    def __init__(self, constantAcceleration=False, processNoise=5000.0, measurementNoise=1.0,
+                 maxCoastTime=MAX_COAST_TIME, actuationLatency=SERVO_LATENCY):
+        """
+        constantAcceleration - track acceleration too, otherwise velocity is assumed constant between frames
+        processNoise - spectral density of the unmodelled motion (units^2/s^3 for constant velocity, units^2/s^5 for constant acceleration)
+        measurementNoise - variance of a position measurement (units^2)
+        maxCoastTime - predictions further than this past the last measurement return None
+        actuationLatency - how far ahead of "now" estimate() predicts, to cover the servo delay
+        """
+        self.order = 3 if constantAcceleration else 2
+        self.processNoise = processNoise
+        self.measurementNoise = measurementNoise
+        self.maxCoastTime = maxCoastTime
+        self.actuationLatency = actuationLatency
+        self.reset()
+
+    def reset(self):
+        self.state = None # (order, 2) array, column 0 is x, column 1 is y. Rows are position, velocity, (acceleration)
+        self.covariance = None
+        self.time = None # time the state is for
+        self.lastMeasurementTime = None
+        self.measurements = 0
+        self.missedMeasurements = 0
+
+    def _transition(self, dt):
+        F = np.eye(self.order)
+        F[0, 1] = dt
+        if self.order == 3:
+            F[0, 2] = dt**2 / 2
+            F[1, 2] = dt
+        return F
+
+    def _processCovariance(self, dt):
+        q = self.processNoise
+        if self.order == 2:
+            # continuous white noise acceleration
+            return q * np.array([[dt**3 / 3, dt**2 / 2],
+                                 [dt**2 / 2, dt]])
+        # continuous white noise jerk
+        return q * np.array([[dt**5 / 20, dt**4 / 8, dt**3 / 6],
+                             [dt**4 / 8, dt**3 / 3, dt**2 / 2],
+                             [dt**3 / 6, dt**2 / 2, dt]])
+
+    def update(self, timestamp, x, y):
+        """
+        adds a measurement taken at timestamp (s, same clock as the predictions, the pipeline uses perf_counter).
+        x or y being None counts as a missed frame
+        """
+        if x is None or y is None:
+            self.missedMeasurements += 1
+            return
+
+        measurement = np.array([x, y], dtype=float)
+        if self.state is None:
+            self.state = np.zeros((self.order, 2))
+            self.state[0] = measurement
+            # position is known as well as the camera, velocity and acceleration are not known at all
+            self.covariance = np.diag([self.measurementNoise] + [1e6] * (self.order - 1))
+            self.time = timestamp
+            self.lastMeasurementTime = timestamp
+            self.measurements += 1
+            return
+
+        if timestamp < self.time:
+            # older than what we already have (out of order frame), ignore it
+            return
+
+        # predict forward to the measurement time
+        dt = timestamp - self.time
+        F = self._transition(dt)
+        state = F.dot(self.state)
+        covariance = F.dot(self.covariance).dot(F.T) + self._processCovariance(dt)
+
+        # correct with the measurement, only position is measured so H = [1, 0, (0)]
+        innovation = measurement - state[0]
+        innovationVariance = covariance[0, 0] + self.measurementNoise
+        gain = covariance[:, 0] / innovationVariance
+        self.state = state + np.outer(gain, innovation)
+        self.covariance = covariance - np.outer(gain, covariance[0, :])
+
+        self.time = timestamp
+        self.lastMeasurementTime = timestamp
+        self.measurements += 1
+
+    def predict(self, timestamp):
+        """
+        returns the predicted (x, y, vx, vy) at timestamp without changing the filter,
+        or None if there hasn't been a measurement yet or the last one is older than maxCoastTime
+        """
+        if self.state is None or timestamp - self.lastMeasurementTime > self.maxCoastTime:
+            return None
+        state = self._transition(timestamp - self.time).dot(self.state)
+        return (state[0, 0], state[0, 1], state[1, 0], state[1, 1])
+
+    def estimate(self, now):
+        """
+        returns (x, y, vx, vy) predicted for when a command sent now takes effect (now + actuationLatency), or None
+        """
+        return self.predict(now + self.actuationLatency)
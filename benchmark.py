@@ -0,0 +1,398 @@
+# Benchmark suite for the parts of the code that decide the loop rate
+# Every case is timed call by call so the results have percentiles (p50/p99/max) and not just an average,
+# the worst calls are what make the control loop miss its deadline.
+# Results are saved as JSON, and a run can be compared to an older one to catch slowdowns:
+#   python benchmark.py                                  run everything and save the results
+#   python benchmark.py kinematics                       only run cases with "kinematics" in the name
+#   python benchmark.py --baseline benchmarks/old.json   also compare to an older run, exits with 1 if something got slower
+
+import os
+import sys
+import json
+import platform
+import argparse
+import tempfile
+from datetime import datetime
+from time import perf_counter_ns
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+VISION_DIR = os.path.join(REPO_DIR, 'Ball balancer')
+sys.path.append(VISION_DIR)
+
+BENCHMARK_DIR = os.path.join(REPO_DIR, 'benchmarks')
+DEFAULT_REPEATS = 1000 # timed samples per case
+WARMUP_CALLS = 5 # untimed calls first, so caches and lazy setup don't count
+DEFAULT_THRESHOLD = 0.10 # a case counts as slower if its p50 or p99 went up by more than this fraction
+SAMPLE_IMAGE = os.path.join(VISION_DIR, 'image with corners.png') # camera frame with the whole board in it
+BALL_POSITION = (200, 260) # where the ball is drawn on the warped sample frame
+
+CASES = {} # name -> (setup function, repeats, calls per sample)
+
+
+def benchmarkCase(name, repeats=DEFAULT_REPEATS, inner=1):
+    """
+    decorator that registers a benchmark case. The decorated function does the setup and returns the function to time,
+    or (function to time, function to run untimed before each sample).
+    inner - calls per timed sample, for things too fast to time one call at a time
+    """
+    def register(setup):
+        CASES[name] = (setup, repeats, inner)
+        return setup
+    return register
+
+
+def timeCase(setup, repeats, inner=1):
+    """
+    runs a case and returns its per call times in microseconds
+    """
+    run = setup()
+    prepare = None
+    if isinstance(run, tuple):
+        run, prepare = run
+
+    for i in range(WARMUP_CALLS):
+        if prepare is not None:
+            prepare()
+        run()
+
+    times = np.empty(repeats)
+    for i in range(repeats):
+        if prepare is not None:
+            prepare()
+        start = perf_counter_ns()
+        for j in range(inner):
+            run()
+        times[i] = (perf_counter_ns() - start) / inner / 1000
+    return times
+
+
+def summarize(times):
+    return {"samples": len(times), "mean_us": float(times.mean()), "p50_us": float(np.percentile(times, 50)),
+            "p99_us": float(np.percentile(times, 99)), "max_us": float(times.max())}
+
+
+# Kinematics
+
+@benchmarkCase("kinematics/ik_scalar")
+def ikScalar():
+    from calculateMotorAngle import calculateMotorAngle
+    return lambda: calculateMotorAngle(7.5, -4.2, 12.0)
+
+@benchmarkCase("kinematics/ik_batch_1000", repeats=200)
+def ikBatch():
+    from calculateMotorAngle import calculateMotorAngleBatch
+    rng = np.random.default_rng(0)
+    pitch, roll, z = rng.uniform(-15, 15, 1000), rng.uniform(-15, 15, 1000), rng.uniform(-30, 30, 1000)
+    return lambda: calculateMotorAngleBatch(pitch, roll, z)
+
+@benchmarkCase("kinematics/ik_tilt_scalar")
+def ikTiltScalar():
+    from calculateMotorAngle import calculateMotorAngleTilt
+    return lambda: calculateMotorAngleTilt(30.0, 8.7, 12.0)
+
+@benchmarkCase("kinematics/ik_table_lookup")
+def ikTable():
+    from servoAngleTable import ServoAngleTable
+    table = ServoAngleTable()
+    return lambda: table.lookup(7.5, -4.2, 12.0)
+
+@benchmarkCase("kinematics/rotation_matrix", inner=10)
+def rotationMatrix():
+    from calculateRotationMatrix import calculateRotationMatrix
+    return lambda: calculateRotationMatrix(7.5, -4.2)
+
+@benchmarkCase("kinematics/rotation_matrix_batch_1000", repeats=200)
+def rotationMatrixBatch():
+    from calculateRotationMatrix import calculateRotationMatrixBatch
+    rng = np.random.default_rng(0)
+    pitch, roll = rng.uniform(-15, 15, 1000), rng.uniform(-15, 15, 1000)
+    return lambda: calculateRotationMatrixBatch(pitch, roll)
+
+@benchmarkCase("kinematics/forward_kinematics_tracking")
+def forwardKinematicsTracking():
+    from calculateMotorAngle import calculateMotorAngleBatch
+    from forwardKinematics import PoseTracker
+    t = np.linspace(0, 20, 1000)
+    angles = calculateMotorAngleBatch(10 * np.sin(t), 10 * np.cos(t), 0)
+    tracker = PoseTracker()
+    step = iter(range(10**9))
+    return lambda: tracker.solve(angles[next(step) % len(angles)])
+
+@benchmarkCase("kinematics/workspace_saturate", inner=10)
+def workspaceSaturate():
+    from workspaceMap import WorkspaceMap
+    workspace = WorkspaceMap()
+    return lambda: workspace.saturate(40.0, -25.0, 10.0)
+
+
+# Vision, all on the sample frame in Ball balancer
+
+def _visionSetup():
+    import cv2 as cv
+    import Charuco_imaging as charuco
+    camMatrix, distMatrix = charuco.loadCalibration()
+    dictionary = cv.aruco.getPredefinedDictionary(charuco.ARUCO_DICT)
+    board = cv.aruco.CharucoBoard(charuco.SIZE, charuco.SQUARE_LENGTH, charuco.MARKER_LENGTH, dictionary)
+    frame = cv.imread(SAMPLE_IMAGE)
+    return cv, charuco, camMatrix, distMatrix, dictionary, board, frame
+
+def _warpedBoard():
+    """the sample frame warped top down like the pipeline does, no ball on it"""
+    cv, charuco, camMatrix, distMatrix, dictionary, board, frame = _visionSetup()
+    gray = charuco.sharpenImage(cv.undistort(frame, camMatrix, distMatrix))
+    found, warped = charuco.drawCorners(gray, dictionary, board, camMatrix, distMatrix)
+    return cv, warped.copy()
+
+def _warpedWithBall():
+    """the warped sample frame with a plain white disc drawn on it for the ball"""
+    cv, warped = _warpedBoard()
+    cv.circle(warped, BALL_POSITION, 15, 255, -1)
+    return warped
+
+@benchmarkCase("vision/undistort", repeats=200)
+def undistort():
+    cv, charuco, camMatrix, distMatrix, dictionary, board, frame = _visionSetup()
+    return lambda: cv.undistort(frame, camMatrix, distMatrix)
+
+@benchmarkCase("vision/sharpen_image", repeats=200)
+def sharpen():
+    cv, charuco, camMatrix, distMatrix, dictionary, board, frame = _visionSetup()
+    return lambda: charuco.sharpenImage(frame)
+
+@benchmarkCase("vision/draw_corners", repeats=100)
+def drawCorners():
+    cv, charuco, camMatrix, distMatrix, dictionary, board, frame = _visionSetup()
+    gray = charuco.sharpenImage(cv.undistort(frame, camMatrix, distMatrix))
+    return lambda: charuco.drawCorners(gray, dictionary, board, camMatrix, distMatrix)
+
+@benchmarkCase("vision/transform_perspective", repeats=200)
+def transformPerspective():
+    cv, charuco, camMatrix, distMatrix, dictionary, board, frame = _visionSetup()
+    gray = charuco.sharpenImage(cv.undistort(frame, camMatrix, distMatrix))
+    found, rvec, tvec = charuco.estimateBoardPose(gray, dictionary, board, camMatrix, distMatrix)
+    corners = charuco.projectBoardCorners(rvec, tvec, camMatrix, distMatrix)
+    return lambda: charuco.transformPerspective(gray, corners)
+
+def _packedYuyv():
+    """the sample frame as one packed YUYV camera frame (what the driver gives with CONVERT_RGB off)"""
+    cv, charuco, camMatrix, distMatrix, dictionary, board, frame = _visionSetup()
+    yuv = cv.cvtColor(frame, cv.COLOR_BGR2YUV)
+    packed = yuv[:, :, :2].copy()
+    packed[:, 1::2, 1] = yuv[:, 1::2, 2]
+    return cv, packed
+
+@benchmarkCase("vision/yuyv_luma_only", repeats=200)
+def yuyvLumaOnly():
+    # gray the way CameraCapture(gray=True) gets it
+    cv, packed = _packedYuyv()
+    return lambda: cv.cvtColor(packed, cv.COLOR_YUV2GRAY_YUY2)
+
+@benchmarkCase("vision/yuyv_to_bgr_to_gray", repeats=200)
+def yuyvToBgrToGray():
+    # gray the default way, the driver converting to BGR and then sharpenImage converting to gray
+    cv, packed = _packedYuyv()
+    return lambda: cv.cvtColor(cv.cvtColor(packed, cv.COLOR_YUV2BGR_YUY2), cv.COLOR_BGR2GRAY)
+
+def _checkBall(result, expected):
+    """the vision cases check the detector got the right answer, a fast wrong answer isn't worth timing"""
+    x, y, confidence = result
+    if expected is None and x is not None:
+        raise RuntimeError("ball found at (%.1f, %.1f) on the empty board" % (x, y))
+    if expected is not None and (x is None or abs(x - expected[0]) > 2 or abs(y - expected[1]) > 2):
+        raise RuntimeError("ball at %s not found, got %s" % (expected, result[:2]))
+
+@benchmarkCase("vision/ball_acquire", repeats=200)
+def ballAcquire():
+    from ballDetector import BallTracker
+    image = _warpedWithBall()
+    tracker = BallTracker()
+    _checkBall(tracker.detect(image), BALL_POSITION)
+    return (lambda: tracker.detect(image)), tracker.reset
+
+@benchmarkCase("vision/ball_track", repeats=500)
+def ballTrack():
+    from ballDetector import BallTracker
+    image = _warpedWithBall()
+    tracker = BallTracker()
+    _checkBall(tracker.detect(image), BALL_POSITION)
+    return lambda: tracker.detect(image)
+
+@benchmarkCase("vision/ball_acquire_no_ball", repeats=200)
+def ballAcquireNoBall():
+    # the empty board has to come back as a miss, every frame without the ball runs a full acquisition
+    from ballDetector import BallTracker
+    cv, image = _warpedBoard()
+    tracker = BallTracker()
+    _checkBall(tracker.detect(image), None)
+    return (lambda: tracker.detect(image)), tracker.reset
+
+@benchmarkCase("vision/pixel_to_mm", inner=10)
+def pixelToMm():
+    from interperalate_matrix import CalibrationMap
+    calibrationMap = CalibrationMap()
+    return lambda: calibrationMap.toMillimetres(240.5, 300.25)
+
+@benchmarkCase("vision/process_frame", repeats=100)
+def processFrame():
+    from homographyCache import HomographyCache
+    cv, charuco, camMatrix, distMatrix, dictionary, board, frame = _visionSetup()
+    cache = HomographyCache(dictionary, board, camMatrix, distMatrix)
+    return lambda: charuco.processFrame(frame, dictionary, board, camMatrix, distMatrix, cache)
+
+@benchmarkCase("vision/frame_processor", repeats=100)
+def frameProcessor():
+    from homographyCache import HomographyCache
+    from frameProcessor import FrameProcessor
+    cv, charuco, camMatrix, distMatrix, dictionary, board, frame = _visionSetup()
+    processor = FrameProcessor(camMatrix, distMatrix, dictionary, board, HomographyCache(dictionary, board, camMatrix, distMatrix))
+    return lambda: processor.process(frame)
+
+
+# End to end
+
+@benchmarkCase("loop/simulated_control_iteration")
+def simulatedControlIteration():
+    """
+    one iteration of the cameraControlLoopDemo control loop (camera data, estimator, PID, set_platform_angle)
+    against the simulator. The simulated physics between iterations isn't timed
+    """
+    from platformSimulator import Simulation, CONTROL_RATE, MAX_TILT
+    from ballEstimator import BallEstimator
+    from telemetry import TelemetryRecorder
+    from pidController import PIDBatch
+    simulation = Simulation(seed=0)
+    platform = simulation.platform
+    estimator = BallEstimator()
+    recorder = TelemetryRecorder(os.path.join(tempfile.gettempdir(), 'benchmark_telemetry.npy'), capacity=1000)
+    period = 1 / CONTROL_RATE
+    pid = PIDBatch([0.15, 0.15], 0, [0.08, 0.08], magnitudeLimit=MAX_TILT) # x and y together like cameraControlLoopDemo
+
+    def prepare():
+        simulation.advance(period)
+        if not simulation.ball.onPlate():
+            simulation.ball.position[:] = 0
+            simulation.ball.velocity[:] = 0
+
+    def iteration():
+        x, y, timestamp = simulation.camera.getCameraData()
+        if timestamp is not None:
+            estimator.update(timestamp, x, y)
+        estimate = estimator.estimate(simulation.time)
+        if estimate is None:
+            return
+        xPos, yPos, xVel, yVel = estimate
+        pitch, roll = pid.update((0, 0), (xPos, yPos), period, measurementRate = (xVel, yVel)).tolist()
+        platform.set_platform_tilt(direction = np.degrees(np.arctan2(roll, pitch)), magnitude = np.hypot(pitch, roll), z = 0)
+        recorder.record(timestamp = simulation.time, est_x = xPos, est_y = yPos, pitch = pitch, roll = roll, z = 0)
+
+    return iteration, prepare
+
+
+@benchmarkCase("loop/pid_batch_1000_both_axes", repeats=200)
+def pidBatch():
+    from pidController import PIDBatch
+    rng = np.random.default_rng(0)
+    gains = rng.uniform(0, 0.3, (1000, 3))
+    pid = PIDBatch(gains[:, 0:1], gains[:, 1:2], gains[:, 2:3])
+    measurements = rng.normal(0, 20, (1000, 2))
+    return lambda: pid.update(0, measurements, 0.02)
+
+@benchmarkCase("loop/set_platform_angle_fake_servos")
+def setPlatformAngleFakeServos():
+    """
+    PlatformController.set_platform_angle in non blocking mode with the angle table and workspace map, on the fake
+    servo backend (which models the PWM write time on the writer thread)
+    """
+    from PlatformController import PlatformController
+    from hardwareBackends import FakeServoBackend
+    from servoAngleTable import ServoAngleTable
+    from workspaceMap import WorkspaceMap
+    controller = PlatformController(angle_table = ServoAngleTable(), non_blocking = True, workspace = WorkspaceMap(),
+                                    backend = FakeServoBackend())
+    step = iter(range(10**9))
+    return lambda: controller.set_platform_angle(pitch = 10 * np.sin(next(step) / 50), roll = 5.0, z = 0)
+
+
+def runBenchmarks(nameFilter=None, repeats=None):
+    """
+    runs every case with nameFilter in its name, returns the results dict that gets saved as JSON
+    """
+    results = {"date": datetime.now().isoformat(timespec='seconds'), "machine": platform.node(),
+               "platform": platform.platform(), "python": platform.python_version(), "numpy": np.__version__,
+               "cases": {}}
+    try:
+        import cv2
+        results["opencv"] = cv2.__version__
+    except ImportError:
+        pass
+
+    for name, (setup, caseRepeats, inner) in CASES.items():
+        if nameFilter is not None and nameFilter not in name:
+            continue
+        try:
+            times = timeCase(setup, repeats or caseRepeats, inner)
+        except Exception as error:
+            # e.g. no OpenCV on this machine, skip the case instead of losing the whole run
+            print("%-45s skipped: %s" % (name, error))
+            continue
+        results["cases"][name] = summarize(times)
+        print("%-45s p50 %10.1f us   p99 %10.1f us   max %10.1f us" %
+              (name, results["cases"][name]["p50_us"], results["cases"][name]["p99_us"], results["cases"][name]["max_us"]))
+    return results
+
+
+def compareResults(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    returns a list of (case, stat, baseline us, current us) for every case whose p50 or p99 got slower than
+    the baseline by more than threshold (a fraction). Cases missing from either run are ignored
+    """
+    regressions = []
+    for name, result in current["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        for stat in ("p50_us", "p99_us"):
+            old = baseline["cases"][name][stat]
+            new = result[stat]
+            if new > old * (1 + threshold):
+                regressions.append((name, stat, old, new))
+    return regressions
+
+
+def saveResults(results, path=None):
+    if path is None:
+        path = os.path.join(BENCHMARK_DIR, datetime.now().strftime('benchmark_%Y%m%d_%H%M%S.json'))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="times the kinematics, vision and control loop code")
+    parser.add_argument("filter", nargs="?", help="only run cases with this in their name")
+    parser.add_argument("--repeats", type=int, help="timed samples per case (default depends on the case)")
+    parser.add_argument("--output", help="where to save the JSON results (default benchmarks/benchmark_<time>.json)")
+    parser.add_argument("--baseline", help="earlier results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="fraction a p50 or p99 can go up by before it counts as a slowdown (default 0.1)")
+    parser.add_argument("--list", action="store_true", help="list the cases and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        for name in CASES:
+            print(name)
+        sys.exit(0)
+
+    results = runBenchmarks(args.filter, args.repeats)
+    print("results saved to", saveResults(results, args.output))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compareResults(baseline, results, args.threshold)
+        for name, stat, old, new in regressions:
+            print("SLOWER: %s %s %.1f us -> %.1f us (+%.0f%%)" % (name, stat, old, new, (new / old - 1) * 100))
+        if regressions:
+            sys.exit(1)
+        print("no slowdowns beyond", args.threshold * 100, "% compared to", args.baseline)
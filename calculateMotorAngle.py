@@ -1,6 +1,6 @@
 import numpy as np
 from helperFuncs import *
-from calculateRotationMatrix import calculateRotationMatrix
+from calculateRotationMatrix import calculateRotationMatrix, calculateRotationMatrixBatch, calculateTiltRotationMatrixBatch
 
 # NOTE: for numpy np.matmul(A,B) is matrix multiplication A*B
 # NOTE: for numpy A.dot(b) where A is 3x3 and b is 3x1, does matrix-vector multiplication A*b
@@ -26,60 +26,256 @@ B1 = (B * np.array([cosd(0), sind(0), 0]))
 B2 = (B * np.array([cosd(120), sind(120), 0]))
 B3 = (B * np.array([cosd(240), sind(240), 0]))
 
-def calculateMotorAngle(pitch:float, roll:float, z:float) -> tuple[float,float,float]:
+# Stacked versions of the vectors above for the batch calculation, row i is leg i+1
+p_legs = np.array([p1, p2, p3])
+B_legs = np.array([B1, B2, B3])
+
+# Radial unit vectors, each servo arm swings in the vertical plane through its base vector
+u_legs = B_legs / B
+
+# Plain python copies for the scalar calculation, numpy is slow for lots of tiny calculations
+_LEGS = [(p_legs[i][0], p_legs[i][1], B_legs[i][0], B_legs[i][1], u_legs[i][0], u_legs[i][1]) for i in range(3)]
+
+
+class UnreachablePoseError(ValueError):
+    """
+    Raised when the platform can't get to a pose, leg is the leg (1, 2 or 3) that can't reach.
+    For a tilt (see calculateMotorAngleTilt) tilt is (direction, magnitude) and pitch and roll are the small angle
+    equivalents magnitude*cos(direction), magnitude*sin(direction)
+    """
+    def __init__(self, leg, pitch, roll, z, tilt=None):
+        self.leg = leg
+        self.pitch = pitch
+        self.roll = roll
+        self.z = z
+        self.tilt = tilt
+        if tilt is None:
+            super().__init__(f"leg {leg} can't reach pitch = {pitch}, roll = {roll}, z = {z}")
+        else:
+            super().__init__(f"leg {leg} can't reach tilt direction = {tilt[0]}, magnitude = {tilt[1]}, z = {z}")
+
+
+def calculateMotorAngle(pitch:float, roll:float, z:float, clamp:bool=False, angleLimits=None) -> tuple[float,float,float]:
     """ Calculates the 3 servo motor angles to achieve the desired platform position
     
     inputs:
     float pitch (Degrees) Rotation about the y-axis (right hand rule thumb pointing towards neg y :(  )
     float roll (Degrees) Rotation about the x-axis (right hand rule thumb pointing towards pos x)
     float z (mm) Delta height from h0
+    bool clamp If True an impossible pose is moved to the closest reachable pose on the way back to flat instead of raising
+    (min, max) angleLimits (Degrees) Servo range, with clamp a pose needing a servo outside it is clamped as well.
+                           None only clamps poses the legs can't reach at all
 
     returns:
     (psi1, psi2, psi3) (Degrees) The three motor angles {relative to the z-axis}
 
-    NOTE: Does approximations, should be very good up to about 20 degrees with values chosen
-    TODO: make it so if position is impossible it throws an exception instead of crashing
+    raises:
+    UnreachablePoseError if a leg can't reach the pose (and clamp is False)
+
+    NOTE: Exact for the geometry, no small angle approximations.
+    The arm tip A = B_i + a*(cos(psi)*u_i + sin(psi)*z_hat) has to be distance b from the platform point P_i.
+    With l = P_i - B_i that works out to (l.u_i)*cos(psi) + l_z*sin(psi) = (|l|^2 + a^2 - b^2) / (2a)
+    """
+    # Rotation matrix columns that get used, R = R_pitch * R_roll (see calculateRotationMatrix)
+    cp = cosd(pitch)
+    sp = sind(pitch)
+    cr = cosd(roll)
+    sr = sind(roll)
+
+    angles = _anglesFromRotation(cp, sp*sr, 0.0, cr, -sp, cp*sr, h_0 + z)
+    if clamp and (isinstance(angles, int) or not _inLimits(angles, angleLimits)):
+        return calculateMotorAngle(*clampToReachablePose(pitch, roll, z, angleLimits=angleLimits))
+    if isinstance(angles, int):
+        raise UnreachablePoseError(angles, pitch, roll, z)
+    return angles
+
+def _inLimits(angles, angleLimits):
+    """True if no angle is outside angleLimits (min, max), always True without limits"""
+    if angleLimits is None:
+        return True
+    return all(angleLimits[0] <= angle <= angleLimits[1] for angle in angles)
+
+def _anglesFromRotation(r00:float, r01:float, r10:float, r11:float, r20:float, r21:float, height:float):
+    """
+    servo angles for the platform rotated by R and at height, only the first two columns of R are needed
+    (the platform points have no z). returns (psi1, psi2, psi3), or the leg number (1, 2 or 3) that can't reach
     """
+    angles = []
+    for leg, (px, py, Bx, By, ux, uy) in enumerate(_LEGS):
+        # l vector (vector from bottom of motor arm to platform), l = T + R*p - B
+        lx = r00*px + r01*py - Bx
+        ly = r10*px + r11*py - By
+        lz = r20*px + r21*py + height
+
+        # component of l along the arm's swing direction, and the right hand side of the equation above
+        lu = lx*ux + ly*uy
+        k = (lx*lx + ly*ly + lz*lz + a**2 - b**2) / (2*a)
+        m = math.sqrt(lu*lu + lz*lz)
+        if m == 0 or abs(k) > m:
+            return leg + 1
 
-    T = np.array([0, 0, h_0]) + np.array([0, 0, z])
+        # psi represents the motor angle, angle between controlled arm and xy plane
+        angles.append(math.degrees(math.atan2(lz, lu) - math.acos(k / m)))
 
-    # Rotation matrix calculation to determine platform vectors
-    R = calculateRotationMatrix(pitch,roll)
-    P1 = (T + R.dot(p1))
-    P2 = (T + R.dot(p2))
-    P3 = (T + R.dot(p3))
+    return (angles[0], angles[1], angles[2])
 
-    # Calculating l vectors (vector from bottom of motor arm to platform)
-    l1 = (T + R.dot(p1) - B1)
-    l2 = (T + R.dot(p2) - B2)
-    l3 = (T + R.dot(p3) - B3)
+def calculateMotorAngleTilt(direction:float, magnitude:float, z:float, clamp:bool=False,
+                            angleLimits=None) -> tuple[float,float,float]:
+    """ Calculates the 3 servo motor angles to tilt the platform by magnitude towards direction
+    Same as calculateMotorAngle but the rotation is axis-angle (see calculateTiltRotationMatrix), so the steepest
+    slope of the plate is exactly along direction and magnitude steep, however big the tilt
+
+    inputs:
+    float direction (Degrees) Direction of the tilt, 0 is the same as pitch and 90 the same as roll
+    float magnitude (Degrees) Angle between the platform and the base
+    float z (mm) Delta height from h0
+    bool clamp If True an impossible pose is moved to the closest reachable pose on the way back to flat instead of raising
+    (min, max) angleLimits (Degrees) Servo range, same as for calculateMotorAngle
 
-    magl1sqrd = l1[0]**2 + l1[1]**2 + l1[2]**2
-    magl2sqrd = l2[0]**2 + l2[1]**2 + l2[2]**2
-    magl3sqrd = l3[0]**2 + l3[1]**2 + l3[2]**2
+    returns:
+    (psi1, psi2, psi3) (Degrees) The three motor angles {relative to the z-axis}
 
-    magl1 = math.sqrt(magl1sqrd)
-    magl2 = math.sqrt(magl2sqrd)
-    magl3 = math.sqrt(magl3sqrd)
+    raises:
+    UnreachablePoseError if a leg can't reach the pose (and clamp is False)
+    """
+    # Rodrigues formula for the axis (sin(direction), cos(direction), 0) written out, only the first two columns
+    kx = sind(direction)
+    ky = cosd(direction)
+    s = sind(magnitude)
+    c = cosd(magnitude)
+    t = 1 - c
 
-    # Calculating motor angle
-    # beta represents the angle between controlled arm and l vector
-    beta1 = math.degrees(math.acos( (-b**2+a**2+magl1sqrd) / (2*a*magl1) ))
-    beta2 = math.degrees(math.acos( (-b**2+a**2+magl2sqrd) / (2*a*magl2) ))
-    beta3 = math.degrees(math.acos( (-b**2+a**2+magl3sqrd) / (2*a*magl3) ))
+    angles = _anglesFromRotation(c + kx*kx*t, kx*ky*t, kx*ky*t, c + ky*ky*t, -ky*s, kx*s, h_0 + z)
+    if clamp and (isinstance(angles, int) or not _inLimits(angles, angleLimits)):
+        return calculateMotorAngleTilt(*clampToReachableTilt(direction, magnitude, z, angleLimits=angleLimits))
+    if isinstance(angles, int):
+        raise UnreachablePoseError(angles, magnitude*ky, magnitude*kx, z, tilt=(direction, magnitude))
+    return angles
 
-    # alpha represents the angle between the z-axis and the l vector
-    # pos means l in same direction as B vector, neg means l away from B vector
-    alpha1 = 90 - math.degrees(math.acos( np.dot(B1,l1) / (B*magl1) ))
-    alpha2 = 90 - math.degrees(math.acos( np.dot(B2,l2) / (B*magl2) ))
-    alpha3 = 90 - math.degrees(math.acos( np.dot(B3,l3) / (B*magl3) ))
+def calculateMotorAngleBatch(pitch, roll, z, raiseOnUnreachable=False) -> np.ndarray:
+    """ Vectorized version of calculateMotorAngle, calculates the servo angles for N poses in one pass
 
-    # % psi represents the motor angle, angle between controlled arm and xy plane
-    psi1 = 90 - (alpha1 + beta1)
-    psi2 = 90 - (alpha2 + beta2)
-    psi3 = 90 - (alpha3 + beta3)
+    inputs:
+    array pitch (Degrees) shape (N,), same convention as calculateMotorAngle
+    array roll (Degrees) shape (N,)
+    array z (mm) shape (N,), Delta height from h0
+    (scalars are broadcast against the arrays)
+    bool raiseOnUnreachable raise UnreachablePoseError for the first impossible pose instead of returning NaN
 
-    return (psi1, psi2, psi3)
+    returns:
+    np.ndarray of shape (N, 3), row i is (psi1, psi2, psi3) in Degrees for pose i. Impossible poses are NaN
+    """
+    pitch, roll, z = np.broadcast_arrays(np.asarray(pitch, dtype=float), np.asarray(roll, dtype=float), np.asarray(z, dtype=float))
+    pitch = pitch.ravel()
+    roll = roll.ravel()
+    z = z.ravel()
+
+    R = calculateRotationMatrixBatch(pitch, roll) # (N,3,3)
+    angles, reachable = _anglesFromRotationBatch(R, z)
+    if raiseOnUnreachable and not reachable.all():
+        pose, leg = np.argwhere(~reachable)[0]
+        raise UnreachablePoseError(leg + 1, pitch[pose], roll[pose], z[pose])
+    return angles
+
+def calculateMotorAngleTiltBatch(direction, magnitude, z, raiseOnUnreachable=False) -> np.ndarray:
+    """ Vectorized version of calculateMotorAngleTilt, calculates the servo angles for N tilts in one pass
+
+    inputs:
+    array direction (Degrees) shape (N,), same convention as calculateMotorAngleTilt
+    array magnitude (Degrees) shape (N,)
+    array z (mm) shape (N,), Delta height from h0
+    (scalars are broadcast against the arrays)
+    bool raiseOnUnreachable raise UnreachablePoseError for the first impossible pose instead of returning NaN
+
+    returns:
+    np.ndarray of shape (N, 3), row i is (psi1, psi2, psi3) in Degrees for pose i. Impossible poses are NaN
+    """
+    direction, magnitude, z = np.broadcast_arrays(np.asarray(direction, dtype=float), np.asarray(magnitude, dtype=float),
+                                                  np.asarray(z, dtype=float))
+    direction = direction.ravel()
+    magnitude = magnitude.ravel()
+    z = z.ravel()
+
+    angles, reachable = _anglesFromRotationBatch(calculateTiltRotationMatrixBatch(direction, magnitude), z)
+    if raiseOnUnreachable and not reachable.all():
+        pose, leg = np.argwhere(~reachable)[0]
+        raise UnreachablePoseError(leg + 1, magnitude[pose]*cosd(direction[pose]), magnitude[pose]*sind(direction[pose]),
+                                   z[pose], tilt=(direction[pose], magnitude[pose]))
+    return angles
+
+def _anglesFromRotationBatch(R, z):
+    """
+    servo angles for N platform rotations R (N,3,3) at heights z (N,).
+    returns the (N, 3) angles (NaN rows for impossible poses) and the (N, 3) reachable flag of each leg
+    """
+    # l[n, i] is the l vector of leg i for pose n -> (N,3,3)
+    l = np.einsum('njk,ik->nij', R, p_legs) - B_legs
+    l[:, :, 2] += h_0 + z[:, None]
+
+    lu = np.einsum('ik,nik->ni', u_legs, l)
+    lz = l[:, :, 2]
+    k = (np.einsum('nij,nij->ni', l, l) + a**2 - b**2) / (2*a)
+    m = np.sqrt(lu**2 + lz**2)
+
+    reachable = np.abs(k) <= m
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # if any leg can't reach a pose the whole pose is impossible
+        ratio = np.where(reachable.all(axis=1, keepdims=True), k / m, np.nan)
+    # psi represents the motor angle, angle between controlled arm and xy plane
+    return np.degrees(np.arctan2(lz, lu) - np.arccos(ratio)), reachable
+
+def isPoseReachable(pitch:float, roll:float, z:float) -> bool:
+    """True if all 3 legs can reach the pose"""
+    try:
+        calculateMotorAngle(pitch, roll, z)
+    except UnreachablePoseError:
+        return False
+    return True
+
+def clampToReachablePose(pitch:float, roll:float, z:float, steps:int=32, angleLimits=None) -> tuple[float,float,float]:
+    """
+    Returns the reachable pose closest to (pitch, roll, z) on the straight line back to flat at h0,
+    found by checking steps points along the line, then steps points between the last good and first bad one.
+    Reachable means the legs can get there, and with angleLimits (min, max) also that every servo stays in that range.
+    Without angleLimits the clamped pose can still need a servo past its limits
+    """
+    scale = _reachableScale(lambda scales: calculateMotorAngleBatch(pitch*scales, roll*scales, z*scales), steps,
+                            angleLimits)
+    if scale is None:
+        # flat isn't reachable either, nothing sensible to clamp to
+        raise UnreachablePoseError(0, pitch, roll, z)
+    return (pitch*scale, roll*scale, z*scale)
+
+def clampToReachableTilt(direction:float, magnitude:float, z:float, steps:int=32, angleLimits=None) -> tuple[float,float,float]:
+    """
+    Same as clampToReachablePose for a tilt, the direction stays the same and the magnitude and z are scaled back
+    """
+    scale = _reachableScale(lambda scales: calculateMotorAngleTiltBatch(direction, magnitude*scales, z*scales), steps,
+                            angleLimits)
+    if scale is None:
+        raise UnreachablePoseError(0, magnitude*cosd(direction), magnitude*sind(direction), z, tilt=(direction, magnitude))
+    return (direction, magnitude*scale, z*scale)
+
+def _reachableScale(anglesForScales, steps, angleLimits=None):
+    """
+    largest scale between 0 and 1 (to within 1/steps^2) where anglesForScales gives a reachable pose, None if even 0 isn't.
+    With angleLimits (min, max) poses with a servo outside them don't count as reachable
+    """
+    low, high = 0.0, 1.0
+    for i in range(2):
+        scales = np.linspace(low, high, steps)
+        angles = anglesForScales(scales)
+        reachable = ~np.isnan(angles).any(axis=1)
+        if angleLimits is not None:
+            with np.errstate(invalid='ignore'):
+                reachable &= ((angles >= angleLimits[0]) & (angles <= angleLimits[1])).all(axis=1)
+        if reachable.all():
+            return high
+        firstBad = int(np.argmin(reachable))
+        if firstBad == 0:
+            return None
+        low, high = scales[firstBad - 1], scales[firstBad]
+    return low
 
 if __name__ == "main":
     angles = calculateMotorAngle(-20,20,10)    
@@ -23,3 +23,85 @@ def calculateRotationMatrix(pitch:float, roll:float) -> np.ndarray:
     R = np.matmul(R_pitch, R_roll)
 
     return R
+
+
+def calculateRotationMatrixBatch(pitch, roll) -> np.ndarray:
+    """
+    Vectorized version of calculateRotationMatrix for many poses at once
+
+    inputs:
+    array pitch Angles of platform in degrees, shape (N,)
+    array roll Angles of platform in degrees, shape (N,)
+
+    output:
+    np.ndarray of shape (N, 3, 3), R[i] == calculateRotationMatrix(pitch[i], roll[i])
+    """
+    pitch = np.radians(np.asarray(pitch, dtype=float))
+    roll = np.radians(np.asarray(roll, dtype=float))
+    pitch, roll = np.broadcast_arrays(pitch, roll)
+    cp, sp = np.cos(pitch), np.sin(pitch)
+    cr, sr = np.cos(roll), np.sin(roll)
+
+    # R_pitch @ R_roll written out by hand so no (N,3,3) matmul is needed
+    R = np.empty(pitch.shape + (3, 3))
+    R[..., 0, 0] = cp
+    R[..., 0, 1] = sp*sr
+    R[..., 0, 2] = sp*cr
+    R[..., 1, 0] = 0
+    R[..., 1, 1] = cr
+    R[..., 1, 2] = -sr
+    R[..., 2, 0] = -sp
+    R[..., 2, 1] = cp*sr
+    R[..., 2, 2] = cp*cr
+
+    return R
+
+
+def calculateTiltRotationMatrix(direction:float, magnitude:float) -> np.ndarray:
+    """
+    Calculate the rotation matrix for tilting the platform by magnitude towards direction (axis-angle, Rodrigues formula)
+    Unlike pitch then roll, the tilt doesn't depend on the order of anything: the plate's steepest slope is always
+    along direction and is always magnitude steep. For small angles it is the same as pitch = magnitude*cos(direction),
+    roll = magnitude*sin(direction)
+
+    inputs:
+    float direction Direction of the tilt in degrees, 0 is pure pitch and 90 is pure roll
+    float magnitude Angle between the platform and the base in degrees
+
+    output:
+    np.ndarray of shape (3, 3), rotation by magnitude about the horizontal axis (sin(direction), cos(direction), 0)
+    """
+    return calculateTiltRotationMatrixBatch(direction, magnitude)
+
+
+def calculateTiltRotationMatrixBatch(direction, magnitude) -> np.ndarray:
+    """
+    Vectorized version of calculateTiltRotationMatrix for many tilts at once
+
+    inputs:
+    array direction Directions of the tilts in degrees, shape (N,)
+    array magnitude Angles of the tilts in degrees, shape (N,)
+
+    output:
+    np.ndarray of shape (N, 3, 3), R[i] == calculateTiltRotationMatrix(direction[i], magnitude[i])
+    """
+    direction = np.radians(np.asarray(direction, dtype=float))
+    magnitude = np.radians(np.asarray(magnitude, dtype=float))
+    direction, magnitude = np.broadcast_arrays(direction, magnitude)
+    kx, ky = np.sin(direction), np.cos(direction) # rotation axis, horizontal so kz = 0
+    s, c = np.sin(magnitude), np.cos(magnitude)
+    t = 1 - c
+
+    # I + sin*K + (1 - cos)*K^2 with K the cross product matrix of the axis, written out with kz = 0
+    R = np.empty(direction.shape + (3, 3))
+    R[..., 0, 0] = c + kx*kx*t
+    R[..., 0, 1] = kx*ky*t
+    R[..., 0, 2] = ky*s
+    R[..., 1, 0] = kx*ky*t
+    R[..., 1, 1] = c + ky*ky*t
+    R[..., 1, 2] = -kx*s
+    R[..., 2, 0] = -ky*s
+    R[..., 2, 1] = kx*s
+    R[..., 2, 2] = c
+
+    return R
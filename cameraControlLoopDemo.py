@@ -2,14 +2,30 @@
 
 # Import Things
 # TODO import camera function and platform motion function
-from time import time
-from PlatformController import PlatformController
+import os
+import sys
+import math
+from time import perf_counter
+from PlatformController import PlatformController, MIN_ANGLE, MAX_ANGLE
+from ballEstimator import BallEstimator
+from loopScheduler import LoopScheduler
+from servoAngleTable import ServoAngleTable
+from workspaceMap import WorkspaceMap
+from telemetry import TelemetryRecorder
+from pidController import PIDBatch
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Ball balancer'))
+from visionPipeline import VisionPipeline
 
 
 
 # DEFINE CONSTANTS
 desiredPosX = 100 #Units? TODO what should be for center?
 desiredPosY = 100
+CONTROL_RATE = 50 # Hz, how often the control loop runs
+CONTROL_CORE = 3 # cpu core the control loop gets to itself, the camera threads use the others
+USE_ANGLE_TABLES = False # look servo angles up in ServoAngleTables instead of solving them exactly. A little faster,
+                         # but interpolated (up to 0.33 degrees off inside the servo range, 2 or more past
+                         # it, see servoAngleTable), so off by default
 # PID Control Loop Parameters
 kPX = 1
 kPY = 1
@@ -20,49 +36,71 @@ kIY = 0
 
 # DEFINE VARIABLES
 running = True # Program stops when turned to False
-lastLoopTime = time()
-currentLoopTime = time()
+scheduler = LoopScheduler(CONTROL_RATE) # runs the loop at a fixed rate and keeps track of its timing
 timeSinceLastLoop = 0
-newXPos = None # Position for current run of loop
+newXPos = None # Filtered position for current run of loop
 newYPos = None
-lastXPos = None # Position from last run of loop
-lastYPos = None
 propXErr = 0 # Proportional Error only based on current position
 propYErr = 0
-lastPropXErr = 0 # Proportional Error from last run of loop for calculating derivative term
-lastPropYErr = 0
-derXErr = 0 # Derivative Error based on how fast error is changing
-derYErr = 0
-intXErr = 0 # Integral Error based on cumulative total of error # TODO - am I implementing this correctly?
-intYErr = 0
-correctionX = 0
-correctionY = 0
+velXEst = 0 # Ball velocity from the estimator
+velYEst = 0
+pipeline = None # VisionPipeline running the camera in the background
+estimator = BallEstimator() # Kalman filter smoothing the ball position and predicting it forward to when the servos move
+telemetry = None # TelemetryRecorder, one record per loop instead of printing (printing slows the loop down)
+pid = None # PID controllers for x and y together. The (x, y) correction is one tilt vector, its length is limited
+           # to the workspace tilt limit and the integrators stop growing while it is at that limit
+
+
+def getCameraData():
+    """
+    returns the newest ball position (x, y, timestamp) from the vision pipeline without waiting for the camera.
+    timestamp is the perf_counter() time the frame was captured.
+    returns (None, None, None) if there is no new frame since the last call, x and y are None if the ball wasn't found
+    """
+    measurement = pipeline.latest()
+    if measurement is None:
+        return None, None, None
+    return measurement.x, measurement.y, measurement.timestamp
 
 if __name__ == "__main__":
-    p = PlatformController()
-    print("Starting Main Loop")
+    p = PlatformController(angle_table = ServoAngleTable() if USE_ANGLE_TABLES else None, non_blocking = True,
+                           tilt_table = ServoAngleTable(tiltVector = True) if USE_ANGLE_TABLES else None,
+                           workspace = WorkspaceMap(MIN_ANGLE, MAX_ANGLE)) # corrections past the workspace edge get saturated onto it
+    workspace = p.workspace
+    tiltLimit = min(workspace.maxTilt(direction, 0) for direction in (0, 90, 180, 270)) # furthest it can tilt each way at z = 0
+    pid = PIDBatch([kPX, kPY], [kIX, kIY], [kDX, kDY], outputLimits = (-tiltLimit, tiltLimit), magnitudeLimit = tiltLimit)
+    pipeline = VisionPipeline(tilt_source = p.get_platform_tilt).start()
+    scheduler.makeRealtime(core = CONTROL_CORE) # after starting the camera threads so they don't get pinned too
+    telemetry = TelemetryRecorder()
+    print("Starting Main Loop, recording telemetry to", telemetry.path)
     while running == True: 
         # This is the loop that runs every 'frame'
 
         # SET UP FOR NEW RUN OF LOOP
-        lastLoopTime = currentLoopTime
-        currentLoopTime = time()
-        timeSinceLastLoop = currentLoopTime - lastLoopTime
-        lastXPos = newXPos
-        lastYPos = newYPos
-        lastPropXErr = propXErr
-        lastPropYErr = propYErr
+        timeSinceLastLoop = scheduler.waitForNextTick() # waits until it is time for this run of the loop
+        loopStartTime = perf_counter()
 
 
         
         # GET CAMERA DATA
-        newXPos, newYPos = getCameraData()
-        if newXPos == None:
-            # This means the camera did not manage to identify the ball position this frame
-            # Assume ball moving at constant velocity from last frame
-            # TODO - deal with case where it returns None (didn't detect ball), also if ball goess off maybe if doesn't detect for some amount of time just stop
-            newXPos = lastXPos
-            newYPos = lastYPos
+        measuredXPos, measuredYPos, measuredTime = getCameraData()
+        senseDoneTime = perf_counter()
+        if measuredTime is not None:
+            estimator.update(measuredTime, measuredXPos, measuredYPos)
+
+        # Filtered position and velocity, predicted forward to when this loop's command reaches the platform
+        # If the camera misses the ball the estimator keeps going assuming constant velocity, for a limited time
+        estimate = estimator.estimate(perf_counter())
+        estimateDoneTime = perf_counter()
+        if estimate is None:
+            # Ball not seen for too long (or not yet), level the platform and wait for it
+            pid.reset()
+            p.set_platform_angle(pitch = 0, roll = 0, z = 0)
+            telemetry.record(timestamp = loopStartTime, pitch = 0, roll = 0, z = 0, servo_angles = p.servo_angles,
+                             loop_dt = timeSinceLastLoop, sense_time = senseDoneTime - loopStartTime,
+                             estimate_time = estimateDoneTime - senseDoneTime, actuate_time = perf_counter() - estimateDoneTime)
+            continue
+        newXPos, newYPos, velXEst, velYEst = estimate
 
 
 
@@ -70,20 +108,33 @@ if __name__ == "__main__":
         propXErr = newXPos - desiredPosX # Positive means newXPos is too positive
         propYErr = newYPos - desiredPosY
 
-        derXErr = (propXErr - lastPropXErr)/timeSinceLastLoop # Positive means propXErr increasing
-        derYErr = (propYErr - lastPropYErr)/timeSinceLastLoop
-
-        intXErr += propXErr * timeSinceLastLoop # Positive means propXErr is staying too positive
-        intYErr += propYErr * timeSinceLastLoop
-
-        correctionX = (propXErr * kPX) + (derXErr * kDX) + (intXErr * kIX)
-        correctionY = (propYErr * kPY) + (derYErr * kDY) + (intYErr * kIY)
+        # desired position doesn't move so the derivative is how fast the ball moves, the estimator already has that
+        correctionX, correctionY = pid.update((desiredPosX, desiredPosY), (newXPos, newYPos), timeSinceLastLoop,
+                                              measurementRate = (velXEst, velYEst)).tolist()
+        controlDoneTime = perf_counter()
         
 
 
         # MOVE MOTORS
-        # Note - right now pitch and roll proportional to correction, from small angle approximation angle should be roughly proportional to force which should be proportional to correction
-        p.set_platform_angle(pitch = correctionX, roll = correctionY, z = 0)
+        # The correction is a vector, tilt the plate so its steepest slope points along it. Unlike setting pitch and roll
+        # separately the x correction doesn't change how much the y correction tilts (and the other way round)
+        p.set_platform_tilt(direction = math.degrees(math.atan2(correctionY, correctionX)),
+                            magnitude = math.hypot(correctionX, correctionY), z = 0)
+        actuateDoneTime = perf_counter()
+
+
+
+        # RECORD TELEMETRY
+        telemetry.record(timestamp = loopStartTime, ball_x = measuredXPos, ball_y = measuredYPos,
+                         est_x = newXPos, est_y = newYPos, vel_x = velXEst, vel_y = velYEst,
+                         error_x = propXErr, error_y = propYErr,
+                         p_x = pid.p[0], i_x = pid.i[0], d_x = pid.d[0],
+                         p_y = pid.p[1], i_y = pid.i[1], d_y = pid.d[1],
+                         pitch = p.pitch, roll = p.roll, z = p.z, servo_angles = p.servo_angles,
+                         loop_dt = timeSinceLastLoop,
+                         frame_age = None if measuredTime is None else loopStartTime - measuredTime,
+                         sense_time = senseDoneTime - loopStartTime, estimate_time = estimateDoneTime - senseDoneTime,
+                         control_time = controlDoneTime - estimateDoneTime, actuate_time = actuateDoneTime - controlDoneTime)
 
 
 
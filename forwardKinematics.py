@@ -0,0 +1,175 @@
+# Forward kinematics, goes from the 3 servo angles back to the platform pose (pitch, roll, z)
+# There's no closed form for this platform, so it's solved with Newton's method on calculateMotorAngleBatch.
+# Seeded from the previous solution, consecutive poses only take one or two iterations
+
+import numpy as np
+from calculateMotorAngle import calculateMotorAngleBatch
+
+TOLERANCE = 1e-6 # degrees, largest servo angle error accepted as a solution
+MAX_ITERATIONS = 20
+JACOBIAN_STEP = 1e-5 # degrees or mm, finite difference step for the jacobian
+MAX_STEP_HALVINGS = 6 # how many times in a row a Newton step is halved when it lands on an impossible pose
+
+
+class ForwardKinematicsError(ValueError):
+    """
+    Raised when no pose gives the servo angles (or Newton's method couldn't find it)
+    """
+    def __init__(self, servoAngles):
+        self.servoAngles = servoAngles
+        super().__init__(f"no platform pose found for servo angles {tuple(servoAngles)}")
+
+
+def _newton(targets, poses, tolerance=TOLERANCE, maxIterations=MAX_ITERATIONS):
+    """
+    Newton iterations for N poses at once, only the poses that haven't converged are worked on.
+    targets - (N, 3) servo angles, poses - (N, 3) starting (pitch, roll, z), changed in place
+    returns (converged (N,) bool, Newton steps taken by the slowest pose)
+    """
+    n = len(poses)
+    converged = np.zeros(n, dtype=bool)
+    lastStep = np.zeros((n, 3))
+    halvings = np.zeros(n, dtype=int)
+    offsets = np.vstack((np.zeros(3), np.eye(3) * JACOBIAN_STEP)) # the pose and the 3 nudged poses for the jacobian
+
+    active = np.arange(n)
+    for iteration in range(maxIterations + 1):
+        # residual and finite difference jacobian in one batch call, 4 poses per active pose
+        nudged = (poses[active, None, :] + offsets).reshape(-1, 3)
+        angles = calculateMotorAngleBatch(nudged[:, 0], nudged[:, 1], nudged[:, 2]).reshape(-1, 4, 3)
+        residual = angles[:, 0] - targets[active]
+
+        # a step that landed on an impossible pose is halved and tried again, one that can't be fixed gives up
+        bad = np.isnan(angles).any(axis=(1, 2))
+        retry = bad & (halvings[active] < MAX_STEP_HALVINGS) & lastStep[active].any(axis=1)
+        if retry.any():
+            rows = active[retry]
+            lastStep[rows] /= 2
+            poses[rows] += lastStep[rows]
+            halvings[rows] += 1
+        done = ~bad & (np.abs(residual).max(axis=1) < tolerance)
+        converged[active[done]] = True
+        step = ~bad & ~done
+        active = np.concatenate((active[step], active[retry]))
+        if len(active) == 0 or iteration == maxIterations:
+            return converged, iteration
+        rows = active[:step.sum()]
+        if len(rows) == 0:
+            continue
+
+        jacobian = ((angles[step, 1:] - angles[step, :1]) / JACOBIAN_STEP).transpose(0, 2, 1)
+        try:
+            newtonStep = np.linalg.solve(jacobian, residual[step][:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            # a singular jacobian somewhere, fall back to least squares pose by pose
+            newtonStep = np.array([np.linalg.lstsq(J, r, rcond=None)[0] for J, r in zip(jacobian, residual[step])])
+        poses[rows] -= newtonStep
+        lastStep[rows] = newtonStep
+        halvings[rows] = 0
+
+
+def forwardKinematicsBatch(servoAngles, initialPoses=None, tolerance=TOLERANCE, maxIterations=MAX_ITERATIONS) -> np.ndarray:
+    """ Finds the platform poses for N sets of servo angles
+
+    inputs:
+    array servoAngles (Degrees) shape (N, 3), row i is (psi1, psi2, psi3) like calculateMotorAngle returns
+    array initialPoses shape (N, 3) or (3,), starting (pitch, roll, z) guesses. Defaults to flat
+    float tolerance (Degrees) largest servo angle error accepted
+
+    returns:
+    np.ndarray of shape (N, 3), row i is (pitch, roll, z) for servo angles i. NaN where no pose was found
+    """
+    targets = np.atleast_2d(np.asarray(servoAngles, dtype=float))
+    if initialPoses is None:
+        poses = np.zeros(targets.shape)
+    else:
+        poses = np.array(np.broadcast_to(np.asarray(initialPoses, dtype=float), targets.shape))
+    converged, iterations = _newton(targets, poses, tolerance, maxIterations)
+    poses[~converged] = np.nan
+    return poses
+
+
+def forwardKinematics(servoAngles, initialPose=(0, 0, 0)) -> tuple[float, float, float]:
+    """ Finds the platform pose for one set of servo angles
+
+    inputs:
+    (psi1, psi2, psi3) (Degrees) the servo angles
+    (pitch, roll, z) initialPose starting guess, the closer the fewer iterations
+
+    returns:
+    (pitch, roll, z) (Degrees, Degrees, mm)
+
+    raises:
+    ForwardKinematicsError if no pose was found
+    """
+    pose = forwardKinematicsBatch(servoAngles, initialPose)[0]
+    if np.isnan(pose).any():
+        raise ForwardKinematicsError(servoAngles)
+    return (float(pose[0]), float(pose[1]), float(pose[2]))
+
+
+class PoseTracker():
+    """
+    Forward kinematics for a stream of servo angles, each solve starts from the last solution (warm start).
+    Asking again for the same angles costs nothing
+    """
+    def __init__(self, initialPose=(0, 0, 0), tolerance=TOLERANCE):
+        self.tolerance = tolerance
+        self.pose = np.array(initialPose, dtype=float)
+        self.servoAngles = None # angles self.pose is the solution for
+        self.solves = 0
+        self.cacheHits = 0
+        self.iterations = 0 # total over all solves
+        self.coldStarts = 0 # solves where the warm start failed and it had to start again from flat
+
+    def solve(self, servoAngles):
+        """
+        returns (pitch, roll, z) for the servo angles, raises ForwardKinematicsError if there is no pose
+        """
+        servoAngles = np.asarray(servoAngles, dtype=float)
+        if self.servoAngles is not None and np.array_equal(servoAngles, self.servoAngles):
+            self.cacheHits += 1
+            return (float(self.pose[0]), float(self.pose[1]), float(self.pose[2]))
+
+        targets = servoAngles.reshape(1, 3)
+        poses = self.pose.reshape(1, 3).copy()
+        converged, iterations = _newton(targets, poses, self.tolerance)
+        self.iterations += iterations
+        if not converged[0]:
+            self.coldStarts += 1
+            poses = np.zeros((1, 3))
+            converged, iterations = _newton(targets, poses, self.tolerance)
+            self.iterations += iterations
+            if not converged[0]:
+                raise ForwardKinematicsError(servoAngles)
+
+        self.solves += 1
+        self.pose = poses[0]
+        self.servoAngles = servoAngles.copy()
+        return (float(self.pose[0]), float(self.pose[1]), float(self.pose[2]))
+
+    def stats(self):
+        return {"solves": self.solves, "cache_hits": self.cacheHits, "cold_starts": self.coldStarts,
+                "mean_iterations": self.iterations / max(self.solves, 1)}
+
+
+if __name__ == "__main__":
+    from time import perf_counter
+    from calculateMotorAngle import calculateMotorAngle
+
+    pose = (8, -5, 10)
+    angles = calculateMotorAngle(*pose)
+    print("pose", pose, "-> angles", angles, "-> pose", forwardKinematics(angles))
+
+    # a slowly moving pose, like the platform following the control loop
+    t = np.linspace(0, 2, 200)
+    poses = np.column_stack((10 * np.sin(3 * t), 10 * np.cos(2 * t), 5 * np.sin(t)))
+    angleList = calculateMotorAngleBatch(poses[:, 0], poses[:, 1], poses[:, 2])
+    tracker = PoseTracker()
+    startTime = perf_counter()
+    solved = np.array([tracker.solve(angle) for angle in angleList])
+    print("tracked", len(poses), "poses in", perf_counter() - startTime, "s, worst error", np.abs(solved - poses).max(), tracker.stats())
+
+    startTime = perf_counter()
+    solved = forwardKinematicsBatch(angleList)
+    print("batch of", len(poses), "from flat in", perf_counter() - startTime, "s, worst error", np.nanmax(np.abs(solved - poses)))
@@ -0,0 +1,236 @@
+# Hardware backends for the servos and the joystick ADC
+# PlatformController and Joystick talk to one of these instead of gpiozero/smbus directly, so the same code runs
+# on the pi (pigpio backends), on any computer (fake backends) or while logging every write (recording backends).
+# The hardware libraries are only imported when a real backend is created, importing this file doesn't need them
+# Pick the backend with the PLATFORM_BACKEND environment variable ("pigpio" or "fake"), defaults to pigpio
+
+import os
+from time import sleep, perf_counter
+import numpy as np
+
+# Servos, (pin, min pulse width, max pulse width) for servo 1, 2, 3. Pulse widths are from calibrationHelper.py
+SERVO_1_PIN = 16
+SERVO_2_PIN = 13
+SERVO_3_PIN = 12
+SERVO_SETTINGS = ((SERVO_1_PIN, 0.00036, 0.00227),
+                  (SERVO_2_PIN, 0.00036, 0.00227),
+                  (SERVO_3_PIN, 0.00050, 0.00224))
+
+# Joystick, PCF8591 ADC on i2c plus a push button on a GPIO pin
+ADC_ADDRESS = 0x48
+ADC_BUS = 1
+ADC_COMMAND = 0x40 # analog output enabled, add the channel number to read a channel
+ADC_AUTO_INCREMENT = 0x04 # added to the command, the ADC moves to the next channel after each byte read
+ADC_CHANNELS = 4
+JOYSTICK_BUTTON_PIN = 24
+
+# Fake backends, roughly what the real ones cost so loop rate benchmarks mean something on a build machine
+FAKE_SERVO_WRITE_LATENCY = 0.0003 # s per servo, setting an angle through gpiozero and the pigpio daemon
+FAKE_ADC_READ_LATENCY = 0.0002 # s per i2c transaction at 100kHz
+
+BACKEND_ENVIRONMENT_VARIABLE = "PLATFORM_BACKEND"
+
+
+class PigpioServoBackend():
+    """
+    The real servos, driven with gpiozero AngularServo through the pigpio daemon (hardware timed PWM)
+    """
+    def __init__(self, servoSettings=SERVO_SETTINGS):
+        from gpiozero import AngularServo
+        from gpiozero.pins.pigpio import PiGPIOFactory
+
+        factory = PiGPIOFactory()
+        self.servos = [AngularServo(pin, initial_angle = 0, pin_factory=factory, min_angle =-90, max_angle = 90,
+                                    min_pulse_width = minPulse, max_pulse_width = maxPulse)
+                       for pin, minPulse, maxPulse in servoSettings]
+
+    def setAngles(self, angles):
+        """sets servo 1, 2 and 3 to the angles (degrees)"""
+        for servo, angle in zip(self.servos, angles):
+            servo.angle = angle
+
+    def close(self):
+        for servo in self.servos:
+            servo.close()
+
+
+class FakeServoBackend():
+    """
+    Pretend servos for running without a pi. Each write takes writeLatency per servo (sleeping, like waiting on the
+    pigpio daemon does) and the last angles are kept so they can be checked
+    """
+    def __init__(self, writeLatency=FAKE_SERVO_WRITE_LATENCY):
+        self.writeLatency = writeLatency
+        self.angles = (0.0, 0.0, 0.0)
+        self.writes = 0
+        self.closed = False
+
+    def setAngles(self, angles):
+        if self.writeLatency > 0:
+            sleep(self.writeLatency * len(angles))
+        self.angles = tuple(angles)
+        self.writes += 1
+
+    def close(self):
+        self.closed = True
+
+
+class RecordingServoBackend():
+    """
+    Passes writes on to another backend and keeps every write with its time, for checking what the servos were sent
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.log = [] # (perf_counter time, angle 1, angle 2, angle 3)
+
+    def setAngles(self, angles):
+        self.log.append((perf_counter(),) + tuple(angles))
+        self.backend.setAngles(angles)
+
+    def history(self):
+        """returns the writes as an (N, 4) array of time, angle 1, angle 2, angle 3"""
+        return np.array(self.log, dtype=float).reshape(-1, 4)
+
+    def save(self, path):
+        np.save(path, self.history())
+
+    def close(self):
+        self.backend.close()
+
+
+class Pcf8591AdcBackend():
+    """
+    The joystick: both axes on a PCF8591 ADC over i2c, and the push button on a GPIO pin (pulled up, low when pushed)
+    """
+    def __init__(self, address=ADC_ADDRESS, busNumber=ADC_BUS, buttonPin=JOYSTICK_BUTTON_PIN):
+        import smbus
+        import RPi.GPIO as GPIO
+
+        self.address = address
+        self.bus = smbus.SMBus(busNumber)
+        self.GPIO = GPIO
+        self.buttonPin = buttonPin
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(buttonPin, GPIO.IN, GPIO.PUD_UP)
+
+    def readChannel(self, channel):
+        """returns the 0-255 reading of an ADC channel"""
+        self.bus.write_byte(self.address, ADC_COMMAND + channel)
+        return self.bus.read_byte(self.address)
+
+    def readChannels(self):
+        """
+        returns the readings of all 4 channels from one i2c transaction using the ADC's auto increment mode.
+        The first byte back is the conversion from before the command, so one extra byte is read and thrown away
+        """
+        data = self.bus.read_i2c_block_data(self.address, ADC_COMMAND + ADC_AUTO_INCREMENT, ADC_CHANNELS + 1)
+        return data[1:]
+
+    def buttonPushed(self):
+        return self.GPIO.input(self.buttonPin) == 0
+
+    def close(self):
+        self.bus.close()
+        self.GPIO.cleanup(self.buttonPin)
+
+
+class FakeAdcBackend():
+    """
+    Pretend joystick. Set channels (list of 0-255 readings) and button directly, or give a function of time
+    that returns (channels, button) to script the input. Each read takes readLatency
+    """
+    def __init__(self, channels=(128, 128, 0, 0), button=False, script=None, readLatency=FAKE_ADC_READ_LATENCY):
+        self.channels = list(channels)
+        self.button = button
+        self.script = script
+        self.readLatency = readLatency
+        self.reads = 0
+        self._startTime = perf_counter()
+
+    def _update(self):
+        if self.script is not None:
+            channels, self.button = self.script(perf_counter() - self._startTime)
+            self.channels = list(channels)
+
+    def readChannel(self, channel):
+        if self.readLatency > 0:
+            sleep(self.readLatency)
+        self._update()
+        self.reads += 1
+        return self.channels[channel]
+
+    def readChannels(self):
+        """all channels for the cost of one read, like the real block read"""
+        if self.readLatency > 0:
+            sleep(self.readLatency)
+        self._update()
+        self.reads += 1
+        return list(self.channels)
+
+    def buttonPushed(self):
+        self._update()
+        return self.button
+
+    def close(self):
+        pass
+
+
+class RecordingAdcBackend():
+    """
+    Passes reads on to another ADC backend and keeps every reading with its time
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.log = [] # (perf_counter time, channel, value), channel -1 is the button
+
+    def readChannel(self, channel):
+        value = self.backend.readChannel(channel)
+        self.log.append((perf_counter(), channel, value))
+        return value
+
+    def readChannels(self):
+        values = self.backend.readChannels()
+        now = perf_counter()
+        for channel, value in enumerate(values):
+            self.log.append((now, channel, value))
+        return values
+
+    def buttonPushed(self):
+        pushed = self.backend.buttonPushed()
+        self.log.append((perf_counter(), -1, int(pushed)))
+        return pushed
+
+    def history(self):
+        """returns the reads as an (N, 3) array of time, channel, value"""
+        return np.array(self.log, dtype=float).reshape(-1, 3)
+
+    def close(self):
+        self.backend.close()
+
+
+def backendName():
+    return os.environ.get(BACKEND_ENVIRONMENT_VARIABLE, "pigpio")
+
+
+def createServoBackend(name=None):
+    """
+    returns a servo backend, name is "pigpio" or "fake" (defaults to the PLATFORM_BACKEND environment variable)
+    """
+    name = name or backendName()
+    if name == "pigpio":
+        return PigpioServoBackend()
+    if name == "fake":
+        return FakeServoBackend()
+    raise ValueError(f"unknown servo backend {name!r}, use 'pigpio' or 'fake'")
+
+
+def createAdcBackend(name=None):
+    """
+    returns a joystick ADC backend, name is "pigpio" (the real PCF8591) or "fake"
+    """
+    name = name or backendName()
+    if name == "pigpio":
+        return Pcf8591AdcBackend()
+    if name == "fake":
+        return FakeAdcBackend()
+    raise ValueError(f"unknown ADC backend {name!r}, use 'pigpio' or 'fake'")
@@ -8,4 +8,11 @@ def cosd(deg:float):
 
 def sind(deg:float):
     """Take sin of angle in degrees"""
-    return math.sin(math.radians(deg))
\ No newline at end of file
+    return math.sin(math.radians(deg))
+
+VERBOSE = False # set True to get the debug prints from inside the control loops. Printing on the pi slows the loops down a lot, use telemetry.py instead
+
+def debugPrint(*args):
+    """print, but only when VERBOSE is True"""
+    if VERBOSE:
+        print(*args)
@@ -1,33 +1,136 @@
+# Joystick on the PCF8591 ADC (both axes) with a push button, read through a backend from hardwareBackends.py
+# JoystickReader polls it in a background thread so control loops only ever read the latest sample.
+# Run this file on its own to print the readings and move the platform with the Y axis
 
+import threading
+from time import perf_counter, sleep
+from hardwareBackends import createAdcBackend
+from loopScheduler import LoopScheduler
 
-import RPi.GPIO as GPIO
-import smbus
-import time
-from platformCode import PlatformController
-
-address = 0x48
-bus = smbus.SMBus(1)
-cmd = 0x40
-
-Z_pin = 24
-
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(Z_pin, GPIO.IN, GPIO.PUD_UP)
-
-def analogRead (chn):
-    bus.write_byte(address, cmd+chn)
-    value = bus.read_byte(address)
-    return value
-def analogWrite(value):
-    bus.write_byte_data(address, cmd, value)
-    
-p = PlatformController()
-    
-while True:
-    val_Z = GPIO.input(Z_pin)
-    val_Y = analogRead(0)
-    val_X = analogRead(1)
-    print("Click: %d, Y: %d, X: %d" % (val_Z, val_Y, val_X))
-    
-    p.set_platform_angle(0,20*val_Y/130-20, 30)
-    
\ No newline at end of file
+X_CHANNEL = 1
+Y_CHANNEL = 0
+
+POLL_RATE = 200 # Hz, how often JoystickReader reads the ADC
+
+
+class Joystick():
+    def __init__(self, backend=None):
+        """
+        backend - ADC backend from hardwareBackends.py, defaults to createAdcBackend() (the real ADC unless the
+                  PLATFORM_BACKEND environment variable says "fake")
+        """
+        self.backend = backend if backend is not None else createAdcBackend()
+
+    def analogRead(self, chn):
+        return self.backend.readChannel(chn)
+
+    def isZPushed(self):
+        """True while the joystick is pushed in"""
+        return self.backend.buttonPushed()
+
+    def getJoystickPosition(self):
+        """returns the (x, y) readings, 0 to 255 with about 128 in the middle. Both come from one block read"""
+        channels = self.backend.readChannels()
+        return (channels[X_CHANNEL], channels[Y_CHANNEL])
+
+    def close(self):
+        self.backend.close()
+
+
+class JoystickSample():
+    """
+    One joystick reading. x and y are 0 to 255 (smoothed if the reader smooths), timestamp is perf_counter()
+    """
+    __slots__ = ("x", "y", "button", "timestamp")
+
+    def __init__(self, x, y, button, timestamp):
+        self.x = x
+        self.y = y
+        self.button = button
+        self.timestamp = timestamp
+
+
+class JoystickReader():
+    """
+    Reads the joystick in a background thread at a fixed rate. latest() never touches the i2c bus, it returns
+    the newest JoystickSample (replacing one attribute is atomic, so there is no lock for the control loop to wait on)
+    """
+    def __init__(self, joystick=None, rate=POLL_RATE, smoothing=0.0):
+        """
+        joystick - Joystick to read, makes one with the default backend if not given
+        rate - polls per second
+        smoothing - 0 for raw readings, up to nearly 1 for heavy smoothing (exponential moving average,
+                    each new reading counts for 1 - smoothing)
+        """
+        self.joystick = joystick if joystick is not None else Joystick()
+        self.rate = rate
+        self.smoothing = smoothing
+        self.samples = 0
+        self.errors = 0 # failed reads, e.g. i2c glitches. The last good sample is kept
+        self._latest = None
+        self._running = False
+        self._thread = None
+        self._scheduler = None
+
+    def start(self):
+        self._running = True
+        self._scheduler = LoopScheduler(self.rate, spinTimeNs = 0) # no busy waiting, it would hold up the main loop
+        self._thread = threading.Thread(target=self._run, name="JoystickReader", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        x = y = None
+        while self._running:
+            self._scheduler.waitForNextTick()
+            try:
+                newX, newY = self.joystick.getJoystickPosition()
+                button = self.joystick.isZPushed()
+            except OSError:
+                self.errors += 1
+                continue
+            if x is None or self.smoothing == 0:
+                x, y = newX, newY
+            else:
+                x += (1 - self.smoothing) * (newX - x)
+                y += (1 - self.smoothing) * (newY - y)
+            self._latest = JoystickSample(x, y, button, perf_counter())
+            self.samples += 1
+
+    def latest(self):
+        """returns the newest JoystickSample, or None before the first read. Never blocks"""
+        return self._latest
+
+    def waitForFirstSample(self, timeout=1.0):
+        """blocks until there is a sample (at startup), returns False if none came within timeout"""
+        startTime = perf_counter()
+        while self._latest is None and perf_counter() - startTime < timeout:
+            sleep(1 / self.rate)
+        return self._latest is not None
+
+    def stats(self):
+        return {"samples": self.samples, "errors": self.errors, "poll timing": self._scheduler.stats()}
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        self.joystick.close()
+
+
+if __name__ == "__main__":
+    from PlatformController import PlatformController
+
+    j = Joystick()
+    p = PlatformController()
+
+    while True:
+        val_Z = j.isZPushed()
+        val_X, val_Y = j.getJoystickPosition()
+        print("Click: %d, Y: %d, X: %d" % (val_Z, val_Y, val_X))
+
+        p.set_platform_angle(0,20*val_Y/130-20, 30)
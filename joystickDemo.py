@@ -1,60 +1,71 @@
 # Demo to show off joystick control. Balance a ball using the joystick!
 # joystick controls pitch and roll, pushing the joystick makes it jump
 
-from time import time, sleep
-import math
-from platformCode import PlatformController
-from joystick import Joystick
+from time import time, sleep, perf_counter
+from PlatformController import PlatformController
+from joystick import JoystickReader
+from loopScheduler import LoopScheduler
+from telemetry import TelemetryRecorder, loadTelemetry, summarizeTelemetry
+from helperFuncs import debugPrint
 
 MAX_INPUT_RANGE = 250
 MAX_ANGLE = 5
+LOOP_RATE = 50 # Hz
+JOYSTICK_SMOOTHING = 0.3 # 0 is raw joystick readings, closer to 1 is smoother but laggier
 
-p = PlatformController()
-j = Joystick()
+p = PlatformController(non_blocking = True)
+j = JoystickReader(smoothing = JOYSTICK_SMOOTHING).start() # reads the joystick in the background so the loop never waits on i2c
 
 print("Starting Test!")
 p.set_platform_angle(pitch = 0, roll = 0, z = 0)
+j.waitForFirstSample()
 sleep(1)
 startTime = time()
+scheduler = LoopScheduler(LOOP_RATE)
+telemetry = TelemetryRecorder() # timing of each loop, instead of adding up timers by hand
 
 i=0
 
 
 
-# TEMP - measuring some time stuff
-joystickInputTime = 0
-settingMotorTime = 0
-
-tempJoystickTime = 0
-tempMotorTime = 0
-
-
-
 while time() < startTime+10:
-    tempJoystickTime = time()
-    val_Z = j.isZPushed()
-    (xInput, yInput) = j.getJoystickPosition()
-    joystickInputTime += time() - tempJoystickTime
-    #print("Click: %d, Y: %d, X: %d" % (val_Z, xInput, yInput))
+    loopTime = scheduler.waitForNextTick()
+    loopStartTime = perf_counter()
+    sample = j.latest()
+    if sample is None:
+        continue # no joystick reading yet
+    val_Z = sample.button
+    (xInput, yInput) = (sample.x, sample.y)
+    joystickDoneTime = perf_counter()
+    debugPrint("Click:", val_Z, "Y:", xInput, "X:", yInput)
     
     roll = ((xInput / MAX_INPUT_RANGE)-0.5) *MAX_ANGLE*2
     pitch = -((yInput / MAX_INPUT_RANGE)-0.5) *MAX_ANGLE*2
     
-    #print("pitch = ", pitch, "roll = ", roll)
+    debugPrint("pitch = ", pitch, "roll = ", roll)
     
     if val_Z:
-        height = 0
+        height = 25 # pushing the joystick in makes it jump
     else:
-        height = 25
+        height = 0
     
-    tempMotorTime = time()
+    controlDoneTime = perf_counter()
     p.set_platform_angle(pitch = pitch, roll = roll, z = height)
-    settingMotorTime += time() - tempJoystickTime
-    #print(time() - startTime)
+    telemetry.record(timestamp = loopStartTime, pitch = pitch, roll = roll, z = height, servo_angles = p.servo_angles,
+                     loop_dt = loopTime, sense_time = joystickDoneTime - loopStartTime,
+                     control_time = controlDoneTime - joystickDoneTime, actuate_time = perf_counter() - controlDoneTime)
     i+=1
-    print(i)
+    debugPrint(i)
     
 
+telemetry.close()
+j.close()
 print(i)
 print("num loops per second = ", i/10)
-print("number of miliseconds per loop = ", 1/(i/10) * 1000)
\ No newline at end of file
+print("number of miliseconds per loop = ", 1/(i/10) * 1000)
+print("loop timing = ", scheduler.stats())
+print("servo commands = ", p.servo_writer.stats())
+print("joystick = ", j.stats())
+print("loop stages = ", summarizeTelemetry(loadTelemetry(telemetry.path)))
+print("telemetry saved to", telemetry.path)
+p.cleanup()
\ No newline at end of file
@@ -0,0 +1,135 @@
+# Runs a loop at a fixed rate using absolute deadlines on a monotonic clock
+# Each iteration sleeps until its deadline instead of "sleep(period)" so timing errors don't add up,
+# and every iteration's timing is kept in a ring buffer so jitter and overruns can be checked afterwards
+
+import os
+from time import perf_counter_ns, sleep
+import numpy as np
+
+DEFAULT_RATE = 50 # Hz, matches the servo PWM period
+SPIN_TIME_NS = 500_000 # sleep() can overshoot, so the last half millisecond before a deadline is busy waited
+REALTIME_PRIORITY = 50 # SCHED_FIFO priority used when realtime is requested
+
+
+class LoopScheduler():
+    """
+    Fixed rate loop timing. Either call waitForNextTick() at the top of an existing while loop,
+    or hand a function to run().
+
+    For every iteration the ring buffer records
+    - jitter: how late the loop woke up after its deadline (ns)
+    - work time: how long the loop body took, from waking up until it asked to wait again (ns)
+    """
+    def __init__(self, rate=DEFAULT_RATE, historySize=1000, realtime=False, core=None, spinTimeNs=SPIN_TIME_NS):
+        """
+        rate - loop frequency (Hz)
+        historySize - number of iterations kept in the ring buffer
+        realtime - on Linux, try to run with SCHED_FIFO priority (needs root or CAP_SYS_NICE)
+        core - on Linux, pin the calling thread to this cpu core
+        spinTimeNs - how long before each deadline to stop sleeping and busy wait. Use 0 for background threads,
+                     busy waiting holds the GIL and would delay the main loop
+        """
+        self.rate = rate
+        self.spinTimeNs = spinTimeNs
+        self.periodNs = int(round(1e9 / rate))
+        self.jitterNs = np.zeros(historySize, dtype=np.int64)
+        self.workTimeNs = np.zeros(historySize, dtype=np.int64)
+        self.iterations = 0
+        self.overruns = 0 # iterations whose deadline had already passed when the body finished
+        self.worstJitterNs = 0
+        self.worstWorkTimeNs = 0
+
+        self._nextDeadline = None
+        self._lastWake = None
+        self._running = False
+
+        if core is not None or realtime:
+            self.makeRealtime(core, realtime)
+
+    def makeRealtime(self, core=None, realtime=True):
+        """
+        pins the calling thread to a core and/or raises it to realtime priority. Prints and carries on if not allowed.
+        Threads started afterwards inherit this, so call it after starting any worker threads
+        """
+        if core is not None and hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(0, {core})
+            except OSError as error:
+                print("Could not pin loop to core", core, ":", error)
+        if realtime and hasattr(os, "sched_setscheduler"):
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(REALTIME_PRIORITY))
+            except OSError as error:
+                print("Could not set realtime priority (try running as root):", error)
+
+    def waitForNextTick(self):
+        """
+        sleeps until the next deadline and returns the time since the previous tick in seconds.
+        The first call starts the schedule and returns the nominal period
+        """
+        now = perf_counter_ns()
+        if self._nextDeadline is None:
+            self._nextDeadline = now
+            self._lastWake = now - self.periodNs
+        else:
+            workTime = now - self._lastWake
+            index = self.iterations % len(self.workTimeNs)
+            self.workTimeNs[index] = workTime
+            self.worstWorkTimeNs = max(self.worstWorkTimeNs, workTime)
+            self.iterations += 1
+
+            self._nextDeadline += self.periodNs
+            if now > self._nextDeadline:
+                # body took longer than a period, skip the missed deadlines instead of running a burst to catch up
+                self.overruns += 1
+                missed = (now - self._nextDeadline) // self.periodNs + 1
+                self._nextDeadline += missed * self.periodNs
+
+        remaining = self._nextDeadline - perf_counter_ns()
+        if remaining > self.spinTimeNs:
+            sleep((remaining - self.spinTimeNs) / 1e9)
+        while perf_counter_ns() < self._nextDeadline:
+            pass
+
+        wake = perf_counter_ns()
+        jitter = wake - self._nextDeadline
+        self.jitterNs[self.iterations % len(self.jitterNs)] = jitter
+        self.worstJitterNs = max(self.worstJitterNs, jitter)
+
+        dt = (wake - self._lastWake) / 1e9
+        self._lastWake = wake
+        return dt
+
+    def run(self, callback, duration=None):
+        """
+        calls callback(dt) once per period until stop() is called, callback returns False,
+        or duration seconds have passed
+        """
+        self._running = True
+        elapsed = 0
+        while self._running:
+            dt = self.waitForNextTick()
+            elapsed += dt
+            if callback(dt) is False:
+                break
+            if duration is not None and elapsed >= duration:
+                break
+        self._running = False
+
+    def stop(self):
+        self._running = False
+
+    def stats(self):
+        """
+        returns jitter and work time percentiles (ms) over the ring buffer plus the all time worst cases and overrun count
+        """
+        count = min(self.iterations, len(self.jitterNs))
+        jitter = self.jitterNs[:count] / 1e6
+        workTime = self.workTimeNs[:count] / 1e6
+        if count == 0:
+            jitter = workTime = np.zeros(1)
+        return {"iterations": self.iterations, "overruns": self.overruns, "period_ms": self.periodNs / 1e6,
+                "jitter_p50_ms": float(np.percentile(jitter, 50)), "jitter_p99_ms": float(np.percentile(jitter, 99)),
+                "jitter_max_ms": self.worstJitterNs / 1e6,
+                "work_p50_ms": float(np.percentile(workTime, 50)), "work_p99_ms": float(np.percentile(workTime, 99)),
+                "work_max_ms": self.worstWorkTimeNs / 1e6}
@@ -0,0 +1,159 @@
+# PID controller for the ball position, one axis per PID
+# The error is measurement - setpoint, like in cameraControlLoopDemo: a ball too far positive gives a positive output
+# (tilt). The output is limited to the tilt the platform can actually do, and the integral stops growing while the
+# output is stuck at that limit (anti-windup) so it doesn't overshoot once the ball comes back.
+# The derivative is taken from the measurement instead of the error so moving the setpoint doesn't kick the platform,
+# and goes through a first order low pass filter because differencing noisy camera positions amplifies the noise.
+# PIDBatch does the same thing for N controllers at once on numpy arrays, for gain sweeps in the simulator. It can also
+# limit the length of a vector of outputs (the x and y tilt together) instead of each output on its own, so the
+# anti-windup sees the saturation the platform actually has
+
+import numpy as np
+
+DEFAULT_OUTPUT_LIMIT = 15 # degrees, +- tilt
+DERIVATIVE_FILTER_TIME = 0.02 # s, time constant of the derivative low pass filter
+
+
+class PID():
+    """
+    One PID controller. update() returns the output and keeps the last p, i and d terms (already multiplied by
+    their gains) for telemetry
+    """
+    __slots__ = ('kP', 'kI', 'kD', 'outputMin', 'outputMax', 'derivativeFilterTime',
+                 'integral', 'derivative', 'lastMeasurement', 'output', 'p', 'i', 'd')
+
+    def __init__(self, kP, kI=0.0, kD=0.0, outputLimits=(-DEFAULT_OUTPUT_LIMIT, DEFAULT_OUTPUT_LIMIT),
+                 derivativeFilterTime=DERIVATIVE_FILTER_TIME):
+        """
+        kP, kI, kD - gains (output per unit error, per unit error s, per unit/s)
+        outputLimits - (min, max) output, normally the platform tilt limits
+        derivativeFilterTime - time constant (s) of the derivative filter, 0 for no filtering
+        """
+        self.kP = kP
+        self.kI = kI
+        self.kD = kD
+        self.outputMin, self.outputMax = outputLimits
+        self.derivativeFilterTime = derivativeFilterTime
+        self.reset()
+
+    def reset(self):
+        """forgets the integral and derivative, for when the ball is lost"""
+        self.integral = 0.0
+        self.derivative = 0.0
+        self.lastMeasurement = None
+        self.output = 0.0
+        self.p = 0.0
+        self.i = 0.0
+        self.d = 0.0
+
+    def update(self, setpoint, measurement, dt, measurementRate=None):
+        """
+        returns the output for a new measurement, dt (s) is the time since the last update.
+        measurementRate - how fast the measurement is changing if it is already known (like the estimator's velocity),
+                          used as is instead of the filtered difference of measurements
+        A dt of 0 or less (first loop, clock problems) leaves the integral and derivative as they were
+        """
+        error = measurement - setpoint
+
+        if measurementRate is not None:
+            self.derivative = measurementRate
+        elif dt > 0 and self.lastMeasurement is not None:
+            rawDerivative = (measurement - self.lastMeasurement) / dt
+            self.derivative += dt / (self.derivativeFilterTime + dt) * (rawDerivative - self.derivative)
+        self.lastMeasurement = measurement
+
+        self.p = self.kP * error
+        self.d = self.kD * self.derivative
+        if dt > 0 and self.kI != 0:
+            # conditional integration: only integrate if it doesn't push an output that is already at its limit
+            # further past it
+            integral = self.integral + error * dt
+            unlimited = self.p + self.kI * integral + self.d
+            if not ((unlimited > self.outputMax and error * self.kI > 0) or
+                    (unlimited < self.outputMin and error * self.kI < 0)):
+                self.integral = integral
+        self.i = self.kI * self.integral
+
+        self.output = min(max(self.p + self.i + self.d, self.outputMin), self.outputMax)
+        return self.output
+
+
+class PIDBatch():
+    """
+    N PID controllers stepped together, same behaviour as PID. Gains can be arrays (one per controller) and
+    everything broadcasts, e.g. gains of shape (N, 1) with measurements of shape (N, 2) runs N controllers on
+    both axes. The state arrays get their shape from the first update.
+    With magnitudeLimit the last axis is one vector (e.g. x and y): its length is limited, keeping its direction,
+    and integration is held while it is at that limit and integrating would make it longer
+    """
+    def __init__(self, kP, kI=0.0, kD=0.0, outputLimits=(-DEFAULT_OUTPUT_LIMIT, DEFAULT_OUTPUT_LIMIT),
+                 derivativeFilterTime=DERIVATIVE_FILTER_TIME, magnitudeLimit=None):
+        self.magnitudeLimit = magnitudeLimit
+        self.kP = np.asarray(kP, dtype=float)
+        self.kI = np.asarray(kI, dtype=float)
+        self.kD = np.asarray(kD, dtype=float)
+        self.outputMin, self.outputMax = outputLimits
+        self.derivativeFilterTime = derivativeFilterTime
+        self.reset()
+
+    def reset(self, which=None):
+        """forgets the integral and derivative, of every controller or only where the boolean array which is True"""
+        if which is None or self.integral is None:
+            self.integral = None
+            self.derivative = None
+            self.lastMeasurement = None
+            self.output = None
+            self.p = self.i = self.d = None
+            return
+        self.integral[which] = 0
+        self.derivative[which] = 0
+        self.lastMeasurement[which] = np.nan
+
+    def update(self, setpoint, measurement, dt, measurementRate=None):
+        """
+        returns the outputs for new measurements, dt is one time step for all of them.
+        NaN measurements (ball not seen) hold that controller's integral and derivative and output its last output
+        """
+        measurement = np.asarray(measurement, dtype=float)
+        error = measurement - setpoint
+        if self.integral is None:
+            shape = np.broadcast(error, self.kP, self.kI, self.kD).shape
+            self.integral = np.zeros(shape)
+            self.derivative = np.zeros(shape)
+            self.lastMeasurement = np.full(shape, np.nan)
+            self.output = np.zeros(shape)
+        seen = ~np.isnan(error)
+        error = np.where(seen, error, 0.0)
+
+        if measurementRate is not None:
+            self.derivative = np.where(seen, measurementRate, self.derivative)
+        elif dt > 0:
+            rawDerivative = (measurement - self.lastMeasurement) / dt
+            filtered = self.derivative + dt / (self.derivativeFilterTime + dt) * (rawDerivative - self.derivative)
+            self.derivative = np.where(np.isnan(rawDerivative), self.derivative, filtered)
+        self.lastMeasurement = np.where(seen, measurement, self.lastMeasurement)
+
+        p = self.kP * error
+        d = self.kD * self.derivative
+        if dt > 0:
+            integral = self.integral + error * dt
+            unlimited = p + self.kI * integral + d
+            if self.magnitudeLimit is None:
+                windingUp = ((unlimited > self.outputMax) & (error * self.kI > 0)) | \
+                            ((unlimited < self.outputMin) & (error * self.kI < 0))
+            else:
+                length = np.linalg.norm(unlimited, axis=-1, keepdims=True)
+                lengthBefore = np.linalg.norm(p + self.kI * self.integral + d, axis=-1, keepdims=True)
+                windingUp = (length > self.magnitudeLimit) & (length > lengthBefore)
+            self.integral = np.where(seen & ~windingUp, integral, self.integral)
+
+        self.p = p
+        self.i = self.kI * self.integral
+        self.d = d
+        output = p + self.i + d
+        if self.magnitudeLimit is not None:
+            length = np.linalg.norm(output, axis=-1, keepdims=True)
+            output = output * np.minimum(1.0, self.magnitudeLimit / np.maximum(length, 1e-12))
+        output = np.clip(output, self.outputMin, self.outputMax)
+        self.output = np.where(seen, output, self.output)
+        return self.output
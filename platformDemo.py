@@ -1,149 +1,63 @@
 # This is a demo script to run on the pi to move the platform around and demo how nicely it moves
+# The whole demo is worked out before it starts (trajectory.py): every behaviour is a path over time, the servo angles
+# for all of it are solved in one go, then played back at the servo update rate
 
-from time import time, sleep
 import math
-# from PlatformController import PlatformController
-
-# DEFINE VARIABLES
-running = True # Program stops when turned to False
-programStartTime = time()
-behaviourStartTime = time()
-behaviourRunTime = 0
-lastLoopTime = time()
-currentLoopTime = time()
-timeSinceLastLoop = 0
-
-setPitch = 0
-setRoll = 0
-setZ = 0
-
-behaviour = 0
-
+from time import perf_counter
+from trajectory import Sequence, Waypoints, Hold, Circle, Lissajous, solveProfile, playProfile, PROFILE_RATE
+from workspaceMap import WorkspaceMap
+from PlatformController import PlatformController, MIN_ANGLE, MAX_ANGLE
 
 # BEHAVIOUR SETTINGS
 # Behaviour 0
-behaviour0WaitTime = 5
-
-def goToNextBehaviour():
-    # Move to next behaviour and reset some variables
-    behaviour += 1
-    behaviourStartTime = time()
-    behaviourRunTime = 0
-    currentLoopTime = behaviourStartTime
-    lastLoopTime = behaviourStartTime
-    print("Starting new behaviour, behaviour =", behaviour)
-
-class PlatformControllerTEST():
-    def __init__(self) -> None:
-        pass
-
-    def set_platform_angle(a,b,c):
-        pass
+behaviour0WaitTime = 5 # s at each tilt
+behaviour0MoveTime = 0.5 # s to move between tilts
+PAUSE_TIME = 5 # s flat between behaviours
 
-    def clean_up():
-        pass
 
-print("helloooooo")
-print(__name__)
+def behaviour0():
+    # does at z = 0 then higher z position. At each height go flat, then tilt each direction
+    tilts = [(0, 0), (0, 10), (10, 0), (0, -10), (-10, 0)]
+    poses = [(pitch, roll, z) for z in (0, 50) for pitch, roll in tilts] + [(0, 0, 0)]
+    waitTimes = [behaviour0WaitTime] * (len(poses) - 1) + [10]
+    return Waypoints(poses, moveTime=behaviour0MoveTime, holdTime=waitTimes)
 
-if __name__ == "__main__":
-    print("Starting Main Loop")
-    p = PlatformControllerTEST()
-    while running == True: 
-        # This is the loop that runs every 'frame'
-
-        # SET UP FOR NEW RUN OF LOOP (not each behaviour uses all of these)
-        lastLoopTime = currentLoopTime
-        currentLoopTime = time()
-        timeSinceLastLoop = currentLoopTime - lastLoopTime
-        behaviourRunTime += timeSinceLastLoop
-        
-        print("new loop run, behaviour has been running for", behaviourRunTime, "s")
-
-        # DECIDE HOW IT SHOULD MOVE, GOES THROUGH BEHAVIOURS
-        if behaviour == 0:
-            # does at z = 0 then higher z position. At each height go flat, then tilt each direction
-            print("Starting behaviour 0, test basic angles at 2 different heights")
-            setZ = 0
-            for i in range(2):
-                setPitch = 0
-                setR = 0
-                p.set_platform_angle(pitch = setPitch, roll = setRoll, z = setZ)
-                sleep(behaviour0WaitTime)
-
-                setRoll = 10
-                p.set_platform_angle(pitch = setPitch, roll = setRoll, z = setZ)
-                sleep(behaviour0WaitTime)
-                
-                setRoll = 0
-                setPitch = 10
-                p.set_platform_angle(pitch = setPitch, roll = setRoll, z = setZ)
-                sleep(behaviour0WaitTime)
-                
-                setRoll = -10
-                setPitch = 0
-                p.set_platform_angle(pitch = setPitch, roll = setRoll, z = setZ)
-                sleep(behaviour0WaitTime)
-                
-                setRoll = 0
-                setPitch = -10
-                p.set_platform_angle(pitch = setPitch, roll = setRoll, z = setZ)
-                sleep(behaviour0WaitTime)
-                
-                if i == 0:
-                    setZ = 50
-            
-            setRoll = 0
-            setPitch = 0
-            setZ = 0
-            p.set_platform_angle(pitch = setPitch, roll = setRoll, z = setZ)
-            sleep(10)
-            goToNextBehaviour()
-        elif behaviour == 1:
-            # Do smooth angle movement at 10 degrees in circle at z = 0, current period is 2pi seconds (about 6seconds pe cycle)
-            print("Starting behaviour 1, smooth circle movement")
-            setRoll = 10*math.sin(behaviourRunTime)
-            setPitch = 10*math.cos(behaviourRunTime)
-            setZ = 0
 
-            if behaviourRunTime > 20:
-                sleep(5)
-                goToNextBehaviour()
-        elif behaviour == 2:
-            # Do smooth vertical movement at constant flat angle
-            print("Starting behaviour 2, smooth vertical movement")
-            setRoll = 0
-            setPitch = 0
-            setZ = 50*math.sin(behaviourRunTime)
-            if (currentLoopTime - behaviourStartTime) > 10:
-                sleep(5)
-                goToNextBehaviour()
-        elif behaviour == 3:
-            setRoll = 10*math.sin(behaviourRunTime*2*math.pi/3) # period of 3s
-            setPitch = 10*math.cos(behaviourRunTime*2*math.pi/3) # period of 3s
-            setZ = 50*math.sin(behaviourRunTime*2*math.pi/10) # period of 10s 
-            if (currentLoopTime - behaviourStartTime) > 30:
-                sleep(5)
-                goToNextBehaviour()
-        elif behaviour == 4:
-            p.cleanup()
-            running = False
+def behaviour1():
+    # Do smooth angle movement at 10 degrees in circle at z = 0, current period is 2pi seconds (about 6seconds pe cycle)
+    return Circle(10, 2*math.pi, 20)
 
 
-        # MOVE MOTORS
-        p.set_platform_angle(pitch = setPitch, roll = setRoll, z = setZ)
+def behaviour2():
+    # Do smooth vertical movement at constant flat angle
+    return Lissajous((0, 0, 50), (0, 0, 2*math.pi), 10)
 
 
+def behaviour3():
+    # circle with a period of 3s while going up and down with a period of 10s
+    return Lissajous((10, 10, 50), (3, 3, 10), 30, phases=(math.pi/2, 0, 0))
 
 
+def demoTrajectory():
+    behaviours = [behaviour0(), behaviour1(), behaviour2(), behaviour3()]
+    parts = []
+    for behaviour in behaviours:
+        parts += [behaviour, Hold((0, 0, 0), PAUSE_TIME)]
+    return Sequence(parts)
 
 
-
-#TEMP - code for behaviour 4
-        
-
-stabDistFromCenter = 5
-stabAngle = 0
-if (currentLoopTime - behaviourStartTime) > 30:
-    sleep(5)
-    goToNextBehaviour()
\ No newline at end of file
+if __name__ == "__main__":
+    print("Solving demo")
+    startTime = perf_counter()
+    # poses the platform can't reach (the bottom of behaviour 3) get moved onto the edge of the workspace
+    profile = solveProfile(demoTrajectory(), PROFILE_RATE, workspace=WorkspaceMap(MIN_ANGLE, MAX_ANGLE))
+    print("Solved", profile.duration, "s of movement in", perf_counter() - startTime, "s,",
+          profile.limitedSamples, "samples slowed down to the servo limits")
+
+    p = PlatformController(non_blocking=True) # run with PLATFORM_BACKEND=fake to try it without the pi
+    print("Starting demo")
+    try:
+        scheduler = playProfile(profile, p)
+        print("Loop timing", scheduler.stats())
+    finally:
+        p.cleanup()
@@ -0,0 +1,398 @@
+# Headless simulation of the ball on the platform, for trying out controllers without the hardware
+# Uses the real platform geometry from calculateMotorAngle, models the servos (latency and slew rate)
+# and the camera (frame rate, latency and noise), and runs as fast as the computer can go.
+# SimulatedPlatformController has the same methods as PlatformController so it can be dropped in for it
+
+import math
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from calculateMotorAngle import calculateMotorAngle, calculateMotorAngleBatch, calculateMotorAngleTiltBatch
+from helperFuncs import cosd, sind
+from calculateRotationMatrix import calculateRotationMatrix, calculateRotationMatrixBatch
+from forwardKinematics import PoseTracker
+from ballEstimator import BallEstimator
+from PlatformController import MIN_ANGLE, MAX_ANGLE
+from pidController import PIDBatch
+
+# Physics
+GRAVITY = 9810 # mm/s^2
+ROLLING_FACTOR = 5/7 # a solid ball rolling without slipping accelerates at 5/7 of a sliding one
+ROLLING_DAMPING = 0.1 # 1/s, rolling resistance
+PLATE_HALF_WIDTH = 96 # mm, the ball falls off past this (8 squares of 24mm)
+PHYSICS_DT = 0.002 # s
+
+# Servos
+SERVO_LATENCY = 0.02 # s, from set_servos until the servo starts moving
+SERVO_SLEW_RATE = 400 # degrees/s
+POSE_TOLERANCE = 1e-3 # degrees, servo angle error allowed when working out the platform pose from the servos
+TILT_SLEW_RATE = SERVO_SLEW_RATE / 1.16 # degrees/s, the servos move about 1.16 degrees per degree of tilt near flat
+
+# Camera
+CAMERA_RATE = 30 # frames per second
+CAMERA_LATENCY = 0.05 # s, from the frame being taken until the measurement is available
+CAMERA_NOISE = 0.5 # mm, standard deviation of the measured position
+
+# Controller used for the gain sweeps
+CONTROL_RATE = 50 # Hz
+MAX_TILT = 15 # degrees
+SETTLE_RADIUS = 5 # mm, the ball counts as settled once it stays this close to the centre
+RECHECK_COUNT = 20 # best gain sets from the simplified batch model that sweepGainsBatch re-runs on the full simulation
+
+
+class SimulatedPlatformController():
+    """
+    Stand in for PlatformController that moves a simulated platform instead of real servos.
+    Time only moves forward when step() is called, so nothing here ever sleeps
+    """
+    def __init__(self, servoLatency=SERVO_LATENCY, servoSlewRate=SERVO_SLEW_RATE):
+        self.servoLatency = servoLatency
+        self.servoSlewRate = servoSlewRate
+        self.time = 0.0
+
+        # last pose sent to set_platform_angle, same as PlatformController
+        self.pitch = 0
+        self.roll = 0
+        self.z = 0
+
+        self.servoAngles = np.array(calculateMotorAngle(0, 0, 0)) # where the servos actually are
+        self.targetAngles = self.servoAngles.copy()
+        self._pendingCommands = [] # (time it takes effect, angles)
+
+        # actual platform pose worked out from the actual servo angles
+        self.pose = np.zeros(3) # pitch, roll, z
+        self.poseTracker = PoseTracker(tolerance=POSE_TOLERANCE)
+        self.rotation = calculateRotationMatrix(0, 0)
+        self.rejectedCommands = 0
+
+    def set_platform_angle(self, pitch, roll, z):
+        angles = calculateMotorAngleBatch(pitch, roll, z)[0]
+        if self.set_servos(angles):
+            self.pitch = pitch
+            self.roll = roll
+            self.z = z
+
+    def set_platform_tilt(self, direction, magnitude, z):
+        angles = calculateMotorAngleTiltBatch(direction, magnitude, z)[0]
+        if self.set_servos(angles):
+            self.pitch = magnitude * cosd(direction)
+            self.roll = magnitude * sind(direction)
+            self.z = z
+
+    def set_servos(self, servo_angles):
+        """
+        queues the servo angles to take effect after the servo latency. Out of range commands are ignored
+        like the real controller does, returns False for those
+        """
+        servo_angles = np.asarray(servo_angles, dtype=float)
+        if np.isnan(servo_angles).any() or (servo_angles < MIN_ANGLE).any() or (servo_angles > MAX_ANGLE).any():
+            self.rejectedCommands += 1
+            return False
+        self._pendingCommands.append((self.time + self.servoLatency, servo_angles))
+        return True
+
+    def get_commanded_tilt(self):
+        return (self.pitch, self.roll)
+
+    def get_platform_pose(self):
+        """
+        returns the (pitch, roll, z) worked out from where the simulated servos actually are (forward kinematics,
+        same as PlatformController). Lags the commanded pose while the servos are still getting there
+        """
+        pitch, roll, z = self.pose.tolist()
+        return (pitch, roll, z)
+
+    def get_platform_tilt(self):
+        """
+        returns the (pitch, roll) part of get_platform_pose, for the vision pipeline's tilt_source
+        """
+        pitch, roll, z = self.get_platform_pose()
+        return (pitch, roll)
+
+    def cleanup(self):
+        pass
+
+    def step(self, dt):
+        """
+        moves the servos forward dt seconds and updates the platform pose
+        """
+        self.time += dt
+        while self._pendingCommands and self._pendingCommands[0][0] <= self.time:
+            self.targetAngles = self._pendingCommands.pop(0)[1]
+
+        difference = self.targetAngles - self.servoAngles
+        if not difference.any():
+            return
+        maxMove = self.servoSlewRate * dt
+        self.servoAngles = self.servoAngles + np.clip(difference, -maxMove, maxMove)
+        self._updatePose()
+
+    def _updatePose(self):
+        """
+        finds the pose that gives the current servo angles, warm started from the last pose
+        """
+        self.pose = np.array(self.poseTracker.solve(self.servoAngles))
+        self.rotation = calculateRotationMatrix(self.pose[0], self.pose[1])
+
+
+class SimulatedBall():
+    """
+    Ball rolling on the plate, position and velocity in plate coordinates (mm, mm/s) with (0, 0) at the centre
+    """
+    def __init__(self, position=(0, 0), velocity=(0, 0)):
+        self.position = np.array(position, dtype=float)
+        self.velocity = np.array(velocity, dtype=float)
+
+    def step(self, dt, rotation):
+        # gravity in plate coordinates, the part along the plate makes the ball roll
+        gravity = rotation.T.dot((0, 0, -GRAVITY))
+        acceleration = ROLLING_FACTOR * gravity[:2] - ROLLING_DAMPING * self.velocity
+        self.velocity += acceleration * dt
+        self.position += self.velocity * dt
+
+    def onPlate(self):
+        return abs(self.position[0]) <= PLATE_HALF_WIDTH and abs(self.position[1]) <= PLATE_HALF_WIDTH
+
+
+class SimulatedCamera():
+    """
+    Takes noisy, delayed pictures of the ball. Camera x points along plate -x so that, like in
+    cameraControlLoopDemo, a positive position error is corrected by a positive pitch or roll
+    """
+    def __init__(self, rng, rate=CAMERA_RATE, latency=CAMERA_LATENCY, noise=CAMERA_NOISE):
+        self.rng = rng
+        self.period = 1 / rate
+        self.latency = latency
+        self.noise = noise
+        self._nextFrameTime = 0.0
+        self._inFlight = [] # (time available, time taken, x, y)
+        self._latest = None
+
+    def step(self, time, ball):
+        if time >= self._nextFrameTime:
+            self._nextFrameTime += self.period
+            x, y = -ball.position[0], ball.position[1]
+            if ball.onPlate():
+                x += self.rng.normal(0, self.noise)
+                y += self.rng.normal(0, self.noise)
+            else:
+                x, y = None, None
+            self._inFlight.append((time + self.latency, time, x, y))
+        while self._inFlight and self._inFlight[0][0] <= time:
+            self._latest = self._inFlight.pop(0)[1:]
+
+    def getCameraData(self):
+        """
+        returns the newest (x, y, time taken) like cameraControlLoopDemo.getCameraData, each measurement only once
+        """
+        latest = self._latest
+        self._latest = None
+        if latest is None:
+            return None, None, None
+        return latest[1], latest[2], latest[0]
+
+
+class Simulation():
+    """
+    Platform, ball and camera stepped together on one simulated clock
+    """
+    def __init__(self, seed=0, ballPosition=None, ballVelocity=(0, 0)):
+        self.rng = np.random.default_rng(seed)
+        if ballPosition is None:
+            ballPosition = self.rng.uniform(-PLATE_HALF_WIDTH / 2, PLATE_HALF_WIDTH / 2, 2)
+        self.platform = SimulatedPlatformController()
+        self.ball = SimulatedBall(ballPosition, ballVelocity)
+        self.camera = SimulatedCamera(self.rng)
+        self.time = 0.0
+
+    def advance(self, duration, dt=PHYSICS_DT):
+        """steps everything forward by duration seconds"""
+        end = self.time + duration - dt / 2
+        while self.time < end:
+            self.time += dt
+            self.platform.step(dt)
+            if self.ball.onPlate():
+                self.ball.step(dt, self.platform.rotation)
+            self.camera.step(self.time, self.ball)
+
+
+def runControlLoop(gains, seed=0, duration=10.0, controlRate=CONTROL_RATE, useTilt=True):
+    """
+    runs the cameraControlLoopDemo PID controller on a simulation.
+    gains - (kP, kI, kD), same for x and y (degrees per mm, per mm s, per mm/s)
+    useTilt - send the correction as a tilt direction and magnitude like cameraControlLoopDemo, otherwise as pitch and roll
+    returns a dict of how well it did: rms and final error (mm), settle time (s, last time the ball was further than
+    SETTLE_RADIUS from the centre), whether the ball stayed on, and the simulated time
+    """
+    kP, kI, kD = gains
+    simulation = Simulation(seed)
+    platform = simulation.platform
+    estimator = BallEstimator()
+    # x and y together, with the tilt command the length of the (x, y) correction is limited instead of each part
+    pid = PIDBatch([kP, kP], [kI, kI], [kD, kD], outputLimits=(-MAX_TILT, MAX_TILT),
+                   magnitudeLimit=MAX_TILT if useTilt else None)
+    period = 1 / controlRate
+    squaredErrors = []
+    settleTime = 0.0
+
+    while simulation.time < duration:
+        simulation.advance(period)
+        if not simulation.ball.onPlate():
+            return {"gains": gains, "seed": seed, "fell_off": True, "time": simulation.time,
+                    "rms_error": float("inf"), "final_error": float("inf"), "settle_time": float("inf")}
+        squaredErrors.append(float(np.dot(simulation.ball.position, simulation.ball.position)))
+        if squaredErrors[-1] > SETTLE_RADIUS**2:
+            settleTime = simulation.time
+
+        x, y, timestamp = simulation.camera.getCameraData()
+        if timestamp is not None:
+            estimator.update(timestamp, x, y)
+        estimate = estimator.estimate(simulation.time)
+        if estimate is None:
+            continue
+        xPos, yPos, xVel, yVel = estimate
+
+        correctionX, correctionY = pid.update((0, 0), (xPos, yPos), period, measurementRate = (xVel, yVel)).tolist()
+        if useTilt:
+            platform.set_platform_tilt(direction = math.degrees(math.atan2(correctionY, correctionX)),
+                                       magnitude = math.hypot(correctionX, correctionY), z = 0)
+        else:
+            platform.set_platform_angle(pitch = correctionX, roll = correctionY, z = 0)
+
+    return {"gains": gains, "seed": seed, "fell_off": False, "time": simulation.time,
+            "rms_error": math.sqrt(np.mean(squaredErrors)), "final_error": float(np.hypot(*simulation.ball.position)),
+            "settle_time": settleTime}
+
+
+def _runControlLoopArgs(args):
+    return runControlLoop(*args)
+
+
+def sweepGains(gainSets, seeds=range(4), duration=10.0, processes=None):
+    """
+    runs every gain set on every seed in a process pool.
+    returns a list with one dict per gain set: gains, mean rms error and how many seeds dropped the ball, best first
+    """
+    jobs = [(tuple(gains), seed, duration) for gains in gainSets for seed in seeds]
+    with ProcessPoolExecutor(processes) as pool:
+        runs = list(pool.map(_runControlLoopArgs, jobs, chunksize=max(1, len(jobs) // 64)))
+
+    summary = []
+    for gains in gainSets:
+        gainRuns = [run for run in runs if run["gains"] == tuple(gains)]
+        summary.append({"gains": tuple(gains),
+                        "mean_rms_error": float(np.mean([run["rms_error"] for run in gainRuns])),
+                        "falls": sum(run["fell_off"] for run in gainRuns)})
+    summary.sort(key=lambda result: result["mean_rms_error"])
+    return summary
+
+
+def runControlLoopBatch(gainSets, seeds=range(4), duration=10.0, controlRate=CONTROL_RATE):
+    """
+    simplified simulation of every gain set on every seed at once, on numpy arrays instead of one run at a time.
+    The platform is a tilt that follows the command after the servo latency at TILT_SLEW_RATE (no kinematics), and
+    the PID works straight off the camera with its filtered derivative (no Kalman filter). Much faster than
+    runControlLoop for big sweeps, but only a rough screen: without the estimator's latency prediction and the tilt
+    kinematics it can be well off (the demo gains (0.15, 0, 0.08) oscillate at about 21 mm rms in runControlLoop and
+    score under 5 mm here), so the gains it likes have to be checked with runControlLoop (sweepGainsBatch does)
+    returns an (gain sets, seeds) array of rms errors (mm, inf if the ball fell off)
+    """
+    gains = np.asarray(gainSets, dtype=float)
+    seeds = list(seeds)
+    count = len(gains) * len(seeds)
+    gains = np.repeat(gains, len(seeds), axis=0) # run i is gain set i // len(seeds) on seed i % len(seeds)
+    rngs = [np.random.default_rng(seed) for seed in seeds]
+    position = np.array([rngs[seed].uniform(-PLATE_HALF_WIDTH / 2, PLATE_HALF_WIDTH / 2, 2) for seed in range(len(seeds))])
+    position = np.tile(position, (len(gainSets), 1))
+    velocity = np.zeros((count, 2))
+    tilt = np.zeros((count, 2)) # actual (pitch, roll)
+    targetTilt = np.zeros((count, 2))
+    onPlate = np.ones(count, dtype=bool)
+    squaredErrors = np.zeros(count)
+    samples = 0
+
+    pid = PIDBatch(gains[:, 0:1], gains[:, 1:2], gains[:, 2:3], outputLimits=(-MAX_TILT, MAX_TILT))
+    noise = np.random.default_rng(max(seeds, default=0) + 1)
+    pendingCommands = [] # (time it takes effect, tilts)
+    framesInFlight = [] # (time available, time taken, measured x and y)
+    nextFrameTime = 0.0
+    lastFrameTime = None
+    stepsPerControl = max(1, int(round(1 / (controlRate * PHYSICS_DT))))
+    time = 0.0
+
+    while time < duration:
+        for _ in range(stepsPerControl):
+            time += PHYSICS_DT
+            while pendingCommands and pendingCommands[0][0] <= time:
+                targetTilt = pendingCommands.pop(0)[1]
+            maxMove = TILT_SLEW_RATE * PHYSICS_DT
+            tilt += np.clip(targetTilt - tilt, -maxMove, maxMove)
+
+            # gravity in plate coordinates is rotation.T @ (0, 0, -g), the bottom row of the rotation times -g
+            gravity = -GRAVITY * calculateRotationMatrixBatch(tilt[:, 0], tilt[:, 1])[:, 2, :2]
+            acceleration = ROLLING_FACTOR * gravity - ROLLING_DAMPING * velocity
+            velocity += np.where(onPlate[:, None], acceleration * PHYSICS_DT, 0)
+            position += np.where(onPlate[:, None], velocity * PHYSICS_DT, 0)
+            onPlate &= (np.abs(position) <= PLATE_HALF_WIDTH).all(axis=1)
+
+            if time >= nextFrameTime:
+                nextFrameTime += 1 / CAMERA_RATE
+                # camera x points along plate -x, see SimulatedCamera
+                measured = position * (-1, 1) + noise.normal(0, CAMERA_NOISE, position.shape)
+                measured[~onPlate] = np.nan
+                framesInFlight.append((time + CAMERA_LATENCY, time, measured))
+
+        squaredErrors += np.where(onPlate, (position ** 2).sum(axis=1), 0)
+        samples += 1
+
+        latest = None
+        while framesInFlight and framesInFlight[0][0] <= time:
+            latest = framesInFlight.pop(0)[1:]
+        if latest is not None:
+            frameTime, measured = latest
+            dt = frameTime - lastFrameTime if lastFrameTime is not None else 0.0
+            lastFrameTime = frameTime
+            pendingCommands.append((time + SERVO_LATENCY, pid.update(0, measured, dt)))
+
+    rmsErrors = np.where(onPlate, np.sqrt(squaredErrors / max(samples, 1)), np.inf)
+    return rmsErrors.reshape(len(gainSets), len(seeds))
+
+
+def sweepGainsBatch(gainSets, seeds=range(4), duration=10.0, recheck=RECHECK_COUNT, processes=None):
+    """
+    screens every gain set at once with runControlLoopBatch, then re-runs the recheck best on the full simulation
+    (sweepGains) since the simplified model can rank gains that oscillate on the real thing near the top.
+    returns the sweepGains results for the rechecked gain sets, best first, each with the batch model's
+    "batch_rms_error" too
+    """
+    seeds = list(seeds)
+    rmsErrors = runControlLoopBatch(gainSets, seeds, duration)
+    screened = sorted(zip(map(tuple, gainSets), rmsErrors.mean(axis=1)), key=lambda screen: screen[1])[:recheck]
+    summary = sweepGains([gains for gains, error in screened], seeds, duration, processes)
+    batchErrors = dict(screened)
+    for result in summary:
+        result["batch_rms_error"] = float(batchErrors[result["gains"]])
+    return summary
+
+
+if __name__ == "__main__":
+    from time import perf_counter
+
+    startTime = perf_counter()
+    result = runControlLoop((0.15, 0, 0.08), duration=10)
+    print("single 10s run took", perf_counter() - startTime, "s:", result)
+
+    gainSets = [(kP, 0, kD) for kP in (0.05, 0.1, 0.15, 0.2, 0.3) for kD in (0.02, 0.05, 0.08, 0.12)]
+    startTime = perf_counter()
+    results = sweepGains(gainSets)
+    print("swept", len(gainSets), "gain sets in", perf_counter() - startTime, "s, best:")
+    for result in results[:5]:
+        print(result)
+
+    gainSets = [(kP, kI, kD) for kP in np.linspace(0.02, 0.4, 20) for kI in (0, 0.01, 0.05)
+                for kD in np.linspace(0.01, 0.2, 20)]
+    startTime = perf_counter()
+    results = sweepGainsBatch(gainSets)
+    print("batch swept", len(gainSets), "gain sets (best", RECHECK_COUNT, "rechecked on the full simulation) in",
+          perf_counter() - startTime, "s, best:")
+    for result in results[:5]:
+        print(result)
@@ -0,0 +1,183 @@
+# Precomputed (pitch, roll, z) -> (psi1, psi2, psi3) lookup table so the control loop doesn't redo the kinematics every frame
+# The table is built once with calculateMotorAngleBatch, cached to disk as a .npy and memory mapped when loaded.
+# Since the closed form solver went in the exact calculation is only a little slower than a lookup, and the lookup is
+# interpolated, so the table is worth it only where every microsecond counts. For the default table maxError() is
+# 0.33 degrees over poses the servos can reach (0.29 for the tilt table), nearly all of it with a servo past 55
+# degrees (under 0.04 below 45). Over the whole table it is 2.1 degrees (2.4 for the tilt table), the error grows
+# quickly past the servo limits towards impossible poses
+
+import os
+import hashlib
+import numpy as np
+import calculateMotorAngle as kinematics
+from calculateMotorAngle import calculateMotorAngleBatch, calculateMotorAngleTiltBatch
+from helperFuncs import cosd, sind
+from PlatformController import MIN_ANGLE, MAX_ANGLE
+
+# Bump this whenever the kinematics change so old cached tables get rebuilt
+SOLVER_VERSION = 2
+
+TABLE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+# Default table range and resolution (pitch and roll in degrees, z in mm)
+DEFAULT_PITCH_RANGE = (-20, 20)
+DEFAULT_ROLL_RANGE = (-20, 20)
+DEFAULT_Z_RANGE = (-50, 50)
+DEFAULT_RESOLUTION = (0.5, 0.5, 1) # grid spacing in (pitch, roll, z)
+
+
+class ServoAngleTable():
+    """
+    Grid of servo angles over (pitch, roll, z) queried with trilinear interpolation.
+    Grid points where the pose is impossible hold NaN, any query touching them returns None.
+    With tiltVector=True the first two axes are the tilt vector (magnitude*cos(direction), magnitude*sin(direction))
+    of calculateMotorAngleTilt instead of pitch and roll, use lookupTilt. The tilt vector is used instead of
+    direction and magnitude because it is smooth through flat, where the direction jumps around
+    """
+    def __init__(self, pitchRange=DEFAULT_PITCH_RANGE, rollRange=DEFAULT_ROLL_RANGE, zRange=DEFAULT_Z_RANGE,
+                 resolution=DEFAULT_RESOLUTION, cacheDir=TABLE_CACHE_DIR, tiltVector=False):
+        self.tiltVector = tiltVector
+        self.resolution = tuple(float(step) for step in resolution)
+        self.mins = np.array([pitchRange[0], rollRange[0], zRange[0]], dtype=float)
+        maxs = np.array([pitchRange[1], rollRange[1], zRange[1]], dtype=float)
+
+        # number of grid points along each axis, the upper limit is rounded up to land on a grid point
+        self.shape = tuple(int(np.ceil((maxs[i] - self.mins[i]) / self.resolution[i])) + 1 for i in range(3))
+        self.maxs = self.mins + (np.array(self.shape) - 1) * self.resolution
+        self.steps = np.array(self.resolution)
+
+        name = 'tiltAngleTable_' if tiltVector else 'servoAngleTable_'
+        self.cachePath = os.path.join(cacheDir, name + self._key() + '.npy')
+        self.table = self._loadOrBuild()
+
+        # plain python copies of things used by the scalar lookup, numpy scalars are slow in tight loops.
+        # _grid is the table as a plain ndarray (still the memory map underneath), slicing a np.memmap is slower
+        self._grid = np.asarray(self.table)
+        self._pitchMin, self._rollMin, self._zMin = self.mins.tolist()
+
+    def _key(self):
+        """Hash of everything the table depends on, used for the cache file name"""
+        description = repr((SOLVER_VERSION, kinematics.B, kinematics.P, kinematics.a, kinematics.b, kinematics.h_0,
+                            tuple(self.mins), self.shape, self.resolution))
+        return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+    def _axes(self):
+        return [self.mins[i] + self.steps[i] * np.arange(self.shape[i]) for i in range(3)]
+
+    def _loadOrBuild(self):
+        if os.path.exists(self.cachePath):
+            return np.load(self.cachePath, mmap_mode='r')
+
+        pitches, rolls, zs = np.meshgrid(*self._axes(), indexing='ij')
+        table = self._exactBatch(pitches, rolls, zs).reshape(self.shape + (3,)).astype(np.float32)
+
+        os.makedirs(os.path.dirname(self.cachePath), exist_ok=True)
+        # write to a temp file first so a half written table is never picked up as a cache hit
+        tempPath = self.cachePath + '.tmp.npy'
+        np.save(tempPath, table)
+        os.replace(tempPath, self.cachePath)
+        return np.load(self.cachePath, mmap_mode='r')
+
+    def _exactBatch(self, pitch, roll, z):
+        """the exact solver for the table's axes"""
+        if self.tiltVector:
+            return calculateMotorAngleTiltBatch(np.degrees(np.arctan2(roll, pitch)), np.hypot(pitch, roll), z)
+        return calculateMotorAngleBatch(pitch, roll, z)
+
+    def contains(self, pitch, roll, z):
+        """True if the pose is inside the range covered by the table"""
+        return (self.mins[0] <= pitch <= self.maxs[0] and self.mins[1] <= roll <= self.maxs[1]
+                and self.mins[2] <= z <= self.maxs[2])
+
+    def lookup(self, pitch, roll, z):
+        """
+        returns the interpolated angles (servo 1, servo 2, servo 3) for a single pose,
+        or None if the pose is outside the table or next to an impossible grid point
+        """
+        if not self.contains(pitch, roll, z):
+            return None
+
+        # fractional grid index along each axis
+        fp = (pitch - self._pitchMin) / self.resolution[0]
+        fr = (roll - self._rollMin) / self.resolution[1]
+        fz = (z - self._zMin) / self.resolution[2]
+        i = min(int(fp), self.shape[0] - 2)
+        j = min(int(fr), self.shape[1] - 2)
+        k = min(int(fz), self.shape[2] - 2)
+        tp = fp - i
+        tr = fr - j
+        tz = fz - k
+
+        # the 8 surrounding grid points as one small slice turned into lists, blended in plain python.
+        # Fancy indexing and np.dot on a single pose cost more than the exact solver does
+        ((c000, c001), (c010, c011)), ((c100, c101), (c110, c111)) = self._grid[i:i+2, j:j+2, k:k+2].tolist()
+        angles = []
+        for n in range(3):
+            c00 = c000[n] + tz * (c001[n] - c000[n])
+            c01 = c010[n] + tz * (c011[n] - c010[n])
+            c10 = c100[n] + tz * (c101[n] - c100[n])
+            c11 = c110[n] + tz * (c111[n] - c110[n])
+            c0 = c00 + tr * (c01 - c00)
+            angles.append(c0 + tp * (c10 + tr * (c11 - c10) - c0))
+        psi1, psi2, psi3 = angles
+
+        if psi1 != psi1 or psi2 != psi2 or psi3 != psi3: # NaN check
+            return None
+        return (psi1, psi2, psi3)
+
+    def lookupTilt(self, direction, magnitude, z):
+        """
+        lookup for a table built with tiltVector=True, by tilt direction and magnitude (degrees)
+        """
+        return self.lookup(magnitude * cosd(direction), magnitude * sind(direction), z)
+
+    def lookupBatch(self, pitch, roll, z) -> np.ndarray:
+        """
+        Vectorized lookup, returns an (N, 3) array. Poses outside the table or next to impossible grid points are NaN
+        """
+        pose = np.stack(np.broadcast_arrays(np.asarray(pitch, dtype=float), np.asarray(roll, dtype=float),
+                                            np.asarray(z, dtype=float)), axis=-1).reshape(-1, 3)
+        inside = np.all((pose >= self.mins) & (pose <= self.maxs), axis=1)
+
+        f = (pose - self.mins) / self.steps
+        idx = np.clip(np.floor(f).astype(int), 0, np.array(self.shape) - 2)
+        t = f - idx
+
+        angles = np.zeros((len(pose), 3))
+        for corner in range(8):
+            di, dj, dk = (corner >> 2) & 1, (corner >> 1) & 1, corner & 1
+            weight = ((t[:, 0] if di else 1 - t[:, 0]) * (t[:, 1] if dj else 1 - t[:, 1])
+                      * (t[:, 2] if dk else 1 - t[:, 2]))
+            angles += weight[:, None] * self.table[idx[:, 0] + di, idx[:, 1] + dj, idx[:, 2] + dk]
+
+        angles[~inside] = np.nan
+        return angles
+
+    def maxError(self, numSamples=100000, seed=0, angleLimits=(MIN_ANGLE, MAX_ANGLE)):
+        """
+        Compares the table against the exact solver at random poses inside the table,
+        returns the largest absolute servo angle error in degrees (ignoring impossible poses).
+        angleLimits - only count poses where every exact servo angle is inside (min, max), the poses that can actually
+                      be sent to the servos. None counts every possible pose in the table
+        """
+        rng = np.random.default_rng(seed)
+        poses = rng.uniform(self.mins, self.maxs, size=(numSamples, 3))
+        exact = self._exactBatch(poses[:, 0], poses[:, 1], poses[:, 2])
+        approx = self.lookupBatch(poses[:, 0], poses[:, 1], poses[:, 2])
+        error = np.abs(exact - approx)
+        if angleLimits is not None:
+            with np.errstate(invalid='ignore'):
+                error = error[((exact >= angleLimits[0]) & (exact <= angleLimits[1])).all(axis=1)]
+        return float(np.nanmax(error)) if not np.isnan(error).all() else float('nan')
+
+
+if __name__ == "__main__":
+    from time import perf_counter
+    startTime = perf_counter()
+    table = ServoAngleTable()
+    print("table", table.shape, "ready in", perf_counter() - startTime, "s, cached at", table.cachePath)
+    print("max error against exact solver =", table.maxError(), "degrees inside the servo range,",
+          table.maxError(angleLimits=None), "degrees over the whole table")
+    tiltTable = ServoAngleTable(tiltVector=True)
+    print("tilt table max error against exact solver =", tiltTable.maxError(), "degrees inside the servo range,",
+          tiltTable.maxError(angleLimits=None), "degrees over the whole table")
@@ -0,0 +1,113 @@
+# Records what the control loop did every iteration, for looking at afterwards instead of printing it live
+# Printing to the terminal on the pi is slow enough to mess up the loop timing, a record costs a few microseconds.
+# Records are fixed size and go into a preallocated .npy file that is memory mapped, used as a ring buffer so a long
+# run keeps the newest records. The file is a normal .npy so np.load works on it, loadTelemetry() puts it in order
+
+import os
+import glob
+from datetime import datetime
+import numpy as np
+from numpy.lib.format import open_memmap
+
+TELEMETRY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telemetry')
+DEFAULT_CAPACITY = 50 * 60 * 10 # records, 10 minutes at 50 Hz
+
+# One record per loop iteration. Anything not recorded is NaN
+TELEMETRY_DTYPE = np.dtype([
+    ('sequence', 'u8'), # record number, starting at 1. 0 means the slot was never written
+    ('timestamp', 'f8'), # s, perf_counter at the start of the iteration
+    ('ball_x', 'f4'), ('ball_y', 'f4'), # measured position, NaN if the ball wasn't seen
+    ('est_x', 'f4'), ('est_y', 'f4'), # filtered position
+    ('vel_x', 'f4'), ('vel_y', 'f4'), # filtered velocity
+    ('error_x', 'f4'), ('error_y', 'f4'),
+    ('p_x', 'f4'), ('i_x', 'f4'), ('d_x', 'f4'), # PID terms, already multiplied by their gains
+    ('p_y', 'f4'), ('i_y', 'f4'), ('d_y', 'f4'),
+    ('pitch', 'f4'), ('roll', 'f4'), ('z', 'f4'), # commanded pose
+    ('servo_angles', 'f4', (3,)), # degrees, what the servos were sent
+    # per stage latencies (s)
+    ('loop_dt', 'f4'), # time since the previous iteration
+    ('frame_age', 'f4'), # how old the camera frame was when the loop used it
+    ('sense_time', 'f4'), # getting the measurement (camera queue or joystick read)
+    ('estimate_time', 'f4'),
+    ('control_time', 'f4'),
+    ('actuate_time', 'f4'), # set_platform_angle
+])
+
+LATENCY_FIELDS = ('loop_dt', 'frame_age', 'sense_time', 'estimate_time', 'control_time', 'actuate_time')
+
+
+class TelemetryRecorder():
+    """
+    Writes one record per call to record() into a memory mapped ring buffer file
+    """
+    def __init__(self, path=None, capacity=DEFAULT_CAPACITY):
+        """
+        path - .npy file to write, defaults to a new timestamped file in TELEMETRY_DIR
+        capacity - number of records kept, the oldest are overwritten after that
+        """
+        if path is None:
+            path = os.path.join(TELEMETRY_DIR, datetime.now().strftime('run_%Y%m%d_%H%M%S.npy'))
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.capacity = capacity
+        self.records = open_memmap(path, mode='w+', dtype=TELEMETRY_DTYPE, shape=(capacity,))
+        self.count = 0
+
+        # field order for building a record tuple, and what a field is when it isn't given
+        self._names = TELEMETRY_DTYPE.names[1:]
+        self._defaults = [(np.nan,) * 3 if TELEMETRY_DTYPE[name].shape else np.nan for name in self._names]
+
+    def record(self, **values):
+        """
+        writes a record, the keywords are TELEMETRY_DTYPE field names (except sequence). Missing or None values are NaN
+        """
+        self.count += 1
+        self.records[(self.count - 1) % self.capacity] = (self.count,) + tuple(map(values.get, self._names, self._defaults))
+
+    def flush(self):
+        self.records.flush()
+
+    def close(self):
+        """
+        flushes the records to disk, the recorder can't be used after this
+        """
+        self.records.flush()
+        del self.records
+
+
+def loadTelemetry(path=None):
+    """
+    loads a recorded run as a numpy structured array in the order it was recorded (oldest first).
+    path defaults to the newest run in TELEMETRY_DIR
+    """
+    if path is None:
+        path = latestTelemetryPath()
+    records = np.load(path, mmap_mode='r')
+    written = records[records['sequence'] > 0]
+    return np.array(written[np.argsort(written['sequence'])])
+
+
+def latestTelemetryPath(directory=TELEMETRY_DIR):
+    """returns the newest run file in directory, or None if there aren't any"""
+    paths = sorted(glob.glob(os.path.join(directory, 'run_*.npy')))
+    return paths[-1] if paths else None
+
+
+def summarizeTelemetry(records):
+    """
+    returns a dict of p50, p99 and max (ms) for each latency field that was recorded
+    """
+    summary = {"records": len(records)}
+    for name in LATENCY_FIELDS:
+        values = records[name][~np.isnan(records[name])] * 1000
+        if len(values):
+            summary[name] = {"p50_ms": float(np.percentile(values, 50)), "p99_ms": float(np.percentile(values, 99)),
+                             "max_ms": float(values.max())}
+    return summary
+
+
+if __name__ == "__main__":
+    import sys
+    records = loadTelemetry(sys.argv[1] if len(sys.argv) > 1 else None)
+    for name, value in summarizeTelemetry(records).items():
+        print(name, value)
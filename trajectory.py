@@ -0,0 +1,267 @@
+# Smooth platform motions worked out ahead of time
+# A motion is described as a path over time (waypoints, circles, Lissajous figures, minimum jerk moves, ...).
+# solveProfile() samples the whole path at the servo update rate, does the kinematics for every sample in one batch
+# and limits how fast the servos speed up and move. Playing a profile back is then just stepping through an array
+
+import math
+import numpy as np
+from calculateMotorAngle import calculateMotorAngleBatch
+from loopScheduler import LoopScheduler
+
+PROFILE_RATE = 50 # Hz, one sample per servo PWM period
+MAX_SERVO_VELOCITY = 300 # degrees/s
+MAX_SERVO_ACCELERATION = 3000 # degrees/s^2
+SETTLE_SAMPLES = 10 * PROFILE_RATE # most samples added to the end of a profile while the servos catch up
+BLEND_TIME = 1.0 # s, default length of the minimum jerk move Sequence puts between segments that don't line up
+
+
+def minimumJerk(s):
+    """
+    minimum jerk blend from 0 to 1 as s goes from 0 to 1, starts and ends with zero velocity and acceleration
+    """
+    s = np.clip(s, 0, 1)
+    return s**3 * (10 - 15 * s + 6 * s**2)
+
+
+class Trajectory():
+    """
+    A platform motion, poses(t) gives the (pitch, roll, z) at each time in t (s from the start of the motion).
+    Subclasses set duration and define _poses for times that are already between 0 and duration
+    """
+    duration = 0.0
+
+    def poses(self, t):
+        """returns an (N, 3) array of (pitch, roll, z) for the N times in t, times past the end hold the last pose"""
+        t = np.clip(np.atleast_1d(np.asarray(t, dtype=float)), 0, self.duration)
+        return self._poses(t)
+
+    def start(self):
+        return self.poses(0)[0]
+
+    def end(self):
+        return self.poses(self.duration)[0]
+
+
+class Hold(Trajectory):
+    """stays at one pose"""
+    def __init__(self, pose, duration):
+        self.pose = np.array(pose, dtype=float)
+        self.duration = duration
+
+    def _poses(self, t):
+        return np.tile(self.pose, (len(t), 1))
+
+
+class MinimumJerkMove(Trajectory):
+    """straight line from one pose to another with a minimum jerk speed profile (smooth start and stop)"""
+    def __init__(self, start, end, duration):
+        self.startPose = np.array(start, dtype=float)
+        self.endPose = np.array(end, dtype=float)
+        self.duration = duration
+
+    def _poses(self, t):
+        s = minimumJerk(t / self.duration) if self.duration > 0 else np.ones(len(t))
+        return self.startPose + s[:, None] * (self.endPose - self.startPose)
+
+
+class Waypoints(Trajectory):
+    """
+    goes through a list of poses with a minimum jerk move between each one, stopping at every waypoint
+    moveTime - s for each move, holdTime - s to stay at each waypoint (both can be one number or one per waypoint)
+    """
+    def __init__(self, poses, moveTime=1.0, holdTime=0.0):
+        self.waypoints = np.array(poses, dtype=float)
+        count = len(self.waypoints)
+        self.moveTimes = np.broadcast_to(np.asarray(moveTime, dtype=float), (count,)).copy()
+        self.holdTimes = np.broadcast_to(np.asarray(holdTime, dtype=float), (count,)).copy()
+        self.moveTimes[0] = 0 # already at the first waypoint
+        # when each move starts and each hold starts
+        segmentTimes = np.column_stack((self.moveTimes, self.holdTimes)).ravel()
+        self.boundaries = np.concatenate(([0], np.cumsum(segmentTimes)))
+        self.duration = float(self.boundaries[-1])
+
+    def _poses(self, t):
+        waypoint = np.clip(np.searchsorted(self.boundaries[1::2], t, side='left'), 0, len(self.waypoints) - 1)
+        moveStart = self.boundaries[2 * waypoint]
+        moveTime = self.moveTimes[waypoint]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            s = np.where(moveTime > 0, minimumJerk((t - moveStart) / moveTime), 1.0)
+        previous = self.waypoints[np.maximum(waypoint - 1, 0)]
+        return previous + s[:, None] * (self.waypoints[waypoint] - previous)
+
+
+class Lissajous(Trajectory):
+    """
+    each of pitch, roll and z is a sine wave: centre + amplitude * sin(2*pi*t / period + phase)
+    amplitudes, periods, phases and centre are (pitch, roll, z) triples, a period of 0 means that axis doesn't move
+    """
+    def __init__(self, amplitudes, periods, duration, phases=(0, 0, 0), centre=(0, 0, 0)):
+        self.amplitudes = np.array(amplitudes, dtype=float)
+        self.periods = np.array(periods, dtype=float)
+        self.phases = np.array(phases, dtype=float)
+        self.centre = np.array(centre, dtype=float)
+        self.duration = duration
+
+    def _poses(self, t):
+        with np.errstate(divide='ignore'):
+            angularFrequency = np.where(self.periods > 0, 2 * np.pi / self.periods, 0)
+        return self.centre + self.amplitudes * np.sin(t[:, None] * angularFrequency + self.phases)
+
+
+class Circle(Lissajous):
+    """tilts by a constant amount while the direction of the tilt goes round, pitch = tilt*cos, roll = tilt*sin"""
+    def __init__(self, tilt, period, duration, z=0):
+        super().__init__((tilt, tilt, 0), (period, period, 0), duration, phases=(math.pi / 2, 0, 0), centre=(0, 0, z))
+
+
+class Sequence(Trajectory):
+    """
+    trajectories one after another. If one doesn't start where the last one ended a minimum jerk move of
+    blendTime is put in between so the platform never jumps
+    """
+    def __init__(self, trajectories, blendTime=BLEND_TIME):
+        self.segments = []
+        for trajectory in trajectories:
+            if self.segments:
+                lastEnd = self.segments[-1].end()
+                if not np.allclose(lastEnd, trajectory.start()):
+                    self.segments.append(MinimumJerkMove(lastEnd, trajectory.start(), blendTime))
+            self.segments.append(trajectory)
+        self.startTimes = np.concatenate(([0], np.cumsum([segment.duration for segment in self.segments])))
+        self.duration = float(self.startTimes[-1])
+
+    def _poses(self, t):
+        index = np.clip(np.searchsorted(self.startTimes, t, side='right') - 1, 0, len(self.segments) - 1)
+        poses = np.empty((len(t), 3))
+        for i, segment in enumerate(self.segments):
+            inSegment = index == i
+            if inSegment.any():
+                poses[inSegment] = segment.poses(t[inSegment] - self.startTimes[i])
+        return poses
+
+
+class ServoProfile():
+    """
+    A trajectory solved ahead of time: servo angles for every sample at a fixed rate
+    times - (N,) s, poses - (N, 3) the requested (pitch, roll, z), angles - (N, 3) servo angles after the limits
+    limitedSamples - number of samples where the velocity or acceleration limit changed the angles
+    """
+    def __init__(self, times, poses, angles, rate, limitedSamples):
+        self.times = times
+        self.poses = poses
+        self.angles = angles
+        self.rate = rate
+        self.limitedSamples = limitedSamples
+        self.duration = float(times[-1]) if len(times) else 0.0
+
+    def __len__(self):
+        return len(self.times)
+
+    def anglesAt(self, t):
+        """servo angles for time t, the nearest sample (lookup only)"""
+        return self.angles[min(max(int(round(t * self.rate)), 0), len(self.angles) - 1)]
+
+    def save(self, path):
+        np.savez(path, times=self.times, poses=self.poses, angles=self.angles, rate=self.rate,
+                 limitedSamples=self.limitedSamples)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['times'], data['poses'], data['angles'], float(data['rate']), int(data['limitedSamples']))
+
+
+def limitServoMotion(angles, rate, maxVelocity=MAX_SERVO_VELOCITY, maxAcceleration=MAX_SERVO_ACCELERATION):
+    """
+    returns a copy of the (N, 3) servo angles where no servo moves faster than maxVelocity (degrees/s) or speeds up
+    faster than maxAcceleration (degrees/s^2), plus the number of samples that had to change.
+    Each servo follows the requested angle as closely as the limits allow, slowing down in time so it doesn't
+    overshoot. If it is still behind at the end, samples holding the last angle are added until it gets there
+    """
+    dt = 1 / rate
+    maxStep = maxVelocity * dt
+    maxStepChange = maxAcceleration * dt * dt
+    # plain python floats, one list per servo. The servos are independent apart from when to stop padding, and
+    # numpy on 3 numbers at a time costs far more than the arithmetic
+    requested = np.asarray(angles, dtype=float)
+    columns = requested.T.tolist()
+    count = len(requested)
+    limited = [[column[0]] for column in columns]
+    changedAt = [False] * count
+    settled = [count] * 3 # sample each servo ends up on the last angle and stops
+    for n, column in enumerate(columns):
+        output = limited[n]
+        target = column[-1]
+        position = column[0]
+        step = 0.0
+        i = 1
+        while i < count or (i < count + SETTLE_SAMPLES and (abs(position - target) > 1e-6 or abs(step) > 1e-6)):
+            wanted = (column[i] if i < count else target) - position
+            # fastest step that can still stop in time (v^2 = 2ad)
+            fastest = min(maxStep, math.sqrt(2 * maxStepChange * abs(wanted)))
+            wanted = min(max(wanted, -fastest), fastest)
+            step = min(max(wanted, step - maxStepChange), step + maxStepChange)
+            position += step
+            output.append(position)
+            if i < count and abs(position - column[i]) > 1e-9:
+                changedAt[i] = True
+            i += 1
+        settled[n] = i
+
+    # every servo keeps going until the slowest one has settled, the faster ones just hold their last angle
+    length = max(settled)
+    for output in limited:
+        output.extend([output[-1]] * (length - len(output)))
+    changed = sum(changedAt) + length - count
+    return np.array(limited).T, changed
+
+
+def solveProfile(trajectory, rate=PROFILE_RATE, maxVelocity=MAX_SERVO_VELOCITY, maxAcceleration=MAX_SERVO_ACCELERATION,
+                 workspace=None):
+    """
+    samples the trajectory at rate (Hz), solves the kinematics for every sample in one batch and applies the
+    servo velocity and acceleration limits.
+    workspace - a WorkspaceMap, poses outside it are moved onto its edge first. Without one a path that goes
+                somewhere impossible raises UnreachablePoseError
+    """
+    times = np.arange(int(math.floor(trajectory.duration * rate)) + 1) / rate
+    poses = trajectory.poses(times)
+    if workspace is not None:
+        poses = workspace.saturateBatch(poses[:, 0], poses[:, 1], poses[:, 2])
+    angles = calculateMotorAngleBatch(poses[:, 0], poses[:, 1], poses[:, 2], raiseOnUnreachable=True)
+    angles, limitedSamples = limitServoMotion(angles, rate, maxVelocity, maxAcceleration)
+    # samples added at the end while the servos catch up hold the last pose
+    times = np.arange(len(angles)) / rate
+    poses = np.concatenate((poses, np.repeat(poses[-1:], len(angles) - len(poses), axis=0)))
+    return ServoProfile(times, poses, angles, rate, limitedSamples)
+
+
+def playProfile(profile, controller, scheduler=None):
+    """
+    sends the profile to a PlatformController (set_servos) at the profile rate. Samples are picked by the time since
+    the start, so a late loop skips ahead instead of falling behind. Returns the scheduler for its timing stats
+    """
+    if scheduler is None:
+        scheduler = LoopScheduler(profile.rate)
+    elapsed = 0.0
+    scheduler.waitForNextTick()
+    while elapsed <= profile.duration:
+        controller.set_servos(tuple(profile.anglesAt(elapsed)))
+        elapsed += scheduler.waitForNextTick()
+    return scheduler
+
+
+if __name__ == "__main__":
+    from time import perf_counter
+    from workspaceMap import WorkspaceMap
+
+    motion = Sequence([Waypoints([(0, 0, 0), (0, 10, 0), (10, 0, 0), (0, -10, 0), (-10, 0, 0)], moveTime=0.5, holdTime=1),
+                       Circle(10, 3, 12),
+                       Lissajous((10, 10, 50), (3, 3, 10), 20, phases=(math.pi / 2, 0, 0)),
+                       Hold((0, 0, 0), 1)])
+    startTime = perf_counter()
+    profile = solveProfile(motion, workspace=WorkspaceMap())
+    print("solved", len(profile), "samples (", profile.duration, "s ) in", perf_counter() - startTime, "s,",
+          profile.limitedSamples, "samples limited")
+    velocity = np.abs(np.diff(profile.angles, axis=0)).max() * profile.rate
+    print("fastest servo", velocity, "degrees/s")
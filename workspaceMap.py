@@ -0,0 +1,200 @@
+# Precomputed map of which platform poses can actually be reached
+# Built once by sweeping calculateMotorAngleBatch over (pitch, roll, z), counting a pose as reachable if every leg
+# can reach it and every servo angle is within the servo limits. Cached to disk like servoAngleTable.
+# Answers "can the platform get here?" and "how far can it tilt this way?" in constant time, so the control loop can
+# saturate its corrections to the real workspace before anything is sent to the servos
+
+import os
+import math
+import hashlib
+import numpy as np
+import calculateMotorAngle as kinematics
+from calculateMotorAngle import calculateMotorAngleBatch
+from servoAngleTable import SOLVER_VERSION, TABLE_CACHE_DIR
+from PlatformController import MIN_ANGLE, MAX_ANGLE
+
+DEFAULT_MIN_ANGLE = MIN_ANGLE # same servo limits as PlatformController
+DEFAULT_MAX_ANGLE = MAX_ANGLE
+
+DEFAULT_TILT_RANGE = 30 # degrees, pitch and roll go from -this to +this
+DEFAULT_Z_RANGE = (-50, 50) # mm
+DEFAULT_RESOLUTION = (0.5, 0.5, 1) # grid spacing in (pitch, roll, z)
+DIRECTION_STEP = 2 # degrees between tilt directions in the boundary table
+TILT_STEP = 0.1 # degrees, resolution of the max tilt in the boundary table
+# degrees, how far out the boundary table looks along each direction. Well past what the servos can do, so the table
+# has the real limit and not tiltRange. A direction still reachable this far out is stored as inf (not bounded)
+BOUNDARY_SEARCH_TILT = 90
+
+
+class WorkspaceMap():
+    """
+    reachable - bitmap over the (pitch, roll, z) grid
+    maxTiltTable - boundary table of the largest tilt magnitude in each direction at each z, searched out to
+                   BOUNDARY_SEARCH_TILT (not just tiltRange). Tilt direction d and magnitude m mean
+                   pitch = m*cos(d), roll = m*sin(d)
+    """
+    def __init__(self, minAngle=DEFAULT_MIN_ANGLE, maxAngle=DEFAULT_MAX_ANGLE, tiltRange=DEFAULT_TILT_RANGE,
+                 zRange=DEFAULT_Z_RANGE, resolution=DEFAULT_RESOLUTION, cacheDir=TABLE_CACHE_DIR):
+        self.minAngle = minAngle
+        self.maxAngle = maxAngle
+        self.tiltRange = tiltRange
+        self.resolution = tuple(float(step) for step in resolution)
+        self.mins = (-float(tiltRange), -float(tiltRange), float(zRange[0]))
+        self.shape = tuple(int(math.ceil(2 * tiltRange / self.resolution[i])) + 1 for i in range(2)) + \
+                     (int(math.ceil((zRange[1] - zRange[0]) / self.resolution[2])) + 1,)
+        self.maxs = tuple(self.mins[i] + (self.shape[i] - 1) * self.resolution[i] for i in range(3))
+        self.numDirections = int(round(360 / DIRECTION_STEP))
+
+        self.cachePath = os.path.join(cacheDir, 'workspaceMap_' + self._key() + '.npz')
+        self.reachable, self.maxTiltTable = self._loadOrBuild()
+
+        flat = np.nonzero(self.maxTiltTable.min(axis=0) >= 0)[0]
+        if len(flat) == 0:
+            raise ValueError(f"the platform can't be flat at any z from {self.mins[2]} to {self.maxs[2]} mm with the "
+                             f"servo limits ({minAngle}, {maxAngle}), there is no workspace to saturate to")
+        self._zLimits = (self.mins[2] + flat[0] * self.resolution[2], self.mins[2] + flat[-1] * self.resolution[2])
+
+    def _key(self):
+        description = repr((SOLVER_VERSION, kinematics.B, kinematics.P, kinematics.a, kinematics.b, kinematics.h_0,
+                            self.minAngle, self.maxAngle, self.mins, self.shape, self.resolution,
+                            DIRECTION_STEP, TILT_STEP, BOUNDARY_SEARCH_TILT))
+        return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+    def _posesReachable(self, pitch, roll, z):
+        angles = calculateMotorAngleBatch(pitch, roll, z)
+        with np.errstate(invalid='ignore'):
+            return ((angles >= self.minAngle) & (angles <= self.maxAngle)).all(axis=1) # NaN compares False
+
+    def _loadOrBuild(self):
+        if os.path.exists(self.cachePath):
+            cached = np.load(self.cachePath)
+            reachable = np.unpackbits(cached['reachable'])[:np.prod(self.shape)].reshape(self.shape).astype(bool)
+            return reachable, cached['maxTilt']
+
+        # bitmap, one z slice at a time to keep the memory down
+        pitches, rolls = np.meshgrid(self.mins[0] + self.resolution[0] * np.arange(self.shape[0]),
+                                     self.mins[1] + self.resolution[1] * np.arange(self.shape[1]), indexing='ij')
+        reachable = np.zeros(self.shape, dtype=bool)
+        for k in range(self.shape[2]):
+            z = self.mins[2] + k * self.resolution[2]
+            reachable[:, :, k] = self._posesReachable(pitches, rolls, z).reshape(self.shape[:2])
+
+        # boundary table, the first unreachable magnitude along each direction (the reachable set is assumed to be
+        # star shaped around flat, so the tilt is checked all the way out along the direction). Searched well past
+        # tiltRange so the limit isn't just where the search stopped
+        directions = np.radians(np.arange(self.numDirections) * DIRECTION_STEP)
+        magnitudes = np.arange(0, BOUNDARY_SEARCH_TILT + TILT_STEP, TILT_STEP)
+        directionGrid, magnitudeGrid = np.meshgrid(directions, magnitudes, indexing='ij')
+        maxTilt = np.zeros((self.numDirections, self.shape[2]), dtype=np.float32)
+        for k in range(self.shape[2]):
+            z = self.mins[2] + k * self.resolution[2]
+            ok = self._posesReachable(magnitudeGrid * np.cos(directionGrid), magnitudeGrid * np.sin(directionGrid), z)
+            ok = ok.reshape(directionGrid.shape)
+            # number of reachable magnitudes before the first unreachable one
+            firstBad = np.where(ok.all(axis=1), len(magnitudes), np.argmin(ok, axis=1))
+            maxTilt[:, k] = np.where(firstBad > 0, magnitudes[np.maximum(firstBad - 1, 0)], -1) # -1 means flat isn't reachable
+            maxTilt[firstBad == len(magnitudes), k] = np.inf # reachable as far as the search went, not bounded
+
+        os.makedirs(os.path.dirname(self.cachePath), exist_ok=True)
+        tempPath = self.cachePath + '.tmp.npz'
+        np.savez(tempPath, reachable=np.packbits(reachable.ravel()), maxTilt=maxTilt)
+        os.replace(tempPath, self.cachePath)
+        return reachable, maxTilt
+
+    def isReachable(self, pitch, roll, z):
+        """
+        True if the pose is reachable. Conservative, the pose only counts if all 8 grid points around it are reachable
+        """
+        fp = (pitch - self.mins[0]) / self.resolution[0]
+        fr = (roll - self.mins[1]) / self.resolution[1]
+        fz = (z - self.mins[2]) / self.resolution[2]
+        if not (0 <= fp <= self.shape[0] - 1 and 0 <= fr <= self.shape[1] - 1 and 0 <= fz <= self.shape[2] - 1):
+            return False
+        i = min(int(fp), self.shape[0] - 2)
+        j = min(int(fr), self.shape[1] - 2)
+        k = min(int(fz), self.shape[2] - 2)
+        return bool(self.reachable[i:i+2, j:j+2, k:k+2].all())
+
+    def maxTilt(self, direction, z):
+        """
+        largest reachable tilt magnitude (degrees) in a direction (degrees, 0 is pure pitch, 90 is pure roll) at height z.
+        Conservative, uses the smallest of the surrounding table entries. Returns -1 if even flat isn't reachable at z,
+        and inf if the tilt was still reachable at BOUNDARY_SEARCH_TILT. Clipped to the map's z range: outside it -1,
+        even if the platform could get there
+        """
+        fz = (z - self.mins[2]) / self.resolution[2]
+        if not 0 <= fz <= self.shape[2] - 1:
+            return -1.0
+        k = min(int(fz), self.shape[2] - 2)
+        d = int((direction % 360) / DIRECTION_STEP) % self.numDirections
+        nextD = (d + 1) % self.numDirections
+        return float(min(self.maxTiltTable[d, k], self.maxTiltTable[d, k+1],
+                         self.maxTiltTable[nextD, k], self.maxTiltTable[nextD, k+1]))
+
+    def zRange(self):
+        """
+        lowest and highest z where the platform can be flat, clipped to the map's z range (zRange given to the
+        constructor), so a limit equal to the map's edge may really be further out
+        """
+        return self._zLimits
+
+    def saturate(self, pitch, roll, z):
+        """
+        returns the pose moved onto the edge of the workspace if it is outside it: z is limited to the range where
+        the platform can be flat, then the tilt is scaled down (keeping its direction) to the largest reachable tilt
+        """
+        zMin, zMax = self.zRange()
+        z = min(max(z, zMin), zMax)
+        magnitude = math.hypot(pitch, roll)
+        if magnitude == 0:
+            return pitch, roll, z
+        limit = self.maxTilt(math.degrees(math.atan2(roll, pitch)), z)
+        if magnitude > limit:
+            scale = max(limit, 0) / magnitude
+            return pitch * scale, roll * scale, z
+        return pitch, roll, z
+
+    def saturateBatch(self, pitch, roll, z):
+        """
+        vectorized saturate, returns an (N, 3) array of the saturated (pitch, roll, z). Same result as calling
+        saturate on each pose, without the python loop
+        """
+        pitch, roll, z = (a.ravel() for a in np.broadcast_arrays(np.asarray(pitch, dtype=float),
+                                                                  np.asarray(roll, dtype=float),
+                                                                  np.asarray(z, dtype=float)))
+        zMin, zMax = self.zRange()
+        z = np.clip(z, zMin, zMax)
+        magnitude = np.hypot(pitch, roll)
+
+        # maxTilt for every pose, z is already inside the table so only the -1 of an unreachable flat is left
+        k = np.minimum(((z - self.mins[2]) / self.resolution[2]).astype(int), self.shape[2] - 2)
+        d = (np.degrees(np.arctan2(roll, pitch)) % 360 / DIRECTION_STEP).astype(int) % self.numDirections
+        nextD = (d + 1) % self.numDirections
+        limit = np.minimum(np.minimum(self.maxTiltTable[d, k], self.maxTiltTable[d, k+1]),
+                           np.minimum(self.maxTiltTable[nextD, k], self.maxTiltTable[nextD, k+1])).astype(float)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            scale = np.where(magnitude > limit, np.maximum(limit, 0) / magnitude, 1.0)
+        return np.column_stack((pitch * scale, roll * scale, z))
+
+    def saturateTilt(self, direction, magnitude, z):
+        """
+        saturate for a tilt direction and magnitude (see calculateMotorAngleTilt), the magnitude is limited to maxTilt.
+        The map is built for pitch and roll, which is the same as the tilt for small angles and close near the edge,
+        so a tilt right on the edge can still be slightly out of reach
+        """
+        zMin, zMax = self.zRange()
+        z = min(max(z, zMin), zMax)
+        if magnitude < 0:
+            direction, magnitude = direction + 180, -magnitude
+        return direction, min(magnitude, max(self.maxTilt(direction, z), 0)), z
+
+
+if __name__ == "__main__":
+    from time import perf_counter
+    startTime = perf_counter()
+    workspace = WorkspaceMap()
+    print("workspace map ready in", perf_counter() - startTime, "s, cached at", workspace.cachePath)
+    print("reachable z range =", workspace.zRange())
+    for z in (-30, 0, 30):
+        print("z =", z, "max tilt (pitch, roll, diagonal) =", workspace.maxTilt(0, z), workspace.maxTilt(90, z), workspace.maxTilt(45, z))